@@ -0,0 +1,236 @@
+import base64
+import hashlib
+import io
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from backend.cache import Cache, cache_key
+from backend.metrics import record_cache, timer
+
+# Formats every vision backend accepts as is.
+SUPPORTED_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+
+def image_tokens(width: int, height: int) -> int:
+    """Estimate the prompt tokens of an image: a base cost plus a cost per 512x512 tile, as vision models bill them."""
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def image_url(part: dict) -> str | None:
+    """Return the URL of an image content part, in either the OpenAI or the Mistral format."""
+    if part.get("type") != "image_url":
+        return None
+    url = part.get("image_url")
+    return url.get("url") if isinstance(url, dict) else url
+
+
+def strip_inline_images(message):
+    """
+    Return message with its inline (data URL) images replaced by an [image] text part, for storing it.
+
+    Images passed by URL are kept. The message itself is left as it is, since it is still in the conversation.
+    """
+    content = message.get("content") if isinstance(message, dict) else None
+    if not isinstance(content, list):
+        return message
+    parts = []
+    for part in content:
+        url = image_url(part) if isinstance(part, dict) else None
+        parts.append({"type": "text", "text": "[image]"} if url and url.startswith("data:") else part)
+    return {**message, "content": parts}
+
+
+def _url_key(url: str) -> str:
+    # Data URLs are a whole image long, so they are remembered by their digest.
+    return hashlib.sha1(url.encode()).hexdigest() if url.startswith("data:") else url
+
+
+
+class PreparedImage:
+    def __init__(self, url: str, width: int, height: int, sha256: str | None = None) -> None:
+        # A data URL of the downscaled image, or the original URL when it could not be processed.
+        self.url: str = url
+        self.width: int = width
+        self.height: int = height
+        self.sha256: str | None = sha256
+
+
+    @property
+    def tokens(self) -> int:
+        return image_tokens(self.width, self.height)
+
+
+
+class ImagePipeline:
+    """
+    Turns image attachments into compact image inputs for vision models and limits the images kept in context.
+
+    The images of a message are downloaded concurrently, downscaled to fit max_side pixels and recompressed,
+    then sent inline as data URLs, which are much smaller than full-size CDN images and save the model provider
+    a download. Results are cached by content hash, so an image posted again is not processed twice. Without
+    Pillow installed, attachments are passed by URL as before.
+
+    limit() keeps at most max_images images, the newest first, within token_budget estimated image tokens.
+    """
+    def __init__(
+        self,
+        cache: Cache | None = None,
+        max_side: int = 1024,
+        quality: int = 85,
+        max_images: int = 4,
+        token_budget: int = 3000,
+        max_download_bytes: int = 20 * 1024 * 1024,
+        timeout: float = 10,
+        max_workers: int = 4,
+    ) -> None:
+        self.cache: Cache | None = cache
+        self.max_side: int = max_side
+        self.quality: int = quality
+        self.max_images: int = max_images
+        self.token_budget: int = token_budget
+        self.max_download_bytes: int = max_download_bytes
+        self.timeout: float = timeout
+        self.session: requests.Session = requests.Session()
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image")
+        # Estimated tokens of the most recently prepared images, by URL, so limit() can charge each image its real
+        # cost. Bounded like the image cache; an image that was evicted is charged as a full-size one. Shared by
+        # the worker threads of every brain, hence the lock.
+        self._tokens: OrderedDict[str, int] = OrderedDict()
+        self._tokens_lock: threading.Lock = threading.Lock()
+        self._max_tokens_entries: int = cache.max_entries if cache is not None else 1024
+
+
+    def prepare(self, attachments: list) -> list[PreparedImage]:
+        """Download and downscale the image attachments of a message, skipping duplicates."""
+        attachments = [
+            attachment for attachment in attachments
+            if attachment.content_type and attachment.content_type.startswith("image/")
+            and (attachment.size or 0) <= self.max_download_bytes
+        ]
+        if Image is None:
+            images = [self._fallback(attachment) for attachment in attachments]
+        else:
+            with timer("image_prepare", images=len(attachments)):
+                images = list(self.executor.map(self._prepare, attachments))
+
+        unique = []
+        seen = set()
+        for image in images:
+            key = image.sha256 or image.url
+            if key not in seen:
+                seen.add(key)
+                unique.append(image)
+                self._remember_tokens(image)
+        return unique
+
+
+    def limit(self, history: list) -> None:
+        """Strip images from history in place, newest kept first, beyond max_images or token_budget."""
+        kept = 0
+        tokens = 0
+        for message in reversed(history):
+            content = message.get("content") if isinstance(message, dict) else None
+            if not isinstance(content, list):
+                continue
+            parts = []
+            for part in reversed(content):
+                url = image_url(part) if isinstance(part, dict) else None
+                if url is not None:
+                    # The cost is kept when the image is dropped, as other sessions may still hold the same image.
+                    with self._tokens_lock:
+                        cost = self._tokens.get(_url_key(url), image_tokens(self.max_side, self.max_side))
+                    if kept >= self.max_images or tokens + cost > self.token_budget:
+                        continue
+                    kept += 1
+                    tokens += cost
+                parts.append(part)
+            if len(parts) != len(content):
+                message["content"] = parts[::-1]
+
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+    def _remember_tokens(self, image: PreparedImage) -> None:
+        key = _url_key(image.url)
+        with self._tokens_lock:
+            self._tokens[key] = image.tokens
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self._max_tokens_entries:
+                self._tokens.popitem(last=False)
+
+
+    def _prepare(self, attachment) -> PreparedImage:
+        url_key = cache_key("image-url", attachment.url)
+        if self.cache is not None and (cached := self.cache.get(url_key)) is not None:
+            record_cache("image", True)
+            return PreparedImage(**cached)
+
+        try:
+            response = self.session.get(attachment.url, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.content
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to download image {attachment.url}, passing it by URL: {e}")
+            return self._fallback(attachment)
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        content_key = cache_key("image", sha256, self.max_side, self.quality)
+        cached = self.cache.get(content_key) if self.cache is not None else None
+        if self.cache is not None:
+            record_cache("image", cached is not None)
+        if cached is None:
+            try:
+                cached = self._downscale(data, attachment.content_type)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                print(f"Failed to process image {attachment.url}, passing it by URL: {e}")
+                return self._fallback(attachment)
+            cached["sha256"] = sha256
+            if self.cache is not None:
+                self.cache.set(content_key, cached)
+        if self.cache is not None:
+            self.cache.set(url_key, cached)
+        return PreparedImage(**cached)
+
+
+    def _downscale(self, data: bytes, content_type: str) -> dict:
+        with Image.open(io.BytesIO(data)) as source:
+            image = ImageOps.exif_transpose(source)
+            resized = max(image.size) > self.max_side
+            image.thumbnail((self.max_side, self.max_side))
+            transparent = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+            output = io.BytesIO()
+            if transparent:
+                image.save(output, "PNG", optimize=True)
+                encoded, mime = output.getvalue(), "image/png"
+            else:
+                image.convert("RGB").save(output, "JPEG", quality=self.quality, optimize=True)
+                encoded, mime = output.getvalue(), "image/jpeg"
+            # A small image may already be smaller than its recompressed version.
+            if not resized and content_type in SUPPORTED_TYPES and len(data) <= len(encoded):
+                encoded, mime = data, content_type
+            width, height = image.size
+
+        return {
+            "url": f"data:{mime};base64,{base64.b64encode(encoded).decode()}",
+            "width": width,
+            "height": height,
+        }
+
+
+    def _fallback(self, attachment) -> PreparedImage:
+        width = attachment.width or self.max_side
+        height = attachment.height or self.max_side
+        scale = min(1.0, self.max_side / max(width, height))
+        return PreparedImage(attachment.url, round(width * scale), round(height * scale))
@@ -0,0 +1,284 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Hashable, Iterator
+
+import torch
+from transformers import TextIteratorStreamer
+
+from backend.brains.prefix_cache import PrefixCache
+from backend.metrics import log_event, record_draft, record_usage, timer
+
+
+class GenerationRequest:
+    def __init__(self, messages: list, generation_kwargs: dict, session_id: Hashable | None = None) -> None:
+        self.messages: list = messages
+        self.session_id: Hashable | None = session_id
+        self.generation_kwargs: dict = generation_kwargs
+        self.future: Future = Future()
+
+
+    @property
+    def batch_key(self) -> tuple:
+        # Only requests with identical sampling settings can share a generate() call. Streamers are unique per
+        # request, so streamed requests always run on their own.
+        return tuple(sorted(self.generation_kwargs.items(), key=lambda item: item[0]))
+
+
+    def fail(self, error: Exception) -> None:
+        if not self.future.done():
+            self.future.set_exception(error)
+        # Unblock a caller iterating over the streamer.
+        if "streamer" in self.generation_kwargs:
+            self.generation_kwargs["streamer"].end()
+
+
+
+class BatchingEngine:
+    """
+    Runs chat generation for many callers on one transformers model.
+
+    Requests are queued by submit(). A background thread waits up to max_wait seconds after the first pending
+    request to collect up to max_batch_size requests, left-pads them into one batch, calls model.generate()
+    once and resolves each caller's future with its own decoded reply.
+
+    When a request is generated on its own, the engine reuses the past key values of the session's previous
+    turn or of a registered shared prefix (the system prompt) from its PrefixCache, so only new tokens are
+    prefilled.
+
+    With an assistant_model (a small draft model sharing the main model's tokenizer), generation uses assisted
+    decoding: the draft proposes a few tokens and the main model checks them all in one forward pass, keeping
+    the ones it would have produced itself, so replies are unchanged but need fewer passes of the large model.
+    Assisted decoding only supports a batch size of 1, so every request is then generated on its own, and
+    without the prefix cache.
+    """
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+        prefix_cache: PrefixCache | None = None,
+        assistant_model=None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait
+        self.prefix_cache: PrefixCache | None = prefix_cache
+        self._prefixes: dict[Hashable, list] = {}
+
+        self.assistant_model = assistant_model
+        # Forward passes of each model during the current assisted generate() call, counted by hooks. The draft
+        # proposes one token per pass, and every pass of the main model keeps the accepted tokens plus one of its own.
+        self._forward_passes: dict[str, int] = {"model": 0, "assistant": 0}
+        self.draft_proposed: int = 0
+        self.draft_accepted: int = 0
+        if assistant_model is not None:
+            self.model.register_forward_hook(lambda *args: self._count_forward("model"))
+            self.assistant_model.register_forward_hook(lambda *args: self._count_forward("assistant"))
+
+        # Decoder-only models must be padded on the left so every prompt ends right before its generated tokens.
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread = threading.Thread(target=self._run, name="batching-engine", daemon=True)
+        self._thread.start()
+
+
+    def submit(self, messages: list, session_id: Hashable | None = None, **generation_kwargs) -> Future:
+        """
+        Queue a chat for generation.
+
+        Args:
+            messages (list): The chat messages, formatted with the tokenizer's chat template.
+            session_id (Hashable): Optional session key under which the prompt's key/value cache is kept for the next turn.
+            **generation_kwargs: Keyword arguments for model.generate(), e.g. max_new_tokens or temperature.
+
+        Returns:
+            Future: Resolves to the generated reply text.
+        """
+        request = GenerationRequest(messages, generation_kwargs, session_id)
+        self._queue.put(request)
+        return request.future
+
+
+    def generate(self, messages: list, session_id: Hashable | None = None, **generation_kwargs) -> str:
+        return self.submit(messages, session_id, **generation_kwargs).result()
+
+
+    def stream(self, messages: list, session_id: Hashable | None = None, **generation_kwargs) -> Iterator[str]:
+        """Queue a chat for generation and yield the reply text as it is decoded; streamed requests are never batched."""
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        future = self.submit(messages, session_id, streamer=streamer, **generation_kwargs)
+        for chunk in streamer:
+            if chunk:
+                yield chunk
+        # Surface errors raised by generate().
+        future.result()
+
+
+    @property
+    def acceptance_rate(self) -> float | None:
+        """Share of draft tokens the main model accepted, or None before any assisted generation."""
+        return self.draft_accepted / self.draft_proposed if self.draft_proposed else None
+
+
+    def register_prefix(self, messages: list) -> None:
+        """Register messages (usually the system prompt) that start many prompts; their cache is shared by all sessions."""
+        self._prefixes[("prefix", repr(messages))] = messages
+
+
+    def forget(self, session_id: Hashable) -> None:
+        if self.prefix_cache is not None:
+            self.prefix_cache.discard(session_id)
+
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            stopping = False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            groups: dict[tuple, list[GenerationRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+            for group in groups.values():
+                if self.assistant_model is not None:
+                    # The draft model has no cache of its own for a reused prefix, so assisted requests are
+                    # generated from scratch: with the main model's cached prefix, replies would change.
+                    for request in group:
+                        self._generate_batch([request])
+                elif len(group) == 1 and self.prefix_cache is not None:
+                    self._generate_cached(group[0])
+                else:
+                    self._generate_batch(group)
+
+            if stopping:
+                return
+
+
+    def _generate_batch(self, batch: list[GenerationRequest]) -> None:
+        try:
+            with timer("tokenization", batch_size=len(batch)):
+                prompts = [
+                    self.tokenizer.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
+                    for request in batch
+                ]
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.model.device)
+
+            with timer("model_call", batch_size=len(batch)), torch.no_grad():
+                output = self._model_generate(
+                    **inputs,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **batch[0].generation_kwargs,
+                )
+
+            generated = output[:, inputs["input_ids"].shape[1]:]
+            record_usage(
+                "huggingface",
+                int(inputs["attention_mask"].sum()),
+                int((generated != self.tokenizer.pad_token_id).sum()),
+            )
+            replies = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            for request, reply in zip(batch, replies):
+                request.future.set_result(reply.strip())
+        except Exception as e:
+            for request in batch:
+                request.fail(e)
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+    def _generate_cached(self, request: GenerationRequest) -> None:
+        try:
+            with timer("tokenization", batch_size=1):
+                prompt = self.tokenizer.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
+                inputs = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(self.model.device)
+                input_ids = inputs["input_ids"][0].tolist()
+
+            self._compute_missing_prefixes()
+            keys = list(self._prefixes)
+            if request.session_id is not None:
+                keys.insert(0, request.session_id)
+            past_key_values, _ = self.prefix_cache.lookup(keys, input_ids)
+
+            with timer("model_call", batch_size=1, cached_tokens=past_key_values.get_seq_length() if past_key_values else 0), torch.no_grad():
+                output = self._model_generate(
+                    **inputs,
+                    past_key_values=past_key_values,
+                    return_dict_in_generate=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **request.generation_kwargs,
+                )
+
+            sequence = output.sequences[0]
+            record_usage("huggingface", len(input_ids), len(sequence) - len(input_ids))
+            reply = self.tokenizer.decode(sequence[len(input_ids):], skip_special_tokens=True)
+            if request.session_id is not None and output.past_key_values is not None:
+                # The cache covers every token except the last generated one.
+                cached_length = output.past_key_values.get_seq_length()
+                self.prefix_cache.store(request.session_id, sequence[:cached_length].tolist(), output.past_key_values)
+            request.future.set_result(reply.strip())
+        except Exception as e:
+            request.fail(e)
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+    def _model_generate(self, **kwargs):
+        if self.assistant_model is None:
+            return self.model.generate(**kwargs)
+
+        self._forward_passes = {"model": 0, "assistant": 0}
+        output = self.model.generate(assistant_model=self.assistant_model, **kwargs)
+        sequences = output.sequences if hasattr(output, "sequences") else output
+        generated = sequences.shape[1] - kwargs["input_ids"].shape[1]
+        proposed = self._forward_passes["assistant"]
+        accepted = min(proposed, max(0, generated - self._forward_passes["model"]))
+        self.draft_proposed += proposed
+        self.draft_accepted += accepted
+        record_draft(proposed, accepted)
+        log_event("assisted_decoding", proposed=proposed, accepted=accepted, generated=generated)
+        return output
+
+
+    def _count_forward(self, model: str) -> None:
+        self._forward_passes[model] += 1
+
+
+    def _compute_missing_prefixes(self) -> None:
+        for key, messages in self._prefixes.items():
+            if key in self.prefix_cache:
+                continue
+            prompt = self.tokenizer.apply_chat_template(messages, tokenize=False)
+            inputs = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(self.model.device)
+            with torch.no_grad():
+                output = self.model(**inputs, use_cache=True)
+            self.prefix_cache.store(key, inputs["input_ids"][0].tolist(), output.past_key_values)
@@ -1,8 +1,60 @@
+import asyncio
+import json
+import os
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Hashable, Iterator
+
 import discord
 
+from backend.attachments import strip_inline_images
+from backend.cache import Cache, cache_key
+from backend.context import ContextWindow, approximate_token_count, message_role, message_text, summary_prompt
+from backend.memory import SemanticMemory
+from backend.metrics import log_event, record_cache, timer
+from backend.persistence import ConversationStore
+from backend.sessions import Session, SessionManager
+from backend.tool_registry import tool_result_text
+
+# Characters of tool arguments and results kept in log lines.
+LOG_VALUE_CHARS: int = 200
+
 
 class Brain:
+    def __init__(self, *args, **kwargs) -> None:
+        # Upper bound on the number of response() calls that may run at the same time.
+        self.max_workers: int = kwargs.pop('max_workers', 4)
+        self.system_prompt: str = ""
+        # Optional store to which every turn is appended as it happens, labelled with the persona's key.
+        self.store: ConversationStore | None = kwargs.pop('conversation_store', None)
+        self.persona: str = kwargs.pop('persona', "")
+        # Optional long-term memory of each channel, searched for turns relevant to the newest message.
+        self.memory: SemanticMemory | None = kwargs.pop('memory', None)
+        self.sessions: SessionManager = SessionManager(
+            self._initial_history,
+            max_sessions=kwargs.pop('max_sessions', 100),
+            idle_timeout=kwargs.pop('session_idle_timeout', 3600),
+            on_append=self._on_append if self.store is not None or self.memory is not None else None,
+            # Optional store shared with other bot processes (shards), so conversations continue across them.
+            store=kwargs.pop('session_store', None),
+            namespace=self.persona,
+        )
+        self.context: ContextWindow = ContextWindow(
+            self.count_tokens,
+            self._summarize,
+            max_tokens=kwargs.pop('context_tokens', 3000),
+            summary_tokens=kwargs.pop('summary_tokens', 200),
+            recall=self._recall if self.memory is not None else None,
+        )
+        # Optional cache of first-turn replies, keyed on the model, the character and the normalized message.
+        self.cache: Cache | None = kwargs.pop('cache', None)
+        self.cache_completions: bool = kwargs.pop('cache_completions', False)
+        self._executor: ThreadPoolExecutor | None = None
+        # Every brain is offered the shared tools and image pipeline; those that use them took them already.
+        kwargs.pop('tools', None)
+        kwargs.pop('images', None)
+        if kwargs:
+            print(f"{type(self).__name__} ignores unknown options: {', '.join(sorted(kwargs))}")
 
     @abstractmethod
     def add_system_prompt(self, system_prompt: str) -> None:
@@ -12,10 +64,264 @@ class Brain:
     def response(self, message: discord.Message) -> str:
         pass
 
-    @abstractmethod
-    def reset_history(self) -> None:
-        pass
+    def stream(self, message: discord.Message) -> Iterator[str]:
+        """Yield the response in chunks as it is generated; brains whose backend cannot stream yield it whole."""
+        yield self.response(message)
 
-    @abstractmethod
-    def save_history(self, title: str) -> None:
-        pass
\ No newline at end of file
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens in text; brains with access to their model's tokenizer override this."""
+        return approximate_token_count(text)
+
+    def reset_history(self, session_id: Hashable) -> None:
+        self.sessions.reset(session_id)
+
+    def save_history(self, title: str, session_id: Hashable) -> None:
+        session = self.sessions.get(session_id)
+        if self.store is not None:
+            # Every turn is already stored; saving only records the title in the conversation index.
+            if session.conversation_id is None:
+                session.conversation_id = self.store.start_conversation(session_id, self.persona)
+            self.store.name(session.conversation_id, title)
+            return
+
+        # Snapshot the history instead of taking the session lock, which may be held by a running response.
+        # Inline images are left out, as they would make every save as large as the images in it.
+        history = [strip_inline_images(message) for message in session.history]
+        os.makedirs("./conversations/", exist_ok=True)
+        file_path = f"./conversations/{title}.json"
+        with open(file_path, "w") as json_file:
+            json.dump(history, json_file, indent=4)
+
+    def load_history(self, title: str, session_id: Hashable) -> int:
+        """
+        Replace the session's conversation with the one saved under title; new turns continue the saved one.
+
+        Only the most recent turns are read back, as older ones would be folded into the summary anyway.
+
+        Returns:
+            int: The number of turns loaded.
+
+        Raises:
+            KeyError: If no conversation is saved under title.
+        """
+        conversation_id = None
+        if self.store is not None:
+            conversation_id = self.store.find(title)
+            if conversation_id is None:
+                raise KeyError(title)
+            turns = self.store.load(conversation_id)
+        else:
+            try:
+                with open(f"./conversations/{title}.json") as json_file:
+                    turns = json.load(json_file)[len(self._initial_history()):]
+            except FileNotFoundError:
+                raise KeyError(title)
+
+        # Tool results are meaningless without the call that produced them.
+        while turns and message_role(turns[0]) == "tool":
+            turns.pop(0)
+        self.reset_history(session_id)
+        session = self.sessions.get(session_id)
+        with session.lock:
+            # Extend rather than append, so the loaded turns are not stored a second time.
+            session.history.extend(turns)
+            session.conversation_id = conversation_id
+        self.sessions.save(session_id)
+        return len(turns)
+
+    async def aresponse(self, message: discord.Message) -> str:
+        """
+        Generate a response without blocking the asyncio event loop.
+
+        The synchronous response() is dispatched to a bounded thread pool owned by the brain, so the Discord
+        gateway keeps sending heartbeats and serving other channels while a reply is being generated.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self._cached_response, message)
+
+    async def astream(self, message: discord.Message) -> AsyncIterator[str]:
+        """
+        Asynchronously yield the chunks of stream().
+
+        The synchronous stream() runs to completion in one thread of the brain's pool (so it may hold the session
+        lock for the whole reply) and hands each chunk to the event loop as soon as it is produced.
+        """
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def produce() -> None:
+            try:
+                for chunk in self._cached_stream(message):
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, done)
+
+        producer = loop.run_in_executor(self._get_executor(), produce)
+        while (chunk := await chunks.get()) is not done:
+            yield chunk
+        # Re-raise any error raised while generating.
+        await producer
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def model_id(self) -> str:
+        return str(getattr(self, "model_name", None) or getattr(self, "model", ""))
+
+    @staticmethod
+    def session_id(message: discord.Message) -> Hashable:
+        """Return the key of the conversation a message belongs to (threads have their own channel id)."""
+        return message.channel.id
+
+    def _completion_key(self, message: discord.Message) -> str | None:
+        """
+        Return the cache key for a reply to message, or None if the reply may not be cached.
+
+        Only replies opening a conversation are cached: they depend on nothing but the model, the character's
+        system prompt and the message itself. Messages with attachments are never cached.
+        """
+        if self.cache is None or not self.cache_completions or message.attachments:
+            return None
+        session = self.sessions.get(self.session_id(message))
+        if len(session.history) != len(self._initial_history()):
+            return None
+        return cache_key("completion", self.model_id, self.system_prompt, message.content)
+
+    def _cached_response(self, message: discord.Message) -> str:
+        try:
+            return self._generate_response(message)
+        finally:
+            self.sessions.save(self.session_id(message))
+
+    def _cached_stream(self, message: discord.Message) -> Iterator[str]:
+        try:
+            yield from self._generate_stream(message)
+        finally:
+            self.sessions.save(self.session_id(message))
+
+    def _generate_response(self, message: discord.Message) -> str:
+        key = self._completion_key(message)
+        reply = self.cache.get(key) if key is not None else None
+        if key is not None:
+            record_cache("completion", reply is not None)
+        if reply is not None:
+            self._record_turn(message, reply)
+            return reply
+
+        with timer("response", brain=type(self).__name__):
+            reply = self.response(message)
+        if key is not None:
+            self.cache.set(key, reply)
+        return reply
+
+    def _generate_stream(self, message: discord.Message) -> Iterator[str]:
+        key = self._completion_key(message)
+        reply = self.cache.get(key) if key is not None else None
+        if key is not None:
+            record_cache("completion", reply is not None)
+        if reply is not None:
+            self._record_turn(message, reply)
+            yield reply
+            return
+
+        chunks = []
+        with timer("response", brain=type(self).__name__):
+            for chunk in self.stream(message):
+                chunks.append(chunk)
+                yield chunk
+        if key is not None:
+            self.cache.set(key, "".join(chunks))
+
+    def _record_turn(self, message: discord.Message, reply: str) -> None:
+        """Add a user message and a reply that was not generated by the model (e.g. cached) to the session."""
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+            session.append({"role": "assistant", "content": reply})
+
+    def _run_tool_calls(self, session: Session, assistant_message) -> None:
+        """
+        Execute every tool call of assistant_message concurrently and add the call and its results to the session.
+
+        The messages use the tool calling format that OpenAI and Mistral share, so any API brain with tools can use this.
+        """
+        tool_calls = assistant_message.tool_calls
+        # Store the call as a plain dict so the history stays JSON-serializable.
+        session.append({
+            "role": "assistant",
+            "content": assistant_message.content or "",
+            "tool_calls": [{
+                "id": tool_call.id,
+                "type": "function",
+                "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+            } for tool_call in tool_calls],
+        })
+
+        # Execute the tools
+        with timer("tool_round", tools=len(tool_calls)):
+            function_results = self.tools.call_many([(tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls])
+
+        # Add the tool responses to the conversation
+        for tool_call, function_result in zip(tool_calls, function_results):
+            content = tool_result_text(function_result)
+            log_event(
+                "tool_call",
+                tool=tool_call.function.name,
+                session=session.session_id,
+                arguments=_truncate(str(tool_call.function.arguments)),
+                result=_truncate(content),
+                result_chars=len(content),
+            )
+            session.append({
+                "role": "tool",
+                "name": tool_call.function.name,
+                "content": content,
+                "tool_call_id": tool_call.id
+            })
+
+    def _on_append(self, session: Session, message) -> None:
+        if self.store is not None:
+            self._persist(session, message)
+        if self.memory is not None:
+            self.memory.remember(self._memory_channel(session.session_id), message)
+
+    def _persist(self, session: Session, message) -> None:
+        if session.conversation_id is None:
+            session.conversation_id = self.store.start_conversation(session.session_id, self.persona)
+        self.store.append(session.conversation_id, strip_inline_images(message))
+
+    def _memory_channel(self, session_id: Hashable) -> str:
+        # Personas in the same channel each remember their own conversation.
+        return f"{self.persona}-{session_id}" if self.persona else str(session_id)
+
+    def _recall(self, session: Session) -> list[str]:
+        query = next((message_text(message) for message in reversed(session.history) if message_role(message) == "user"), "")
+        # Turns still in the history are sent anyway.
+        in_context = {self.memory.memory_text(message) for message in session.history}
+        return self.memory.recall(self._memory_channel(session.session_id), query, exclude=in_context)
+
+    def _initial_history(self) -> list:
+        return [{
+            "role": "system",
+            "content": self.system_prompt
+        }]
+
+    def _complete(self, messages: list, max_tokens: int) -> str:
+        """Run a plain completion (no tools, no history) over messages and return the reply text."""
+        raise NotImplementedError
+
+    def _summarize(self, summary: str, turns: list) -> str:
+        return self._complete(summary_prompt(summary, turns), self.context.summary_tokens)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="brain")
+        return self._executor
+
+
+def _truncate(text: str, limit: int = LOG_VALUE_CHARS) -> str:
+    return text if len(text) <= limit else text[:limit] + "..."
@@ -0,0 +1,323 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import discord
+
+from backend.brains.brain import Brain
+from backend.metrics import BACKEND_REQUESTS, log_event
+from backend.sessions import Session
+
+# Events an attempt at a reply sends back to the fallback brain.
+CHUNK = "chunk"
+DONE = "done"
+ERROR = "error"
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a backend after failure_threshold failures in a row.
+
+    The breaker then stays open for reset_timeout seconds, after which one trial request is let through (half
+    open); it closes again if the trial succeeds and reopens if it fails.
+    """
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.failures: int = 0
+        self.opened_at: float | None = None
+        self._trial: bool = False
+        self._lock: threading.Lock = threading.Lock()
+
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+
+    def available(self) -> bool:
+        """Return whether a request would be let through, without taking the trial of a half open breaker."""
+        with self._lock:
+            state = self._state()
+            return state == "closed" or (state == "half_open" and not self._trial)
+
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent, taking the trial if the breaker is half open."""
+        with self._lock:
+            state = self._state()
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return state == "closed"
+
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+
+    def record_failure(self) -> bool:
+        """Count a failure and return whether it opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                opened = self._state() != "open"
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+
+    def _state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+
+
+class Backend:
+    """One of the brains behind a FallbackBrain, with its recent latencies and its circuit breaker."""
+    def __init__(self, brain: Brain, breaker: CircuitBreaker, window: int = 100) -> None:
+        self.brain: Brain = brain
+        self.name: str = type(brain).__name__
+        self.breaker: CircuitBreaker = breaker
+        # Seconds until the first output of the most recent requests.
+        self.latencies: deque[float] = deque(maxlen=window)
+
+
+    def latency(self, quantile: float, min_samples: int = 10) -> float | None:
+        """Return the given quantile of the recent latencies, or None until min_samples requests were timed."""
+        latencies = sorted(self.latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+
+
+class FallbackBrain(Brain):
+    """
+    Answers with the fastest healthy of several brains, e.g. OpenAI, Mistral and a local model.
+
+    Each request goes to the backend with the lowest median latency whose circuit breaker is closed. If it has
+    not answered by its hedge_quantile latency (its p95 by default, or hedge_delay seconds until it has enough
+    history), the request is hedged: it is sent to the next backend as well and whichever answers first is used.
+    A backend that fails is replaced by the next one straight away, and after failure_threshold failures in a
+    row its breaker keeps requests away from it for reset_timeout seconds. While streaming, the first backend to
+    produce a chunk wins. Slow replies are then bounded by the fastest healthy backend rather than the slowest.
+
+    The fallback brain owns the conversation: its history holds the text of each turn and is copied into the
+    backend that answers, so any backend can pick up where another left off. Images are only sent along with the
+    message they are attached to. Tool calls and their results only live in the answering backend's copy while
+    it replies; later turns see the text of each reply, not the tool calls behind it.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        backends: list[Brain] = kwargs.pop('backends', None)
+        if not backends: raise ValueError("Missing required 'backends' argument")
+        failure_threshold = kwargs.pop('failure_threshold', 3)
+        reset_timeout = kwargs.pop('reset_timeout', 30.0)
+        self.backends: list[Backend] = [Backend(brain, CircuitBreaker(failure_threshold, reset_timeout)) for brain in backends]
+        self.hedge_quantile: float = kwargs.pop('hedge_quantile', 0.95)
+        # Seconds before hedging a request to a backend whose latency is not known yet.
+        self.hedge_delay: float = kwargs.pop('hedge_delay', 5.0)
+        # Seconds to wait for any backend to start answering, and then for the backend answering to go on.
+        self.timeout: float = kwargs.pop('timeout', 60.0)
+        super().__init__(*args, **kwargs)
+        # Attempts that lost a race keep running until their backend's next chunk, so each request may hold a
+        # thread in every backend.
+        self._attempts: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=self.max_workers * len(self.backends), thread_name_prefix="fallback"
+        )
+        if self.memory is not None:
+            # Memories are recalled into the prompt of the backend that answers, not into the shared history.
+            for backend in self.backends:
+                backend.brain.context.recall = self._recall
+            self.context.recall = None
+
+
+    def add_system_prompt(self, system_prompt: str) -> None:
+        self.system_prompt = system_prompt
+        for backend in self.backends:
+            backend.brain.add_system_prompt(system_prompt)
+
+
+    def response(self, message: discord.Message) -> str:
+        return "".join(self._race(message, stream=False))
+
+
+    def stream(self, message: discord.Message) -> Iterator[str]:
+        yield from self._race(message, stream=True)
+
+
+    def count_tokens(self, text: str) -> int:
+        return self.backends[0].brain.count_tokens(text)
+
+
+    def shutdown(self) -> None:
+        self._attempts.shutdown(wait=False, cancel_futures=True)
+        for backend in self.backends:
+            backend.brain.shutdown()
+        super().shutdown()
+
+
+    @property
+    def model_id(self) -> str:
+        return "+".join(backend.brain.model_id for backend in self.backends)
+
+
+    def _route(self) -> list[Backend]:
+        """Return the backends whose breakers let requests through, lowest median latency first."""
+        available = [backend for backend in self.backends if backend.breaker.available()]
+        # Backends without enough history keep their configured order, after the ones known to be fast.
+        return sorted(available, key=lambda backend: backend.latency(0.5) or float("inf"))
+
+
+    def _race(self, message: discord.Message, stream: bool) -> Iterator[str]:
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+            self.context.fit(session)
+            # The backend adds the new message itself, with its attachments.
+            turns = session.history[len(self._initial_history()):-1]
+            summary = session.summary
+
+            candidates = self._route()
+            events: queue.Queue = queue.Queue()
+            started: list[Backend] = []
+            # Set to stop an attempt that lost the race or was given up on, so it frees its backend's session.
+            cancelled: list[threading.Event] = []
+            failed: set[int] = set()
+            errors: list[Exception] = []
+            winner: int | None = None
+            deadline = time.monotonic() + self.timeout
+
+            def start() -> float:
+                while candidates:
+                    backend = candidates.pop(0)
+                    if backend.breaker.allow():
+                        started.append(backend)
+                        cancelled.append(threading.Event())
+                        self._attempts.submit(self._attempt, len(started) - 1, backend, message, turns, summary, stream, events, cancelled[-1])
+                        latency = backend.latency(self.hedge_quantile)
+                        return time.monotonic() + (self.hedge_delay if latency is None else latency)
+                return deadline
+
+            hedge_at = start()
+            if not started:
+                raise RuntimeError("No backend is available: every circuit breaker is open.")
+
+            chunks = []
+            try:
+                while True:
+                    # Once a backend is answering, it may pause for up to timeout seconds between chunks.
+                    timeout = self.timeout if winner is not None else max(0.0, min(hedge_at, deadline) - time.monotonic())
+                    try:
+                        attempt, kind, value = events.get(timeout=timeout)
+                    except queue.Empty:
+                        if winner is not None:
+                            BACKEND_REQUESTS.inc(backend=started[winner].name, outcome="failed")
+                            raise TimeoutError(f"{started[winner].name} stopped answering for {self.timeout} seconds.")
+                        if time.monotonic() >= deadline:
+                            raise TimeoutError(f"No backend answered within {self.timeout} seconds.")
+                        # The backend is slower than usual: ask the next one as well.
+                        if candidates:
+                            log_event("hedge", backend=started[-1].name, session=session.session_id)
+                        hedge_at = start()
+                        continue
+
+                    if kind == ERROR:
+                        failed.add(attempt)
+                        BACKEND_REQUESTS.inc(backend=started[attempt].name, outcome="failed")
+                        if attempt == winner:
+                            # Part of the reply may have been shown already, so it cannot be taken over by another backend.
+                            raise value
+                        if winner is None:
+                            print(f"{started[attempt].name} failed, falling back to the next backend: {value}")
+                            errors.append(value)
+                            hedge_at = start()
+                            if len(failed) == len(started):
+                                raise errors[-1]
+                        continue
+
+                    if winner is None:
+                        winner = attempt
+                        for index, backend in enumerate(started):
+                            if index != winner:
+                                cancelled[index].set()
+                            if index not in failed:
+                                BACKEND_REQUESTS.inc(backend=backend.name, outcome="answered" if index == winner else "abandoned")
+                    if attempt != winner:
+                        continue
+                    if kind == DONE:
+                        break
+                    chunks.append(value)
+                    yield value
+            finally:
+                for event in cancelled:
+                    event.set()
+
+            session.append({"role": "assistant", "content": "".join(chunks)})
+
+
+    def _attempt(self, index: int, backend: Backend, message: discord.Message, turns: list, summary: str, stream: bool, events: queue.Queue, cancelled: threading.Event) -> None:
+        """
+        Generate a reply with one backend from a copy of the conversation, reporting its chunks to events.
+
+        The backend always streams, so the attempt can stop between chunks once cancelled is set rather than hold
+        the backend's session until its reply is complete; without streaming, the chunks are reported as one.
+        """
+        started = time.monotonic()
+        timed = False
+        try:
+            brain = backend.brain
+            session = brain.sessions.get(brain.session_id(message))
+            with session.lock:
+                session.history[:] = brain._initial_history() + [dict(turn) for turn in turns]
+                session.summary = summary
+                chunks = brain.stream(message)
+                reply = []
+                try:
+                    for chunk in chunks:
+                        if cancelled.is_set():
+                            return
+                        if not stream:
+                            reply.append(chunk)
+                            continue
+                        if not timed:
+                            backend.latencies.append(time.monotonic() - started)
+                            timed = True
+                        events.put((index, CHUNK, chunk))
+                finally:
+                    # Closing the generator releases whatever the backend holds, its session lock included.
+                    chunks.close()
+                if not stream:
+                    events.put((index, CHUNK, "".join(reply)))
+            if not timed:
+                backend.latencies.append(time.monotonic() - started)
+            backend.breaker.record_success()
+            events.put((index, DONE, None))
+        except Exception as e:
+            if backend.breaker.record_failure():
+                print(f"Stopped sending requests to {backend.name} for {backend.breaker.reset_timeout} seconds after {backend.breaker.failures} failures: {e}")
+            events.put((index, ERROR, e))
+
+
+    def _complete(self, messages: list, max_tokens: int) -> str:
+        error = RuntimeError("No backend is available: every circuit breaker is open.")
+        for backend in self._route():
+            try:
+                return backend.brain._complete(messages, max_tokens)
+            except Exception as e:
+                backend.breaker.record_failure()
+                error = e
+        raise error
+
+
+    def _add_user_message(self, session: Session, message: discord.Message) -> None:
+        session.append({"role": "user", "content": message.content})
@@ -1,119 +1,212 @@
 import gc
-import json
 import os
+import threading
+from typing import Hashable, Iterator
 
 from dotenv import load_dotenv
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    BitsAndBytesConfig,
-    Pipeline,
-    pipeline,
-)
+from transformers import AutoTokenizer
 import torch
 import discord
 
+from backend.brains.batching import BatchingEngine
 from backend.brains.brain import Brain
+from backend.brains.model_backends import ModelBackend, get_backend
+from backend.brains.prefix_cache import PrefixCache
+from backend.brains.workers import WorkerPool
+from backend.sessions import Session
 
 load_dotenv()
 HF_TOKEN: str = os.getenv('HUGGINGFACE_TOKEN')
 MODEL_NAME: str = os.getenv('HUGGINGFACE_MODEL_NAME')
+# Optional small model with the same tokenizer, used as the draft model for assisted decoding.
+DRAFT_MODEL_NAME: str | None = os.getenv('HUGGINGFACE_DRAFT_MODEL_NAME')
+
+
+
+def load_tokenizer(model_name: str) -> AutoTokenizer:
+    return AutoTokenizer.from_pretrained(model_name, token=HF_TOKEN)
+
+
+def load_model(model_name: str, backend: str | None = "auto"):
+    """Load a model with one of the backends in backend.brains.model_backends, e.g. 'bnb-4bit' or 'int8-dynamic'."""
+    model_backend = get_backend(backend)
+    print(f"Loading model {model_name} ({model_backend.description})...")
+    return model_backend.load(model_name, HF_TOKEN)
+
+
+
+class SharedModel:
+    """A loaded tokenizer, model and engine, shared by every brain in the process that uses the same model."""
+    def __init__(self, tokenizer: AutoTokenizer, model, engine: BatchingEngine | WorkerPool, engine_options: dict) -> None:
+        self.tokenizer: AutoTokenizer = tokenizer
+        # None when the model runs in worker processes.
+        self.model = model
+        self.engine: BatchingEngine | WorkerPool = engine
+        # The options the engine was built with, which later brains sharing it cannot change.
+        self.engine_options: dict = engine_options
+        self.users: int = 0
+
+
+# Loaded models by (model name, backend), so personas running on the same weights keep one copy in memory.
+_shared_models: dict[tuple[str, str], SharedModel] = {}
+_shared_models_lock: threading.Lock = threading.Lock()
 
 
 class HuggingfaceModelLoader(Brain):
     def __init__(self, *args, **kwargs):
         self.model_name: str = MODEL_NAME
-        self.quantize: bool = True
-        self.tokenizer:AutoTokenizer = AutoTokenizer.from_pretrained(self.model_name, token=HF_TOKEN)
+        self.draft_model_name: str | None = DRAFT_MODEL_NAME
+        # How the weights are loaded, see model_backends.MODEL_BACKENDS. The older quantize flag maps to bnb-4bit or bf16.
+        quantize: bool | None = kwargs.pop('quantize', None)
+        backend_name: str = kwargs.pop('model_backend', None) or {True: "bnb-4bit", False: "bf16"}.get(quantize, "auto")
+        self.backend: ModelBackend = get_backend(backend_name)
         self.device:str = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.max_tokens: int = 200
-        self.system_prompt: str
-        self.conversation_history: list = []
-
-        if self.quantize:
-            self.model = self._load_quantized_model()
-        else:
-            self.model = self.model_name
-
-        self.generator: Pipeline = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            torch_dtype=torch.bfloat16,
-            device_map="auto",
-            pad_token_id=self.tokenizer.eos_token_id,
-            token=HF_TOKEN,
-        )
+        max_batch_size: int = kwargs.pop('max_batch_size', 8)
+        batch_wait_ms: float = kwargs.pop('batch_wait_ms', 10)
+        prefix_cache_mb: int = kwargs.pop('prefix_cache_mb', 256)
+        # With workers > 0 the model is loaded in that many separate processes and this brain only talks to them.
+        workers: int = kwargs.pop('workers', 0)
+        # Concurrent responses are batched by the engine, so allow one worker per batch slot.
+        kwargs.setdefault('max_workers', max_batch_size)
+        super().__init__(*args, **kwargs)
+
+        # The first brain to use a model loads it; later ones share its weights and engine, so requests from
+        # different personas are batched together. Each brain keeps its own system prompt and sessions.
+        engine_options = {
+            'max_batch_size': max_batch_size,
+            'batch_wait_ms': batch_wait_ms,
+            'prefix_cache_mb': prefix_cache_mb,
+            'workers': workers,
+        }
+        with _shared_models_lock:
+            shared = _shared_models.get((self.model_name, self.backend.name))
+            if shared is None:
+                tokenizer = load_tokenizer(self.model_name)
+                if workers:
+                    model = None
+                    engine = WorkerPool(
+                        self.model_name,
+                        self.backend.name,
+                        workers=workers,
+                        engine_options={
+                            'max_batch_size': max_batch_size,
+                            'max_wait': batch_wait_ms / 1000,
+                            'prefix_cache_mb': prefix_cache_mb,
+                            'draft_model_name': self.draft_model_name,
+                        },
+                    )
+                else:
+                    model = load_model(self.model_name, self.backend.name)
+                    engine = BatchingEngine(
+                        model,
+                        tokenizer,
+                        max_batch_size=max_batch_size,
+                        max_wait=batch_wait_ms / 1000,
+                        prefix_cache=PrefixCache(max_bytes=prefix_cache_mb * 1024 * 1024) if prefix_cache_mb and self.backend.prefix_cache else None,
+                        assistant_model=self._load_draft_model(),
+                    )
+                shared = _shared_models[(self.model_name, self.backend.name)] = SharedModel(tokenizer, model, engine, engine_options)
+            elif engine_options != shared.engine_options:
+                ignored = ", ".join(
+                    f"{key}={value} (using {shared.engine_options[key]})"
+                    for key, value in engine_options.items() if value != shared.engine_options[key]
+                )
+                print(f"{self.model_name} is already loaded with other engine options, ignoring {ignored}.")
+            shared.users += 1
+
+        self.shared: SharedModel = shared
+        self.tokenizer: AutoTokenizer = shared.tokenizer
+        self.model = shared.model
+        self.engine: BatchingEngine | WorkerPool = shared.engine
 
 
     def add_system_prompt(self, system_prompt: str) -> None:
         self.system_prompt = system_prompt
-        self.conversation_history.append({
-            "role": "system",
-            "content": self.system_prompt
-        })
+        self.engine.register_prefix(self._initial_history())
 
     
     def response(self, message: discord.Message) -> str:
-        self._add_user_message(message)
-        chat_response = self.generator(
-            self.conversation_history,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.6,
-            max_new_tokens=self.max_tokens,
-        )
-
-        self.conversation_history.append({"role": "assistant", "content": chat_response[0]['generated_text'][-1]['content']})
-
-        torch.cuda.empty_cache()
-        return chat_response[0]['generated_text'][-1]['content']
-    
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+            reply = self.engine.generate(
+                self.context.fit(session),
+                self._cache_key(session.session_id),
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.6,
+                max_new_tokens=self.max_tokens,
+            )
 
-    def reset_history(self) -> None:
-        self.conversation_history = [{
-            "role": "user",
-            "content": self.system_prompt
-        }]
+            session.append({"role": "assistant", "content": reply})
 
-    
-    def save_history(self, title: str) -> None:
-        os.makedirs("./conversations/", exist_ok=True)
-        file_path = f"./conversations/{title}.json"
-        with open(file_path, "w") as json_file:
-            json.dump(self.conversation_history, json_file, indent=4)
+        return reply
+
+
+    def stream(self, message: discord.Message) -> Iterator[str]:
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+            reply = ""
+            for chunk in self.engine.stream(
+                self.context.fit(session),
+                self._cache_key(session.session_id),
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.6,
+                max_new_tokens=self.max_tokens,
+            ):
+                reply += chunk
+                yield chunk
+
+            session.append({"role": "assistant", "content": reply.strip()})
+
+
+    def reset_history(self, session_id) -> None:
+        super().reset_history(session_id)
+        self.engine.forget(self._cache_key(session_id))
+
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+
+    def _complete(self, messages: list, max_tokens: int) -> str:
+        return self.engine.generate(messages, do_sample=False, max_new_tokens=max_tokens)
 
     
-    def cleanup(self):        
-        del self.generator
-        self.generator = None
-        del self.tokenizer
+    def cleanup(self):
+        with _shared_models_lock:
+            self.shared.users -= 1
+            last_user = self.shared.users == 0
+            if last_user:
+                del _shared_models[(self.model_name, self.backend.name)]
+                self.engine.stop()
+        self.engine = None
         self.tokenizer = None
-        del self.model
         self.model = None
-        gc.collect()
+        self.shared = None
+        if last_user:
+            gc.collect()
+            torch.cuda.empty_cache()
 
-        torch.cuda.empty_cache()
-    
 
-    def _add_user_message(self, message: discord.Message) -> None:     
-        self.conversation_history.append({
-            "role": "user",
-            "content": message.content
-        })
+    def _load_draft_model(self):
+        if not self.draft_model_name:
+            return None
+        print(f"Loading draft model {self.draft_model_name} for assisted decoding...")
+        return load_model(self.draft_model_name, self.backend.name)
 
 
-    def _load_quantized_model(self):
-        print("Loading quantized model...")
-        bnb_config = BitsAndBytesConfig(load_in_4bit=True)
+    def _cache_key(self, session_id: Hashable) -> tuple:
+        # Personas sharing the engine see the same channel ids, so their cached turns are kept apart.
+        return (id(self), session_id)
 
-        model = AutoModelForCausalLM.from_pretrained(
-            self.model_name,
-            quantization_config=bnb_config,
-            device_map="auto",
-            torch_dtype=torch.bfloat16,
-            token=HF_TOKEN,
-        )
 
-        return model
\ No newline at end of file
+    def _add_user_message(self, session: Session, message: discord.Message) -> None:     
+        session.append({
+            "role": "user",
+            "content": message.content
+        })
@@ -1,142 +1,177 @@
-import json
 import os
+from typing import Iterator
 
 from dotenv import load_dotenv
 from mistralai import Mistral
+from mistralai.models import AssistantMessage
 import discord
 
+from backend.attachments import ImagePipeline
 from backend.brains.brain import Brain
+from backend.metrics import record_usage, timer
+from backend.sessions import Session
 from backend.tools import Tools
 
 load_dotenv()
 API_KEY = os.getenv('API_KEY')
+# Overridable so benchmarks can point the brain at a local stub server.
+MISTRAL_SERVER_URL = os.getenv('MISTRAL_SERVER_URL')
 
 
 class MistralVisionAPIBrain(Brain):
     def __init__(self, *args, **kwargs):
         self.model: str = "pixtral-12b-2409"
-        self.mistral_client = Mistral(api_key=API_KEY)
+        self.mistral_client = Mistral(api_key=API_KEY, server_url=MISTRAL_SERVER_URL)
         
         self.tools: Tools = kwargs.pop('tools', None)        
         if self.tools is None: raise ValueError("Missing required 'tools' argument")
         
         self.max_tokens: int = 200
-        self.system_prompt: str
-        self.conversation_history: list = []
+        self.images: ImagePipeline = kwargs.pop('images', None) or ImagePipeline()
+        # Number of times the model may call tools before it has to answer.
+        self.max_tool_rounds: int = kwargs.pop('max_tool_rounds', 3)
+        super().__init__(*args, **kwargs)
     
 
     def add_system_prompt(self, system_prompt: str) -> None:
         self.system_prompt = system_prompt
-        self.conversation_history.append({
-            "role": "user",
-            "content": self.system_prompt
-        })
 
         
     def response(self, message: discord.Message) -> str:
-        self._add_user_message(message)
-
-        chat_response = self.mistral_client.chat.complete(
-            model = self.model,
-            tools = self.tools.tool_definitions,
-            messages = self.conversation_history,
-            max_tokens = self.max_tokens,
-            temperature = 0.7,
-            safe_prompt = False
-        )
-        if chat_response.choices[0].message.tool_calls:
-            chat_response = self._handle_tool_call(chat_response)
-
-        self._handle_conversation_images()
-
-        self.conversation_history.append({"role": "assistant", "content": chat_response.choices[0].message.content})
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+
+            messages = self.context.fit(session)
+            with timer("model_call", model=self.model):
+                chat_response = self.mistral_client.chat.complete(
+                    model = self.model,
+                    tools = self.tools.tool_definitions,
+                    messages = messages,
+                    max_tokens = self.max_tokens,
+                    temperature = 0.7,
+                    safe_prompt = False
+                )
+            self._record_usage(chat_response.usage)
+            if chat_response.choices[0].message.tool_calls:
+                chat_response = self._handle_tool_call(session, chat_response)
+
+            session.append({"role": "assistant", "content": chat_response.choices[0].message.content})
 
         return chat_response.choices[0].message.content
-    
-
-    def reset_history(self) -> None:
-        self.conversation_history = [{
-            "role": "user",
-            "content": self.system_prompt
-        }]
-    
-
-    def save_history(self, title: str) -> None:
-        os.makedirs("./conversations/", exist_ok=True)
-        file_path = f"./conversations/{title}.json"
-        with open(file_path, "w") as json_file:
-            json.dump(self.conversation_history, json_file, indent=4)
         
         
-    def _add_user_message(self, message: discord.Message) -> None:
-        image_url: str | None = ""
-        if message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    image_url = attachment.url
-                    print(f"Image URL: {attachment.url}")
+    def stream(self, message: discord.Message) -> Iterator[str]:
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+
+            for tool_round in range(self.max_tool_rounds + 1):
+                content = ""
+                tool_calls = []
+                tool_choice = "auto" if tool_round < self.max_tool_rounds else "none"
+                for chunk in self._stream_completion(session, tool_calls, tool_choice=tool_choice):
+                    content += chunk
+                    yield chunk
+
+                if not tool_calls:
+                    break
+                self._run_tool_calls(session, AssistantMessage(content=content, tool_calls=tool_calls))
+
+            session.append({"role": "assistant", "content": content})
+
+
+    def _complete(self, messages: list, max_tokens: int) -> str:
+        with timer("model_call", model=self.model):
+            chat_response = self.mistral_client.chat.complete(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.3,
+                safe_prompt=False
+            )
+        self._record_usage(chat_response.usage)
+        return chat_response.choices[0].message.content
+
 
+    def _add_user_message(self, session: Session, message: discord.Message) -> None:
         message_content = [{
             "type": "text",
             "text": message.content
         },]
-        if image_url:
+        for image in self.images.prepare(message.attachments):
             message_content.append({
                 "type": "image_url",
-                "image_url": image_url
+                "image_url": image.url
             })
-            
-        self.conversation_history.append({
+
+        session.append({
             "role": "user",
             "content": message_content
         })
+        # Older images are dropped once the conversation holds more than the pipeline allows.
+        self.images.limit(session.history)
 
 
-    def _handle_tool_call(self, chat_response):
-        self.conversation_history.append(chat_response.choices[0].message)
-        tool_call = chat_response.choices[0].message.tool_calls[0]
-        function_name = tool_call.function.name
-        function_params = json.loads(tool_call.function.arguments)
-
-        print(f"TOOL CALL:\nFunction Name: {function_name}\nParameters: {function_params}")
-        # Execute the tool
-        function_result = self.tools.names_to_functions[function_name](**function_params)
-        print(f"RESULT: {function_result}")
-
-        # Add the tool response to the conversation
-        self.conversation_history.append({
-            "role": "tool",
-            "name": function_name,
-            "content": str(function_result),
-            "tool_call_id": tool_call.id
-        })
+    def _handle_tool_call(self, session: Session, chat_response):
+        """
+        Run the tools requested by the model and ask it to continue, for up to max_tool_rounds rounds.
 
-        # Re-call the Mistral API to continue the conversation
-        chat_response = self.mistral_client.chat.complete(
-            model=self.model,
-            tools=self.tools.tool_definitions,
-            tool_choice="auto",
-            messages=self.conversation_history,
-            max_tokens=self.max_tokens,
-            temperature=0.7,
-            safe_prompt=False
-        )
+        On the last round the model is no longer offered tools, so it has to answer with the results it has.
+        """
+        for tool_round in range(1, self.max_tool_rounds + 1):
+            self._run_tool_calls(session, chat_response.choices[0].message)
+
+            # Re-call the Mistral API to continue the conversation
+            messages = self.context.fit(session)
+            with timer("model_call", model=self.model):
+                chat_response = self.mistral_client.chat.complete(
+                    model=self.model,
+                    tools=self.tools.tool_definitions,
+                    tool_choice="auto" if tool_round < self.max_tool_rounds else "none",
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=0.7,
+                    safe_prompt=False
+                )
+            self._record_usage(chat_response.usage)
+            if not chat_response.choices[0].message.tool_calls:
+                break
 
         return chat_response
     
 
-    def _handle_conversation_images(self):
-        """
-        Handles images in the conversation history.
-
-        This function ensures that only one image at a time is supported in the conversation. If an image is present
-        in the last message, it is immediately removed from the history.
-        """
-        # TODO: Implement a max image check instead that allows a max_images number of images.
-        
-        if not self.conversation_history:
-            return
-
-        last_message = self.conversation_history[-1]
-        if "content" in last_message and isinstance(last_message["content"], list):            
-            self.conversation_history[-1]["content"] = [item for item in last_message["content"] if item.get("type") != "image_url"]
\ No newline at end of file
+    def _stream_completion(self, session: Session, tool_calls: list, **kwargs) -> Iterator[str]:
+        """Stream a chat completion over the session, yielding text chunks and collecting requested tool calls."""
+        messages = self.context.fit(session)
+        with timer("model_call", model=self.model):
+            events = self.mistral_client.chat.stream(
+                model=self.model,
+                tools=self.tools.tool_definitions,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                temperature=0.7,
+                safe_prompt=False,
+                **kwargs
+            )
+            for event in events:
+                if event.data.usage:
+                    self._record_usage(event.data.usage)
+                delta = event.data.choices[0].delta
+                if delta.tool_calls:
+                    tool_calls.extend(delta.tool_calls)
+                if isinstance(delta.content, str) and delta.content:
+                    yield delta.content
+
+
+    def _record_usage(self, usage) -> None:
+        if usage is not None:
+            record_usage("mistral", usage.prompt_tokens, usage.completion_tokens)
+
+
+    def _initial_history(self) -> list:
+        # The system prompt is sent as a user message for the Mistral vision model.
+        return [{
+            "role": "user",
+            "content": self.system_prompt
+        }]
@@ -0,0 +1,109 @@
+import os
+from typing import Callable
+
+import torch
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+
+class ModelBackend:
+    """
+    One way of loading a causal language model: its precision, quantization and runtime.
+
+    load is called with the model name and the Hugging Face token and returns a model with a transformers-style
+    generate(). Backends whose models cannot take a transformers key/value cache as past_key_values set
+    prefix_cache to False, and the brain then runs without its PrefixCache.
+    """
+    def __init__(self, name: str, load: Callable, description: str, prefix_cache: bool = True) -> None:
+        self.name: str = name
+        self.load: Callable = load
+        self.description: str = description
+        self.prefix_cache: bool = prefix_cache
+
+
+
+MODEL_BACKENDS: dict[str, ModelBackend] = {}
+
+
+def register_backend(name: str, description: str, prefix_cache: bool = True) -> Callable:
+    """Decorator registering a model loading function under name, so it can be selected in config.yaml."""
+    def register(load: Callable) -> Callable:
+        MODEL_BACKENDS[name] = ModelBackend(name, load, description, prefix_cache)
+        return load
+    return register
+
+
+def get_backend(name: str | None) -> ModelBackend:
+    """
+    Return the backend registered under name.
+
+    'auto' (or None) picks bitsandbytes 4-bit quantization when a CUDA GPU is available and bf16 otherwise,
+    since bitsandbytes is built for GPUs.
+    """
+    if name in (None, "auto"):
+        name = "bnb-4bit" if torch.cuda.is_available() else "bf16"
+    if name not in MODEL_BACKENDS:
+        raise ValueError(f"Unknown model backend: {name} (available: auto, {', '.join(MODEL_BACKENDS)})")
+    return MODEL_BACKENDS[name]
+
+
+def model_memory_mb(model) -> float | None:
+    """Memory taken by a model's parameters and buffers, including dynamically quantized weights, in megabytes."""
+    if not isinstance(model, torch.nn.Module):
+        return None
+    # Dynamically quantized layers keep their weights in packed params, which parameters() does not list.
+    tensors = [*model.parameters(), *model.buffers()]
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._packed_params._weight_bias()
+            tensors += [weight] + ([bias] if bias is not None else [])
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / (1024 * 1024)
+
+
+@register_backend("bnb-4bit", "bitsandbytes 4-bit weights with bf16 compute, on GPU")
+def load_bnb_4bit(model_name: str, token: str | None = None):
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=BitsAndBytesConfig(load_in_4bit=True),
+        device_map="auto",
+        torch_dtype=torch.bfloat16,
+        token=token,
+    )
+
+
+@register_backend("bnb-8bit", "bitsandbytes 8-bit weights, on GPU")
+def load_bnb_8bit(model_name: str, token: str | None = None):
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+        device_map="auto",
+        token=token,
+    )
+
+
+@register_backend("int8-dynamic", "PyTorch dynamic int8 quantization of the linear layers, on CPU")
+def load_int8_dynamic(model_name: str, token: str | None = None):
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, token=token)
+    # Weights are stored as int8 and activations quantized on the fly, which roughly halves the memory of
+    # bf16 weights and speeds up the matrix multiplications on CPUs without fast bf16 support.
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+@register_backend("bf16", "bfloat16 weights, on GPU if available")
+def load_bf16(model_name: str, token: str | None = None):
+    return AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", torch_dtype=torch.bfloat16, token=token)
+
+
+@register_backend("fp32", "float32 weights, on GPU if available")
+def load_fp32(model_name: str, token: str | None = None):
+    return AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", torch_dtype=torch.float32, token=token)
+
+
+@register_backend("onnx", "ONNX Runtime through optimum, on CPU", prefix_cache=False)
+def load_onnx(model_name: str, token: str | None = None):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise ImportError("The onnx model backend needs optimum with ONNX Runtime: pip install 'optimum[onnxruntime]'") from e
+    # A transformers checkpoint is exported to ONNX while loading; save the result to skip that next time.
+    exported = os.path.isdir(model_name) and any(name.endswith(".onnx") for name in os.listdir(model_name))
+    return ORTModelForCausalLM.from_pretrained(model_name, export=not exported, use_cache=True, token=token)
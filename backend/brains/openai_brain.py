@@ -1,11 +1,19 @@
-import json
 import os
+from types import SimpleNamespace
+from typing import Iterator
 
 from dotenv import load_dotenv
 from openai import OpenAI
 import discord
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
+from backend.attachments import ImagePipeline
 from backend.brains.brain import Brain
+from backend.metrics import record_usage, timer
+from backend.sessions import Session
 from backend.tools import Tools
 
 load_dotenv()
@@ -17,91 +25,177 @@ class OpenAIAPIBrain(Brain):
         self.model: str = "gpt-4o-mini"
         self.client = OpenAI(api_key=OPENAI_API_KEY)
         
-        self.tools: Tools = kwargs.pop('tools', None)        
-        # if self.tools is None: raise ValueError("Missing required 'tools' argument")
-        
+        # Without tools, the model answers from what it knows.
+        self.tools: Tools | None = kwargs.pop('tools', None)
+
         self.max_tokens: int = 500
-        self.system_prompt: str
-        self.conversation_history: list = []
+        self.images: ImagePipeline = kwargs.pop('images', None) or ImagePipeline()
+        # Number of times the model may call tools before it has to answer.
+        self.max_tool_rounds: int = kwargs.pop('max_tool_rounds', 3)
+        self.encoding = self._load_encoding()
+        super().__init__(*args, **kwargs)
     
 
     def add_system_prompt(self, system_prompt: str) -> None:
         self.system_prompt = system_prompt
-        self.conversation_history.append({
-            "role": "system",
-            "content": self.system_prompt
-        })
 
         
     def response(self, message: discord.Message) -> str:
-        self._add_user_message(message)
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
+            messages = self.context.fit(session)
+
+            with timer("model_call", model=self.model):
+                chat_response = self.client.chat.completions.create(
+                        model = self.model,
+                        messages = messages,
+                        max_tokens = self.max_tokens,
+                        **self._tool_options(),
+                    )
+            self._record_usage(chat_response.usage)
+            if chat_response.choices[0].message.tool_calls:
+                chat_response = self._handle_tool_call(session, chat_response)
+
+            session.append({"role": "assistant", "content": chat_response.choices[0].message.content})
 
-        chat_response = self.client.chat.completions.create(
-                model = self.model,
-                messages = self.conversation_history,
-                max_tokens = self.max_tokens,
-            )
-        
+        return chat_response.choices[0].message.content
 
-        self._handle_conversation_images()
 
-        self.conversation_history.append({"role": "assistant", "content": chat_response.choices[0].message.content})
+    def stream(self, message: discord.Message) -> Iterator[str]:
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self._add_user_message(session, message)
 
-        return chat_response.choices[0].message.content
-    
+            for tool_round in range(self.max_tool_rounds + 1):
+                content = ""
+                tool_calls = []
+                for chunk in self._stream_completion(session, tool_calls, **self._tool_options(tool_round)):
+                    content += chunk
+                    yield chunk
 
-    def reset_history(self) -> None:
-        self.conversation_history = [{
-            "role": "user",
-            "content": self.system_prompt
-        }]
-    
+                if not tool_calls:
+                    break
+                self._run_tool_calls(session, SimpleNamespace(content=content, tool_calls=tool_calls))
+
+            session.append({"role": "assistant", "content": content})
 
-    def save_history(self, title: str) -> None:
-        os.makedirs("./conversations/", exist_ok=True)
-        file_path = f"./conversations/{title}.json"
-        with open(file_path, "w") as json_file:
-            json.dump(self.conversation_history, json_file, indent=4)
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            return super().count_tokens(text)
+        return len(self.encoding.encode(text))
         
         
-    def _add_user_message(self, message: discord.Message) -> None:
-        image_url: str | None = ""
-        if message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    image_url = attachment.url
-                    print(f"Image URL: {attachment.url}")
+    def _complete(self, messages: list, max_tokens: int) -> str:
+        with timer("model_call", model=self.model):
+            chat_response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+            )
+        self._record_usage(chat_response.usage)
+        return chat_response.choices[0].message.content
 
+
+    def _handle_tool_call(self, session: Session, chat_response):
+        """
+        Run the tools requested by the model and ask it to continue, for up to max_tool_rounds rounds.
+
+        On the last round the model is no longer offered tools, so it has to answer with the results it has.
+        """
+        for tool_round in range(1, self.max_tool_rounds + 1):
+            self._run_tool_calls(session, chat_response.choices[0].message)
+
+            messages = self.context.fit(session)
+            with timer("model_call", model=self.model):
+                chat_response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    **self._tool_options(tool_round),
+                )
+            self._record_usage(chat_response.usage)
+            if not chat_response.choices[0].message.tool_calls:
+                break
+
+        return chat_response
+
+
+    def _stream_completion(self, session: Session, tool_calls: list, **kwargs) -> Iterator[str]:
+        """Stream a chat completion over the session, yielding text chunks and collecting requested tool calls."""
+        messages = self.context.fit(session)
+        # Tool calls arrive in fragments, keyed by their index, and are complete once the stream ends.
+        fragments: dict[int, dict] = {}
+        with timer("model_call", model=self.model):
+            chunks = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs
+            )
+            for chunk in chunks:
+                if chunk.usage:
+                    self._record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                for fragment in delta.tool_calls or []:
+                    call = fragments.setdefault(fragment.index, {"id": None, "name": "", "arguments": ""})
+                    call["id"] = fragment.id or call["id"]
+                    if fragment.function is not None:
+                        call["name"] += fragment.function.name or ""
+                        call["arguments"] += fragment.function.arguments or ""
+                if delta.content:
+                    yield delta.content
+
+        tool_calls.extend(
+            SimpleNamespace(id=call["id"], function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+            for _, call in sorted(fragments.items())
+        )
+
+
+    def _tool_options(self, tool_round: int = 0) -> dict:
+        """Offer the tools to the model, except on the last round, when it has to answer."""
+        if self.tools is None:
+            return {}
+        return {
+            "tools": self.tools.tool_definitions,
+            "tool_choice": "auto" if tool_round < self.max_tool_rounds else "none",
+        }
+
+
+    def _record_usage(self, usage) -> None:
+        if usage is not None:
+            record_usage("openai", usage.prompt_tokens, usage.completion_tokens)
+
+
+    def _load_encoding(self):
+        if tiktoken is None:
+            return None
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except (KeyError, ValueError, OSError) as e:
+            print(f"Failed to load tokenizer for {self.model}, falling back to an approximate token count: {e}")
+            return None
+
+
+    def _add_user_message(self, session: Session, message: discord.Message) -> None:
         message_content = [{
             "type": "text",
             "text": message.content
         },]
-        if image_url:
+        for image in self.images.prepare(message.attachments):
             message_content.append({
                 "type": "image_url",
-                "image_url": {
-                    "url": image_url
-                },
+                "image_url": {"url": image.url}
             })
-            
-        self.conversation_history.append({
+
+        session.append({
             "role": "user",
             "content": message_content
         })
-    
-
-    def _handle_conversation_images(self):
-        """
-        Handles images in the conversation history.
-
-        This function ensures that only one image at a time is supported in the conversation. If an image is present
-        in the last message, it is immediately removed from the history.
-        """
-        # TODO: Implement a max image check instead that allows a max_images number of images.
-        
-        if not self.conversation_history:
-            return
-
-        last_message = self.conversation_history[-1]
-        if "content" in last_message and isinstance(last_message["content"], list):            
-            self.conversation_history[-1]["content"] = [item for item in last_message["content"] if item.get("type") != "image_url"]
\ No newline at end of file
+        # Older images are dropped once the conversation holds more than the pipeline allows.
+        self.images.limit(session.history)
@@ -0,0 +1,101 @@
+import copy
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+
+def cache_nbytes(past_key_values) -> int:
+    """Return the memory used by the key/value tensors of a transformers cache."""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        tensors = [tensor for layer in layers for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = list(getattr(past_key_values, "key_cache", [])) + list(getattr(past_key_values, "value_cache", []))
+    return sum(tensor.nelement() * tensor.element_size() for tensor in tensors if tensor is not None and hasattr(tensor, "nelement"))
+
+
+def common_prefix_length(a: list[int], b: list[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+
+class PrefixCache:
+    """
+    Keeps the past key values computed for earlier prompts so generation only prefills new tokens.
+
+    Entries are stored per session (the full prompt and reply of its last turn) and per system prompt (shared
+    by every session of a character). Looking up a prompt returns a copy of the entry with the longest common
+    token prefix, cropped to that prefix. The least recently used entries are evicted once the cached tensors
+    take more than max_bytes.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.max_bytes: int = max_bytes
+        self._entries: OrderedDict[Hashable, tuple[list[int], object, int]] = OrderedDict()
+        self._size: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def lookup(self, keys: list[Hashable], input_ids: list[int]) -> tuple[object | None, int]:
+        """
+        Find the cached prefix of input_ids.
+
+        Args:
+            keys (list): Cache keys to consider, e.g. the session id and the shared system prompt key.
+            input_ids (list[int]): The token ids of the prompt about to be generated.
+
+        Returns:
+            tuple: A private copy of the cache cropped to the matched prefix and the prefix length, or (None, 0).
+        """
+        with self._lock:
+            best_key, best_length = None, 0
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                # At least one prompt token must be left for the model to process.
+                length = min(common_prefix_length(entry[0], input_ids), len(input_ids) - 1)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None:
+                return None, 0
+
+            self._entries.move_to_end(best_key)
+            past_key_values = copy.deepcopy(self._entries[best_key][1])
+
+        excess = past_key_values.get_seq_length() - best_length
+        if excess > 0:
+            past_key_values.crop(-excess)
+        return past_key_values, best_length
+
+
+    def store(self, key: Hashable, token_ids: list[int], past_key_values) -> None:
+        size = cache_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (token_ids, past_key_values, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._discard(key)
+
+
+    def _discard(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
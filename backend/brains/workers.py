@@ -0,0 +1,341 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Hashable, Iterator
+
+if TYPE_CHECKING:
+    from backend.brains.batching import BatchingEngine
+
+
+class WorkerError(RuntimeError):
+    """Raised to callers whose request was lost because its model worker crashed or stopped responding."""
+    pass
+
+
+
+def serve(model_name: str, backend: str, engine_options: dict, num_threads: int, requests, responses) -> None:
+    """
+    Entry point of a model worker process: load the model and answer commands from requests until told to stop.
+
+    Commands are (command, request_id, payload) tuples; replies are (kind, request_id, payload) tuples.
+    Generations run on a pool of max_batch_size threads, so the worker's BatchingEngine can batch concurrent
+    requests while further ones wait for a free thread.
+    """
+    try:
+        import torch
+        from backend.brains.batching import BatchingEngine
+        from backend.brains.huggingface_local_brain import load_model, load_tokenizer
+        from backend.brains.model_backends import get_backend
+        from backend.brains.prefix_cache import PrefixCache
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        prefix_cache_mb = engine_options.get('prefix_cache_mb', 256)
+        draft_model_name = engine_options.get('draft_model_name')
+        engine = BatchingEngine(
+            load_model(model_name, backend),
+            load_tokenizer(model_name),
+            max_batch_size=engine_options.get('max_batch_size', 8),
+            max_wait=engine_options.get('max_wait', 0.01),
+            prefix_cache=PrefixCache(max_bytes=prefix_cache_mb * 1024 * 1024) if prefix_cache_mb and get_backend(backend).prefix_cache else None,
+            assistant_model=load_model(draft_model_name, backend) if draft_model_name else None,
+        )
+    except Exception as e:
+        responses.put(("failed", None, f"{type(e).__name__}: {e}"))
+        return
+    responses.put(("ready", None, os.getpid()))
+
+    generations = ThreadPoolExecutor(max_workers=engine.max_batch_size, thread_name_prefix="generate")
+    while True:
+        command, request_id, payload = requests.get()
+        if command == "stop":
+            break
+        if command == "ping":
+            responses.put(("pong", request_id, None))
+        elif command == "register_prefix":
+            engine.register_prefix(payload)
+        elif command == "forget":
+            engine.forget(payload)
+        elif command == "generate":
+            generations.submit(_generate, engine, responses, request_id, *payload)
+    generations.shutdown(wait=False, cancel_futures=True)
+    engine.stop()
+
+
+def _generate(engine: "BatchingEngine", responses, request_id: int, messages: list, session_id: Hashable | None, generation_kwargs: dict, stream: bool) -> None:
+    try:
+        if stream:
+            for chunk in engine.stream(messages, session_id, **generation_kwargs):
+                responses.put(("chunk", request_id, chunk))
+            responses.put(("done", request_id, None))
+        else:
+            responses.put(("done", request_id, engine.generate(messages, session_id, **generation_kwargs)))
+    except Exception as e:
+        responses.put(("error", request_id, f"{type(e).__name__}: {e}"))
+
+
+
+class ModelWorker:
+    """A model-serving process, its command and reply queues, and the bookkeeping for its health checks."""
+    def __init__(self, index: int) -> None:
+        self.index: int = index
+        self.process: multiprocessing.Process | None = None
+        self.requests = None
+        self.responses = None
+        self.ready: threading.Event = threading.Event()
+        self.started_once: bool = False
+        self.error: str | None = None
+        self.last_pong: float = time.monotonic()
+        self.restarts: int = 0
+        # Restarts since the worker last answered a ping or a request, which set the backoff before the next one.
+        self.failures: int = 0
+        # False while the worker is being restarted and once it was given up on; requests to it fail straight away.
+        self.running: bool = False
+        self.gave_up: bool = False
+
+
+
+class WorkerPool:
+    """
+    Runs generation in separate model worker processes, with the same interface as BatchingEngine.
+
+    The Discord client's process only sends chat messages to the workers and relays their replies, so
+    generation neither competes with the event loop for the GIL nor takes the bot down when it crashes or runs
+    out of memory. Requests of a session always go to the same worker, which keeps its cached turns.
+
+    Each worker is checked every health_interval seconds. One that has exited, or has not answered a ping for
+    health_timeout seconds, is killed and restarted; the requests it was serving fail with WorkerError.
+    Restarts back off exponentially from restart_backoff seconds while the worker keeps failing, and after
+    max_restarts failed restarts in a row it is given up on and the pool is no longer healthy.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        backend: str,
+        workers: int = 1,
+        engine_options: dict | None = None,
+        health_interval: float = 5,
+        health_timeout: float = 30,
+        startup_timeout: float | None = None,
+        max_restarts: int = 5,
+        restart_backoff: float = 1.0,
+        target: Callable = serve,
+    ) -> None:
+        self.model_name: str = model_name
+        self.backend: str = backend
+        self.engine_options: dict = dict(engine_options or {})
+        self.health_interval: float = health_interval
+        self.health_timeout: float = health_timeout
+        self.max_restarts: int = max_restarts
+        self.restart_backoff: float = restart_backoff
+        # The function run by each worker process; see serve().
+        self.target: Callable = target
+        # Split the cores between the workers so their torch thread pools don't oversubscribe the host.
+        self.num_threads: int = max(1, (os.cpu_count() or 1) // workers)
+
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[ModelWorker] = [ModelWorker(index) for index in range(workers)]
+        self._prefixes: list[list] = []
+        self._pending: dict[int, tuple[ModelWorker, queue.Queue]] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._ids = itertools.count()
+        self._stopped: threading.Event = threading.Event()
+
+        for worker in self._workers:
+            self._start(worker)
+            threading.Thread(target=self._relay, args=(worker,), name=f"model-worker-{worker.index}", daemon=True).start()
+        for worker in self._workers:
+            if not worker.ready.wait(startup_timeout) or worker.error:
+                self.stop()
+                raise WorkerError(f"Model worker {worker.index} failed to start: {worker.error or 'timed out'}")
+
+
+    @property
+    def healthy(self) -> bool:
+        """Whether no worker was given up on after failing to restart."""
+        return not any(worker.gave_up for worker in self._workers)
+
+
+    def submit(self, messages: list, session_id: Hashable | None = None, stream: bool = False, **generation_kwargs) -> queue.Queue:
+        """Send a chat to a worker and return the queue its replies arrive on."""
+        request_id = next(self._ids)
+        replies: queue.Queue = queue.Queue()
+        with self._lock:
+            worker = self._pick(session_id)
+            if not worker.running:
+                raise WorkerError(f"Model worker {worker.index} is {'down: ' + worker.error if worker.gave_up else 'restarting'}.")
+            self._pending[request_id] = (worker, replies)
+            worker.requests.put(("generate", request_id, (messages, session_id, generation_kwargs, stream)))
+        return replies
+
+
+    def generate(self, messages: list, session_id: Hashable | None = None, **generation_kwargs) -> str:
+        kind, payload = self.submit(messages, session_id, **generation_kwargs).get()
+        if kind == "error":
+            raise WorkerError(payload)
+        return payload
+
+
+    def stream(self, messages: list, session_id: Hashable | None = None, **generation_kwargs) -> Iterator[str]:
+        replies = self.submit(messages, session_id, stream=True, **generation_kwargs)
+        while True:
+            kind, payload = replies.get()
+            if kind == "chunk":
+                yield payload
+            elif kind == "error":
+                raise WorkerError(payload)
+            else:
+                return
+
+
+    def register_prefix(self, messages: list) -> None:
+        with self._lock:
+            self._prefixes.append(messages)
+            for worker in self._workers:
+                worker.requests.put(("register_prefix", None, messages))
+
+
+    def forget(self, session_id: Hashable) -> None:
+        with self._lock:
+            self._pick(session_id).requests.put(("forget", None, session_id))
+
+
+    def stop(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            for worker in self._workers:
+                if worker.requests is not None:
+                    worker.requests.put(("stop", None, None))
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.kill()
+            self._fail_pending(worker, "The model worker was stopped.")
+
+
+    def _pick(self, session_id: Hashable | None) -> ModelWorker:
+        # Called with the lock held. Sessions are assigned by a hash that is the same in every run and process.
+        if session_id is not None:
+            return self._workers[zlib.crc32(str(session_id).encode()) % len(self._workers)]
+        load = {worker.index: 0 for worker in self._workers if worker.running}
+        if not load:
+            raise WorkerError("No model worker is running.")
+        for worker, _ in self._pending.values():
+            if worker.index in load:
+                load[worker.index] += 1
+        return self._workers[min(load, key=load.get)]
+
+
+    def _start(self, worker: ModelWorker) -> None:
+        # Called with the lock held on restarts. Fresh queues are used, as a killed process may have left the
+        # old ones locked.
+        worker.ready.clear()
+        worker.requests = self._context.Queue()
+        worker.responses = self._context.Queue()
+        worker.process = self._context.Process(
+            target=self.target,
+            args=(self.model_name, self.backend, self.engine_options, self.num_threads, worker.requests, worker.responses),
+            name=f"model-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.running = True
+        worker.last_pong = time.monotonic()
+        for messages in self._prefixes:
+            worker.requests.put(("register_prefix", None, messages))
+
+
+    def _relay(self, worker: ModelWorker) -> None:
+        """Deliver the worker's replies to the waiting callers and restart it when it stops being healthy."""
+        next_check = time.monotonic() + self.health_interval
+        while not self._stopped.is_set():
+            try:
+                kind, request_id, payload = worker.responses.get(timeout=max(0, next_check - time.monotonic()))
+            except queue.Empty:
+                kind = None
+            except (EOFError, OSError):
+                kind = None
+                next_check = 0
+
+            if kind in ("chunk", "done", "error"):
+                worker.failures = 0
+                with self._lock:
+                    pending = self._pending.get(request_id)
+                    if kind != "chunk":
+                        self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending[1].put((kind, payload))
+            elif kind == "pong":
+                worker.last_pong = time.monotonic()
+                worker.failures = 0
+            elif kind == "ready":
+                worker.started_once = True
+                worker.last_pong = time.monotonic()
+                worker.ready.set()
+            elif kind == "failed":
+                worker.error = payload
+                if not worker.started_once:
+                    # A model that cannot be loaded will not load on a retry either.
+                    worker.ready.set()
+                    return
+
+            if time.monotonic() < next_check or self._stopped.is_set():
+                continue
+            next_check = time.monotonic() + self.health_interval
+            if not worker.process.is_alive():
+                problem = worker.error or f"exited with code {worker.process.exitcode}"
+            elif worker.ready.is_set() and time.monotonic() - worker.last_pong > self.health_timeout:
+                problem = "stopped responding"
+            else:
+                if worker.ready.is_set():
+                    worker.requests.put(("ping", None, None))
+                continue
+
+            if not worker.started_once:
+                # A model that cannot be loaded will not load on a retry either.
+                worker.error = problem
+                worker.ready.set()
+                return
+            if not self._restart(worker, problem):
+                return
+
+
+    def _restart(self, worker: ModelWorker, problem: str) -> bool:
+        """Restart the worker after a backoff, or give up on it after max_restarts failures in a row; return whether it was restarted."""
+        with self._lock:
+            worker.running = False
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        self._fail_pending(worker, f"The model worker {problem}.")
+        if worker.failures >= self.max_restarts:
+            worker.error = problem
+            worker.gave_up = True
+            print(f"Model worker {worker.index} {problem} after {worker.failures} restarts in a row, giving up on it.")
+            return False
+
+        # The first restart is immediate; a worker that keeps failing waits twice as long before each further one.
+        delay = min(60.0, self.restart_backoff * 2 ** (worker.failures - 1)) if worker.failures else 0.0
+        print(f"Model worker {worker.index} {problem}, restarting it{f' in {delay:.1f} seconds' if delay else ''}.")
+        if self._stopped.wait(delay):
+            return False
+        with self._lock:
+            worker.error = None
+            worker.failures += 1
+            worker.restarts += 1
+            self._start(worker)
+        return True
+
+
+    def _fail_pending(self, worker: ModelWorker, error: str) -> None:
+        with self._lock:
+            failed = [request_id for request_id, (owner, _) in self._pending.items() if owner is worker]
+            replies = [self._pending.pop(request_id)[1] for request_id in failed]
+        for pending in replies:
+            pending.put(("error", error))
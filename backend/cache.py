@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+
+def normalize_query(text: str) -> str:
+    """Normalize free text so trivially different spellings of the same question share a cache entry."""
+    return " ".join(text.lower().split()).rstrip("?!. ")
+
+
+def cache_key(*parts) -> str:
+    """Build a cache key from JSON-serializable parts; strings are normalized first."""
+    normalized = [normalize_query(part) if isinstance(part, str) else part for part in parts]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+
+
+
+class Cache(ABC):
+    """A key/value cache whose entries expire after ttl seconds and are evicted least recently used first."""
+    def __init__(self, ttl: float | None = 3600, max_entries: int = 1024) -> None:
+        self.ttl: float | None = ttl
+        self.max_entries: int = max_entries
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None:
+        """Return the cached value for key, or None if it is missing or expired."""
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        """Store value under key; ttl overrides the cache's default time to live."""
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+    def _expires(self, ttl: float | None) -> float | None:
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+
+
+class MemoryCache(Cache):
+    def __init__(self, ttl: float | None = 3600, max_entries: int = 1024) -> None:
+        super().__init__(ttl, max_entries)
+        self._entries: OrderedDict[str, tuple[Any, float | None]] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, self._expires(ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+
+class SQLiteCache(Cache):
+    """Cache persisted to a SQLite file, so entries survive restarts. Values must be JSON-serializable."""
+    def __init__(self, path: str = "./cache/cache.sqlite3", ttl: float | None = 3600, max_entries: int = 10000) -> None:
+        super().__init__(ttl, max_entries)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock: threading.Lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, accessed REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+
+    def get(self, key: str) -> Any | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < now:
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), self._expires(ttl), time.time()),
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache")
+
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+
+class RedisCache(Cache):
+    """
+    Cache in a Redis-compatible server (Redis, Valkey, KeyDB...), shared by every bot process that uses it.
+
+    Values must be JSON-serializable. Keys are prefixed so several caches can share a server, and expire through
+    Redis' own TTLs; max_entries is not enforced, configure Redis' maxmemory policy instead. Needs the redis package,
+    unless a client with the same get/set/delete/scan_iter methods is given, e.g. a stand-in for tests.
+    """
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        ttl: float | None = 3600,
+        max_entries: int = 10000,
+        prefix: str = "discobrain:cache:",
+        client=None,
+    ) -> None:
+        super().__init__(ttl, max_entries)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix: str = prefix
+
+
+    def get(self, key: str) -> Any | None:
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+    def clear(self) -> None:
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+
+def create_cache(options: dict | None) -> Cache | None:
+    """
+    Create the cache described by the 'cache' section of config.yaml.
+
+    Args:
+        options (dict): backend ('memory', 'sqlite' or 'redis'), ttl, max_entries, for SQLite path and for Redis url
+            and prefix.
+
+    Returns:
+        Cache: The configured cache, or None if caching is disabled.
+    """
+    if not options or not options.get('enabled', True):
+        return None
+
+    backend = options.get('backend', 'memory')
+    ttl = options.get('ttl', 3600)
+    max_entries = options.get('max_entries', 1024)
+    if backend == 'memory':
+        return MemoryCache(ttl=ttl, max_entries=max_entries)
+    if backend == 'sqlite':
+        return SQLiteCache(options.get('path', './cache/cache.sqlite3'), ttl=ttl, max_entries=max_entries)
+    if backend == 'redis':
+        return RedisCache(
+            options.get('url', 'redis://localhost:6379/0'),
+            ttl=ttl,
+            max_entries=max_entries,
+            prefix=options.get('prefix', 'discobrain:cache:'),
+        )
+    raise ValueError(f"Unknown cache backend: {backend}")
@@ -0,0 +1,132 @@
+from typing import Callable
+
+from backend.metrics import timer
+from backend.sessions import Session
+
+# Rough per-message overhead of chat templates (role markers, separators).
+MESSAGE_OVERHEAD_TOKENS: int = 4
+
+SUMMARY_INSTRUCTIONS: str = (
+    "Summarize the conversation below in a few sentences. Keep names, facts, preferences and open questions "
+    "that may matter later. Reply with the summary only."
+)
+
+
+def approximate_token_count(text: str) -> int:
+    """Estimate the number of tokens in text when no tokenizer is available (about four characters per token)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def message_text(message) -> str:
+    """Return the text of a chat message, whether it is a dict or an SDK message object."""
+    content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+
+def message_role(message) -> str:
+    return message.get("role", "") if isinstance(message, dict) else getattr(message, "role", "")
+
+
+def summary_prompt(summary: str, turns: list) -> list:
+    """Build the messages asking a model to fold turns into the running summary."""
+    transcript = "\n".join(f"{message_role(turn)}: {message_text(turn)}" for turn in turns if message_text(turn))
+    if summary:
+        transcript = f"Summary so far: {summary}\n\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": transcript},
+    ]
+
+
+
+class ContextWindow:
+    """
+    Keeps the prompt of a session within a token budget.
+
+    The first pinned messages (the system prompt) and the newest turns are sent as they are. When the history
+    grows past max_tokens, the oldest turns are removed from the session and folded into a running summary,
+    which is stored on the session and sent along with the system prompt. Turns are folded until the history
+    is back under low_water * max_tokens, so the summarizer only runs once every few turns.
+
+    If recall is given, it is called with the session and returns remembered texts relevant to the newest turn,
+    which are sent with the system prompt as well and count towards the budget.
+    """
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        summarize: Callable[[str, list], str],
+        max_tokens: int = 3000,
+        summary_tokens: int = 200,
+        low_water: float = 0.75,
+        pinned: int = 1,
+        recall: Callable[[Session], list[str]] | None = None,
+    ) -> None:
+        self.count_tokens: Callable[[str], int] = count_tokens
+        self.summarize: Callable[[str, list], str] = summarize
+        self.max_tokens: int = max_tokens
+        self.summary_tokens: int = summary_tokens
+        self.low_water: float = low_water
+        self.pinned: int = pinned
+        self.recall: Callable[[Session], list[str]] | None = recall
+
+
+    def fit(self, session: Session) -> list:
+        """
+        Trim the session history to the token budget and return the messages to send to the model.
+
+        Args:
+            session (Session): The session to fit; its history and summary are updated in place.
+
+        Returns:
+            list: The pinned messages (including the summary and recalled memories), followed by the retained turns.
+        """
+        memories = []
+        if self.recall is not None:
+            try:
+                memories = self.recall(session)
+            except Exception as e:
+                print(f"Failed to recall memories: {e}")
+
+        with timer("prompt_build"):
+            history = session.history
+            counts = [self._count(message) for message in history]
+            total = sum(counts) + self.count_tokens(session.summary) + sum(self.count_tokens(memory) for memory in memories)
+
+            if total > self.max_tokens:
+                target = int(self.max_tokens * self.low_water)
+                folded = []
+                # Always keep the newest message, and never separate tool results from the call that produced them.
+                while len(history) > self.pinned + 1 and (total > target or message_role(history[self.pinned]) == "tool"):
+                    folded.append(history.pop(self.pinned))
+                    total -= counts.pop(self.pinned)
+
+                if folded:
+                    try:
+                        with timer("summarize"):
+                            session.summary = self.summarize(session.summary, folded)
+                    except Exception as e:
+                        print(f"Failed to summarize conversation, dropping {len(folded)} messages: {e}")
+
+            return self._with_summary(session, memories)
+
+
+    def _with_summary(self, session: Session, memories: list[str] | None = None) -> list:
+        pinned = session.history[:self.pinned]
+        if (session.summary or memories) and pinned:
+            system_message = dict(pinned[-1])
+            content = message_text(system_message)
+            if session.summary:
+                content += f"\n\nSummary of the earlier conversation: {session.summary}"
+            if memories:
+                content += "\n\nEarlier messages in this channel that may be relevant:\n" + "\n".join(memories)
+            system_message["content"] = content
+            pinned = pinned[:-1] + [system_message]
+        return pinned + session.history[self.pinned:]
+
+
+    def _count(self, message) -> int:
+        return self.count_tokens(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
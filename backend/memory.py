@@ -0,0 +1,317 @@
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+from backend.context import message_role, message_text
+from backend.metrics import timer
+
+DEFAULT_EMBEDDER: str = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class HashingEmbedder:
+    """
+    Embeds text as a normalized bag of hashed words and word pairs.
+
+    Needs nothing but NumPy and matches on shared words only, so it stands in for a real embedding model when
+    sentence-transformers is not installed.
+    """
+    def __init__(self, dimensions: int = 1024) -> None:
+        self.name: str = f"hashing-{dimensions}"
+        self.dimensions: int = dimensions
+
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                # crc32 rather than hash(), which is salted per process and would break persisted indexes.
+                vectors[row, zlib.crc32(feature.encode()) % self.dimensions] += 1
+        return _normalize(vectors)
+
+
+
+class SentenceTransformerEmbedder:
+    """Embeds text with a small sentence-transformers model on the CPU."""
+    def __init__(self, model_name: str = DEFAULT_EMBEDDER) -> None:
+        from sentence_transformers import SentenceTransformer
+
+        self.name: str = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dimensions: int = self.model.get_sentence_embedding_dimension()
+
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+
+def create_embedder(name: str = DEFAULT_EMBEDDER) -> HashingEmbedder | SentenceTransformerEmbedder:
+    """Load the named sentence-transformers model, or the hashing embedder for 'hashing' or if it cannot be loaded."""
+    if name != "hashing":
+        try:
+            return SentenceTransformerEmbedder(name)
+        except ImportError:
+            print("sentence-transformers is not installed, falling back to hashed word embeddings for memory.")
+        except Exception as e:
+            print(f"Failed to load embedding model {name}, falling back to hashed word embeddings for memory: {e}")
+    return HashingEmbedder()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+
+class ChannelIndex:
+    """The remembered texts of one channel and their embeddings, searched by cosine similarity."""
+    def __init__(self, dimensions: int, texts: list[str] | None = None, vectors: np.ndarray | None = None) -> None:
+        self.texts: list[str] = texts or []
+        self.vectors: np.ndarray = vectors if vectors is not None else np.zeros((0, dimensions), dtype=np.float32)
+        self.dirty: bool = False
+        # Built on first search with FAISS installed, and rebuilt after the index changes.
+        self._faiss_index = None
+
+
+    def add(self, texts: list[str], vectors: np.ndarray, max_entries: int) -> None:
+        self.texts += texts
+        self.vectors = np.concatenate([self.vectors, vectors])
+        if len(self.texts) > max_entries:
+            # Forget the oldest memories first.
+            self.texts = self.texts[-max_entries:]
+            self.vectors = self.vectors[-max_entries:]
+        self.dirty = True
+        self._faiss_index = None
+
+
+    def search(self, vector: np.ndarray, k: int) -> list[tuple[float, str]]:
+        if not self.texts:
+            return []
+        k = min(k, len(self.texts))
+        if faiss is not None:
+            if self._faiss_index is None:
+                self._faiss_index = faiss.IndexFlatIP(self.vectors.shape[1])
+                self._faiss_index.add(self.vectors)
+            scores, rows = self._faiss_index.search(vector[None, :], k)
+            return [(float(score), self.texts[row]) for score, row in zip(scores[0], rows[0]) if row >= 0]
+
+        scores = self.vectors @ vector
+        rows = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[row]), self.texts[row]) for row in sorted(rows, key=lambda row: -scores[row])]
+
+
+
+class SemanticMemory:
+    """
+    Long-term memory of what was said in each channel, recalled by meaning rather than recency.
+
+    Every user and assistant turn is embedded and added to the index of its channel (or thread). The turns
+    are embedded in batches by a background thread, so replies never wait for the embedding model, and each
+    index is saved under path every flush_interval seconds. Before a reply, recall() embeds the newest user
+    message and returns the top_k most similar past turns scoring at least min_score, which the brain adds to
+    the prompt. Turns keep being recalled after they are summarized away, the history is reset or the bot
+    restarts, while the prompt itself stays short.
+    """
+    def __init__(
+        self,
+        path: str = "./memory",
+        embedder: HashingEmbedder | SentenceTransformerEmbedder | None = None,
+        top_k: int = 3,
+        min_score: float = 0.3,
+        max_entries: int = 10000,
+        max_chars: int = 500,
+        flush_interval: float = 5.0,
+        batch_size: int = 64,
+    ) -> None:
+        self.path: str = path
+        self.embedder: HashingEmbedder | SentenceTransformerEmbedder = embedder or HashingEmbedder()
+        self.top_k: int = top_k
+        self.min_score: float = min_score
+        self.max_entries: int = max_entries
+        # Longer turns are cut to this many characters before they are stored.
+        self.max_chars: int = max_chars
+        self.flush_interval: float = flush_interval
+        self.batch_size: int = batch_size
+        os.makedirs(path, exist_ok=True)
+
+        self._indexes: dict[str, ChannelIndex] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._pending: queue.Queue = queue.Queue()
+        self._worker: threading.Thread = threading.Thread(target=self._run, name="semantic-memory", daemon=True)
+        self._worker.start()
+
+
+    def remember(self, channel: str, message) -> None:
+        """Queue a chat message to be embedded and added to the channel's memory; other roles are ignored."""
+        if message_role(message) in ("user", "assistant") and message_text(message).strip():
+            self._pending.put((channel, self.memory_text(message)))
+
+
+    def recall(self, channel: str, query: str, exclude: set[str] | None = None) -> list[str]:
+        """
+        Return the remembered turns of a channel most relevant to query, best first.
+
+        Args:
+            channel (str): The channel whose memory is searched.
+            query (str): Text to match, usually the newest user message.
+            exclude (set): Remembered texts to leave out, e.g. turns that are still in the prompt.
+        """
+        if not query.strip():
+            return []
+        index = self._index(channel)
+        with timer("memory_recall"):
+            vector = self.embedder.embed([query])[0]
+            with self._lock:
+                # Ask for extra results so excluded ones can be skipped.
+                results = index.search(vector, self.top_k + len(exclude or ()))
+        return [text for score, text in results if score >= self.min_score and text not in (exclude or ())][:self.top_k]
+
+
+    def memory_text(self, message) -> str:
+        """The text under which a chat message is remembered, to match it against recalled turns."""
+        return f"{message_role(message)}: {message_text(message).strip()[:self.max_chars]}"
+
+
+    def flush(self) -> None:
+        """Block until every queued turn is embedded and every changed index is saved."""
+        done = threading.Event()
+        self._pending.put(done)
+        done.wait()
+
+
+    def close(self) -> None:
+        if not self._worker.is_alive():
+            return
+        self.flush()
+        self._pending.put(None)
+        self._worker.join()
+
+
+    def _index(self, channel: str) -> ChannelIndex:
+        with self._lock:
+            index = self._indexes.get(channel)
+        if index is not None:
+            return index
+        # Loading may re-embed the whole channel, so it runs without the lock to keep other channels answering.
+        # Should two threads load the same channel, the index stored first is used by both.
+        index = self._load(channel)
+        with self._lock:
+            return self._indexes.setdefault(channel, index)
+
+
+    def _file(self, channel: str) -> str:
+        return os.path.join(self.path, re.sub(r"[^\w.-]", "_", channel) + ".npz")
+
+
+    def _load(self, channel: str) -> ChannelIndex:
+        try:
+            with np.load(self._file(channel)) as data:
+                texts = [str(text) for text in data["texts"]]
+                vectors = data["vectors"].astype(np.float32)
+                embedder = str(data["embedder"])
+        except FileNotFoundError:
+            return ChannelIndex(self.embedder.dimensions)
+        except Exception as e:
+            print(f"Failed to load the memory of channel {channel}, starting afresh: {e}")
+            return ChannelIndex(self.embedder.dimensions)
+
+        if embedder != self.embedder.name and texts:
+            # Indexes built with another embedding model are embedded again rather than thrown away.
+            print(f"Re-embedding {len(texts)} memories of channel {channel} with {self.embedder.name}...")
+            index = ChannelIndex(self.embedder.dimensions)
+            index.add(texts, self.embedder.embed(texts), self.max_entries)
+            return index
+        return ChannelIndex(self.embedder.dimensions, texts, vectors)
+
+
+    def _save(self, channel: str, index: ChannelIndex) -> None:
+        with self._lock:
+            texts = np.array(index.texts, dtype=str)
+            vectors = index.vectors
+            index.dirty = False
+        path = self._file(channel)
+        # Write to a temporary file first, so a crash while saving never leaves a truncated index behind.
+        with open(f"{path}.tmp", "wb") as file:
+            np.savez(file, texts=texts, vectors=vectors, embedder=np.array(self.embedder.name))
+        os.replace(f"{path}.tmp", path)
+
+
+    def _run(self) -> None:
+        saved_at = time.monotonic()
+        while True:
+            try:
+                batch = [self._pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            # Embed everything already queued together, which is much faster than one turn at a time.
+            while batch and len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            turns = [item for item in batch if isinstance(item, tuple)]
+            if turns:
+                try:
+                    with timer("memory_embed", turns=len(turns)):
+                        vectors = self.embedder.embed([text for _, text in turns])
+                    by_channel: dict[str, list[int]] = {}
+                    for row, (channel, _) in enumerate(turns):
+                        by_channel.setdefault(channel, []).append(row)
+                    for channel, rows in by_channel.items():
+                        index = self._index(channel)
+                        with self._lock:
+                            index.add([turns[row][1] for row in rows], vectors[rows], self.max_entries)
+                except Exception as e:
+                    print(f"Failed to remember {len(turns)} turns: {e}")
+
+            waiting = any(not isinstance(item, tuple) for item in batch)
+            if waiting or time.monotonic() - saved_at >= self.flush_interval:
+                with self._lock:
+                    dirty = [(channel, index) for channel, index in self._indexes.items() if index.dirty]
+                for channel, index in dirty:
+                    try:
+                        self._save(channel, index)
+                    except OSError as e:
+                        print(f"Failed to save the memory of channel {channel}: {e}")
+                saved_at = time.monotonic()
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if batch and batch[-1] is None:
+                return
+
+
+
+def create_memory(options: dict | None) -> SemanticMemory | None:
+    """
+    Create the semantic memory described by the 'memory' section of config.yaml.
+
+    Args:
+        options (dict): enabled, path, embedder (a sentence-transformers model or 'hashing'), top_k, min_score,
+            max_entries (per channel) and flush_interval.
+
+    Returns:
+        SemanticMemory: The memory, or None if it is disabled.
+    """
+    if not options or not options.get('enabled', False):
+        return None
+    return SemanticMemory(
+        options.get('path', "./memory"),
+        embedder=create_embedder(options.get('embedder', DEFAULT_EMBEDDER)),
+        top_k=options.get('top_k', 3),
+        min_score=options.get('min_score', 0.3),
+        max_entries=options.get('max_entries', 10000),
+        flush_interval=options.get('flush_interval', 5.0),
+    )
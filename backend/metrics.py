@@ -0,0 +1,283 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+
+class Metric:
+    """A named metric with one value (or set of values) per combination of label values."""
+    kind: str = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] | list[str] = ()) -> None:
+        self.name: str = name
+        self.help: str = help
+        self.labelnames: tuple[str, ...] = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines += self._render_value(dict(zip(self.labelnames, key)), value)
+        return lines
+
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+    def _render_value(self, labels: dict, value) -> list[str]:
+        return [f"{self.name}{_format_labels(labels)} {_format_value(value)}"]
+
+
+
+class Counter(Metric):
+    kind: str = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+
+class Gauge(Metric):
+    kind: str = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, as Prometheus histograms do, and keeps their sum."""
+    kind: str = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] | list[str] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+
+    def _render_value(self, labels: dict, value) -> list[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float("inf")), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+
+class MetricsRegistry:
+    """Holds the process's metrics and renders them in the Prometheus text exposition format."""
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] | list[str] = ()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] | list[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help, labelnames)
+
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] | list[str] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+    def _register(self, metric_class: type, name: str, help: str, labelnames, **kwargs) -> Metric:
+        # Registering a name twice returns the existing metric, so modules can declare the metrics they use.
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, help, labelnames, **kwargs)
+            metric = self._metrics[name]
+        if not isinstance(metric, metric_class):
+            raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+        return metric
+
+
+
+REGISTRY: MetricsRegistry = MetricsRegistry()
+
+STAGE_SECONDS: Histogram = REGISTRY.histogram(
+    "discobrain_stage_seconds", "Time spent in each stage of answering a message.", ["stage"]
+)
+STAGE_ERRORS: Counter = REGISTRY.counter("discobrain_stage_errors_total", "Stages that ended with an error.", ["stage"])
+MESSAGES: Counter = REGISTRY.counter("discobrain_messages_total", "Messages received, by scheduler outcome.", ["status"])
+QUEUE_DEPTH: Gauge = REGISTRY.gauge("discobrain_queue_depth", "Messages waiting to be answered.")
+TOKENS: Counter = REGISTRY.counter("discobrain_tokens_total", "Prompt and completion tokens, by brain.", ["brain", "kind"])
+CACHE_REQUESTS: Counter = REGISTRY.counter("discobrain_cache_requests_total", "Cache lookups, by cache and result.", ["cache", "result"])
+DRAFT_TOKENS: Counter = REGISTRY.counter(
+    "discobrain_draft_tokens_total", "Tokens proposed by the draft model in assisted decoding, by whether they were accepted.", ["result"]
+)
+BACKEND_REQUESTS: Counter = REGISTRY.counter(
+    "discobrain_backend_requests_total", "Requests sent to the brains behind a fallback brain, by outcome.", ["backend", "outcome"]
+)
+
+_json_logs: bool = False
+
+
+@contextmanager
+def timer(stage: str, **fields) -> Iterator[None]:
+    """
+    Time the enclosed block as one stage of the pipeline.
+
+    The duration is recorded in discobrain_stage_seconds and, if it raises, the stage is counted in
+    discobrain_stage_errors_total. With JSON logs enabled, fields are added to the stage's log line.
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, error=error, **fields)
+
+
+def observe(stage: str, seconds: float, error: str | None = None, **fields) -> None:
+    """Record a stage whose duration was measured elsewhere, e.g. the time a message spent queued."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if error is not None:
+        STAGE_ERRORS.inc(stage=stage)
+    log_event("stage", stage=stage, seconds=round(seconds, 6), error=error, **fields)
+
+
+def record_usage(brain: str, prompt_tokens: int | None, completion_tokens: int | None) -> None:
+    TOKENS.inc(prompt_tokens or 0, brain=brain, kind="prompt")
+    TOKENS.inc(completion_tokens or 0, brain=brain, kind="completion")
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_draft(proposed: int, accepted: int) -> None:
+    DRAFT_TOKENS.inc(accepted, result="accepted")
+    DRAFT_TOKENS.inc(proposed - accepted, result="rejected")
+
+
+def draft_acceptance_rate() -> float | None:
+    """Share of draft tokens accepted by the main model so far, or None if assisted decoding was not used."""
+    accepted = DRAFT_TOKENS.value(result="accepted")
+    proposed = accepted + DRAFT_TOKENS.value(result="rejected")
+    return accepted / proposed if proposed else None
+
+
+def log_event(event: str, **fields) -> None:
+    """Print a structured JSON log line, if JSON logs are enabled."""
+    if _json_logs:
+        print(json.dumps({"time": time.time(), "event": event, **fields}, default=str), flush=True)
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format: str, *args) -> None:
+        # Scrapes are frequent; don't print a line for each.
+        pass
+
+
+
+def start_server(host: str = "127.0.0.1", port: int = 9108) -> ThreadingHTTPServer:
+    """Serve the metrics at http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def configure(options: dict | None) -> ThreadingHTTPServer | None:
+    """
+    Apply the 'metrics' section of config.yaml.
+
+    Args:
+        options (dict): enabled, host and port of the metrics endpoint, and json_logs.
+
+    Returns:
+        ThreadingHTTPServer: The metrics server, or None if the endpoint is disabled.
+    """
+    global _json_logs
+    options = options or {}
+    _json_logs = bool(options.get('json_logs', False))
+    if not options.get('enabled', False):
+        return None
+    server = start_server(options.get('host', "127.0.0.1"), options.get('port', 9108))
+    print(f"Serving metrics on http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from backend.context import message_role, message_text
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    session_key TEXT NOT NULL,
+    persona TEXT NOT NULL,
+    title TEXT UNIQUE,
+    preview TEXT,
+    turns INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation_id, id);
+"""
+
+# Values of SQLite's synchronous pragma, which cannot be passed as a query parameter.
+SYNCHRONOUS_MODES: tuple[str, ...] = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class ConversationStore:
+    """
+    Persists conversations turn by turn in a SQLite database in WAL mode.
+
+    Each turn is appended as it happens, so a crash loses at most the last flush_interval seconds of turns
+    instead of everything since the last !save. Writes are queued and committed by a background thread in
+    batches of up to batch_size statements, which amortizes the fsync over many turns and keeps disk I/O off
+    the threads generating replies. Saving a conversation under a title only records the title in the index.
+    """
+    def __init__(
+        self,
+        path: str = "./conversations/conversations.sqlite3",
+        flush_interval: float = 1.0,
+        batch_size: int = 256,
+        synchronous: str = "NORMAL",
+    ) -> None:
+        self.path: str = path
+        self.flush_interval: float = flush_interval
+        self.batch_size: int = batch_size
+        synchronous = str(synchronous).upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid persistence.synchronous: {synchronous}, expected one of {', '.join(SYNCHRONOUS_MODES)}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock: threading.Lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL only syncs at checkpoints: a power loss may drop the last commits, never corrupt the file.
+            self._connection.execute(f"PRAGMA synchronous={synchronous}")
+            self._connection.executescript(SCHEMA)
+
+        self._writes: queue.Queue = queue.Queue()
+        self._writer: threading.Thread = threading.Thread(target=self._write, name="conversation-store", daemon=True)
+        self._writer.start()
+
+
+    def start_conversation(self, session_key, persona: str = "") -> str:
+        """Open a new conversation for a session and return its id."""
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        self._writes.put((
+            "INSERT INTO conversations (id, session_key, persona, created, updated) VALUES (?, ?, ?, ?, ?)",
+            (conversation_id, str(session_key), persona, now, now),
+        ))
+        return conversation_id
+
+
+    def append(self, conversation_id: str, message) -> None:
+        """Queue a message to be appended to a conversation; it is serialized right away, so later edits don't leak in."""
+        now = time.time()
+        preview = message_text(message)[:100] if message_role(message) == "user" else None
+        self._writes.put(("INSERT INTO turns (conversation_id, message, created) VALUES (?, ?, ?)", (conversation_id, json.dumps(message, default=str), now)))
+        self._writes.put((
+            "UPDATE conversations SET turns = turns + 1, updated = ?, preview = COALESCE(preview, ?) WHERE id = ?",
+            (now, preview, conversation_id),
+        ))
+
+
+    def name(self, conversation_id: str, title: str) -> None:
+        """Save a conversation under title; a conversation previously saved under the same title loses it."""
+        self._writes.put(("UPDATE conversations SET title = NULL WHERE title = ? AND id != ?", (title, conversation_id)))
+        self._writes.put(("UPDATE conversations SET title = ?, updated = ? WHERE id = ?", (title, time.time(), conversation_id)))
+        self.flush()
+
+
+    def list(self, page: int = 1, per_page: int = 10) -> tuple[list[dict], int]:
+        """
+        List saved (titled) conversations, most recently updated first.
+
+        Returns:
+            tuple: The conversations on the page, as dicts of their index entry, and the number of pages.
+        """
+        self.flush()
+        with self._lock:
+            total = self._connection.execute("SELECT COUNT(*) FROM conversations WHERE title IS NOT NULL").fetchone()[0]
+            rows = self._connection.execute(
+                "SELECT id, title, persona, preview, turns, created, updated FROM conversations WHERE title IS NOT NULL "
+                "ORDER BY updated DESC LIMIT ? OFFSET ?",
+                (per_page, (max(page, 1) - 1) * per_page),
+            ).fetchall()
+        columns = ("id", "title", "persona", "preview", "turns", "created", "updated")
+        return [dict(zip(columns, row)) for row in rows], max(1, math.ceil(total / per_page))
+
+
+    def find(self, title: str) -> str | None:
+        """Return the id of the conversation saved under title, if any."""
+        self.flush()
+        with self._lock:
+            row = self._connection.execute("SELECT id FROM conversations WHERE title = ?", (title,)).fetchone()
+        return row[0] if row else None
+
+
+    def load(self, conversation_id: str, limit: int | None = 100) -> list:
+        """Read the last limit turns of a conversation (all of them if limit is None), oldest first."""
+        self.flush()
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT message FROM turns WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, -1 if limit is None else limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+
+    def flush(self) -> None:
+        """Block until every queued write is committed."""
+        done = threading.Event()
+        self._writes.put(done)
+        done.wait()
+
+
+    def close(self) -> None:
+        self.flush()
+        self._writes.put(None)
+        self._writer.join()
+        with self._lock:
+            self._connection.close()
+
+
+    def _write(self) -> None:
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Collect writes until the batch is full, the interval is over or a caller waits for a flush.
+            while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self._writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            statements = [item for item in batch if isinstance(item, tuple)]
+            if statements:
+                try:
+                    with self._lock, self._connection:
+                        for statement, params in statements:
+                            self._connection.execute(statement, params)
+                except sqlite3.Error as e:
+                    print(f"Failed to persist {len(statements)} conversation writes: {e}")
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if batch[-1] is None:
+                return
+
+
+
+def create_store(options: dict | None) -> ConversationStore | None:
+    """
+    Create the conversation store described by the 'persistence' section of config.yaml.
+
+    Args:
+        options (dict): enabled, path, flush_interval, batch_size and synchronous (SQLite's synchronous pragma).
+
+    Returns:
+        ConversationStore: The store, or None if conversations are not persisted.
+    """
+    if not options or not options.get('enabled', True):
+        return None
+    return ConversationStore(
+        options.get('path', "./conversations/conversations.sqlite3"),
+        flush_interval=options.get('flush_interval', 1.0),
+        batch_size=options.get('batch_size', 256),
+        synchronous=options.get('synchronous', "NORMAL"),
+    )
@@ -0,0 +1,131 @@
+import html
+import math
+import re
+from collections import Counter
+from typing import Callable
+from urllib.parse import urlsplit
+
+from backend.context import approximate_token_count
+
+# Fields of a result that are kept besides its title, URL and snippets, e.g. the length of a video.
+DETAIL_FIELDS: tuple[str, ...] = ("age", "duration", "views")
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def clean_snippet(text: str | None) -> str:
+    """Strip the highlighting tags and HTML entities search engines put in snippets."""
+    return " ".join(html.unescape(re.sub(r"<[^>]+>", "", text or "")).split())
+
+
+def normalize_url(url: str | None) -> str:
+    """Reduce a URL to what identifies the page, so mirrors like http/https or www variants compare equal."""
+    parts = urlsplit(url or "")
+    host = parts.netloc.lower().removeprefix("www.")
+    return f"{host}{parts.path.rstrip('/')}{'?' + parts.query if parts.query else ''}"
+
+
+
+class BM25:
+    """Okapi BM25 scores of a small set of documents, e.g. the snippets of one search, against a query."""
+    def __init__(self, documents: list[list[str]], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1: float = k1
+        self.b: float = b
+        self.documents: list[Counter] = [Counter(document) for document in documents]
+        self.lengths: list[int] = [len(document) for document in documents]
+        self.average_length: float = sum(self.lengths) / len(documents) if documents else 0.0
+        frequencies = Counter(term for document in self.documents for term in document)
+        self.idf: dict[str, float] = {
+            term: math.log(1 + (len(documents) - count + 0.5) / (count + 0.5)) for term, count in frequencies.items()
+        }
+
+
+    def scores(self, query: list[str]) -> list[float]:
+        scores = []
+        for document, length in zip(self.documents, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+            scores.append(sum(
+                self.idf[term] * document[term] * (self.k1 + 1) / (document[term] + norm)
+                for term in set(query) if term in document
+            ))
+        return scores
+
+
+
+def compact_results(
+    query: str,
+    results: list[dict],
+    max_tokens: int = 800,
+    max_snippets: int = 3,
+    count_tokens: Callable[[str], int] = approximate_token_count,
+) -> list[dict]:
+    """
+    Reduce search results to the parts most relevant to query, within about max_tokens tokens.
+
+    Results pointing at the same page and snippets repeated across results are dropped. The description and
+    extra snippets of every result are ranked against the query with BM25, and the best snippets are kept, at
+    most max_snippets per result, while they fit in the budget. Results keep the search engine's order.
+
+    Args:
+        query (str): The search query the snippets are ranked against.
+        results (list): Results with a title, url, description, extra_snippets and optional detail fields.
+        max_tokens (int): Budget for the kept results, as counted by count_tokens.
+        max_snippets (int): Most snippets kept per result.
+
+    Returns:
+        list: The kept results, each with its title, url, details and a list of snippets, best first.
+    """
+    pages = []
+    seen_urls = set()
+    seen_snippets = set()
+    snippets = []  # (page, position, text)
+    for result in results:
+        url = normalize_url(result.get("url"))
+        if url and url in seen_urls:
+            continue
+        seen_urls.add(url)
+        page = {"title": clean_snippet(result.get("title")), "url": result.get("url")}
+        page.update({field: result[field] for field in DETAIL_FIELDS if result.get(field) is not None})
+        page["snippets"] = []
+        for text in [result.get("description"), *(result.get("extra_snippets") or [])]:
+            text = clean_snippet(text)
+            if text and text.lower() not in seen_snippets:
+                seen_snippets.add(text.lower())
+                snippets.append((len(pages), len(snippets), text))
+        pages.append(page)
+
+    scores = BM25([tokenize(text) for _, _, text in snippets]).scores(tokenize(query))
+    # The best snippets first; ties go to the higher ranked result.
+    ranked = sorted(zip(scores, snippets), key=lambda item: (-item[0], item[1][0], item[1][1]))
+
+    used = 0
+    kept: set[int] = set()
+    for _, (index, _, text) in ranked:
+        page = pages[index]
+        if len(page["snippets"]) >= max_snippets:
+            continue
+        cost = count_tokens(text) + (0 if index in kept else _page_tokens(page, count_tokens))
+        if used + cost > max_tokens:
+            continue
+        page["snippets"].append(text)
+        kept.add(index)
+        used += cost
+    # Results without any snippet are still worth a title and a link if there is room.
+    for index, page in enumerate(pages):
+        if index not in kept and used + _page_tokens(page, count_tokens) <= max_tokens:
+            kept.add(index)
+            used += _page_tokens(page, count_tokens)
+
+    compacted = []
+    for index in sorted(kept):
+        page = pages[index]
+        if not page["snippets"]:
+            del page["snippets"]
+        compacted.append(page)
+    return compacted
+
+
+def _page_tokens(page: dict, count_tokens: Callable[[str], int]) -> int:
+    return count_tokens(" ".join(str(value) for key, value in page.items() if key != "snippets"))
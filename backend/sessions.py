@@ -0,0 +1,169 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from backend.attachments import strip_inline_images
+from backend.cache import Cache
+
+
+class Session:
+    def __init__(self, session_id: Hashable, history: list, on_append: Callable[["Session", object], None] | None = None) -> None:
+        self.session_id: Hashable = session_id
+        self.history: list = history
+        # Running summary of the turns that no longer fit in the context window.
+        self.summary: str = ""
+        self.last_active: float = time.monotonic()
+        # Held while a response is generated so turns within one session never interleave.
+        self.lock: threading.RLock = threading.RLock()
+        # Called with every appended message, e.g. to persist it; conversation_id is the persisted conversation.
+        self.on_append: Callable[[Session, object], None] | None = on_append
+        self.conversation_id: str | None = None
+        # Version of the state last saved to or loaded from a shared store, to tell when another process changed it.
+        self.version: str | None = None
+
+
+    def append(self, message) -> None:
+        self.history.append(message)
+        self.touch()
+        if self.on_append is not None:
+            self.on_append(self, message)
+
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+
+
+class SessionManager:
+    """
+    Keeps one conversation history per session id (a Discord channel or thread id).
+
+    At most max_sessions histories are held in memory; the least recently used session is evicted when the
+    limit is exceeded, and sessions that have been idle for longer than idle_timeout seconds are dropped.
+
+    With a shared store (e.g. a SQLiteCache or RedisCache used by several bot processes), the state of each
+    session is saved to it after every turn under the namespace, and get() reloads a session whenever another
+    process has saved a newer version. A conversation then carries on wherever its next message is handled,
+    e.g. after its guild moved to another shard. The store is also where sessions are picked up after a restart.
+    Inline images are saved as placeholders, as they would make every save and reload as large as the images.
+    """
+    def __init__(
+        self,
+        initial_history: Callable[[], list],
+        max_sessions: int = 100,
+        idle_timeout: float = 3600.0,
+        on_append: Callable[[Session, object], None] | None = None,
+        store: Cache | None = None,
+        namespace: str = "",
+    ) -> None:
+        self.initial_history: Callable[[], list] = initial_history
+        self.on_append: Callable[[Session, object], None] | None = on_append
+        self.max_sessions: int = max_sessions
+        self.idle_timeout: float = idle_timeout
+        self.store: Cache | None = store
+        self.namespace: str = namespace
+        self._sessions: OrderedDict[Hashable, Session] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def get(self, session_id: Hashable) -> Session:
+        """Return the session for session_id, creating it from initial_history if needed."""
+        with self._lock:
+            self._expire_idle()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self.initial_history(), self.on_append)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+                session.touch()
+        if self.store is not None:
+            self._refresh(session)
+        return session
+
+
+    def save(self, session_id: Hashable) -> None:
+        """Save a session's state to the shared store, if there is one, so other processes can continue it."""
+        if self.store is None:
+            return
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            return
+        with session.lock:
+            session.version = uuid.uuid4().hex
+            state = {
+                "history": [strip_inline_images(message) for message in session.history],
+                "summary": session.summary,
+                "conversation_id": session.conversation_id,
+                "version": session.version,
+            }
+        try:
+            self.store.set(self._key(session_id), state, ttl=self.idle_timeout)
+        except Exception as e:
+            print(f"Failed to save session {session_id} to the shared store: {e}")
+
+
+    def reset(self, session_id: Hashable) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.store is not None:
+            try:
+                self.store.delete(self._key(session_id))
+            except Exception as e:
+                print(f"Failed to delete session {session_id} from the shared store: {e}")
+
+
+    def __contains__(self, session_id: Hashable) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+
+    def _key(self, session_id: Hashable) -> str:
+        return f"session:{self.namespace}:{session_id}"
+
+
+    def _refresh(self, session: Session) -> None:
+        try:
+            state = self.store.get(self._key(session.session_id))
+        except Exception as e:
+            # The local copy is still usable, it just may miss turns handled elsewhere.
+            print(f"Failed to read session {session.session_id} from the shared store: {e}")
+            return
+        if state is None:
+            if session.version is not None:
+                # Reset (or expired) since this process last saw it.
+                with session.lock:
+                    session.history[:] = self.initial_history()
+                    session.summary = ""
+                    session.conversation_id = None
+                    session.version = None
+            return
+        if state["version"] == session.version:
+            return
+        with session.lock:
+            session.history[:] = state["history"]
+            session.summary = state["summary"]
+            session.conversation_id = state["conversation_id"]
+            session.version = state["version"]
+
+
+    def _expire_idle(self) -> None:
+        if self.idle_timeout is None:
+            return
+        deadline = time.monotonic() - self.idle_timeout
+        # Sessions are ordered by last use, so expired ones are always at the front.
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_active >= deadline:
+                break
+            del self._sessions[session_id]
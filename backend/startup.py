@@ -0,0 +1,41 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class StartupTimer:
+    """
+    Records how long each step of starting the bot takes.
+
+    Stages (stage()) are timed individually and may run on any thread; milestones (mark()) record the time
+    elapsed since start, e.g. when the gateway connection is up or the brain is ready.
+    """
+    def __init__(self, start: float | None = None) -> None:
+        self.start: float = time.perf_counter() if start is None else start
+        self.stages: list[tuple[str, float]] = []
+        self.milestones: list[tuple[str, float]] = []
+        self._lock: threading.Lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append((name, time.perf_counter() - started))
+
+
+    def mark(self, name: str) -> None:
+        with self._lock:
+            self.milestones.append((name, time.perf_counter() - self.start))
+
+
+    def report(self) -> str:
+        with self._lock:
+            lines = ["Startup time breakdown:"]
+            lines += [f"  {name:<24}{duration:8.2f}s" for name, duration in self.stages]
+            lines += [f"  {name + ' after':<24}{elapsed:8.2f}s" for name, elapsed in self.milestones]
+        return "\n".join(lines)
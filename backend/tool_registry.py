@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import importlib
+import inspect
+import json
+import re
+import threading
+import time
+import types
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Literal
+
+from backend.metrics import STAGE_ERRORS, timer
+
+# JSON schema types of the Python types tool parameters may have.
+JSON_TYPES: dict[type, str] = {str: "string", int: "integer", float: "number", bool: "boolean", dict: "object"}
+
+
+def tool(function: Callable | None = None, *, name: str | None = None, description: str | None = None) -> Callable:
+    """
+    Decorator declaring a function or method as a tool the model may call.
+
+    The tool's schema is generated from the type hints of its parameters and from its docstring: the first
+    paragraph describes the tool and the Args section describes each parameter. name and description override
+    the function's name and the docstring's first paragraph.
+    """
+    def declare(function: Callable) -> Callable:
+        function.__tool__ = {"name": name or function.__name__, "description": description}
+        return function
+    return declare(function) if function is not None else declare
+
+
+def tool_result_text(result: Any) -> str:
+    """Serialize a tool result for the conversation as compact JSON, which takes far fewer tokens than its repr."""
+    if isinstance(result, str):
+        return result
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def json_schema(annotation) -> dict:
+    """Return the JSON schema of a parameter type, e.g. str, list[int], Literal['a', 'b'] or float | None."""
+    origin = typing.get_origin(annotation)
+    arguments = typing.get_args(annotation)
+    if origin in (typing.Union, types.UnionType):
+        # Optional parameters are described by their type; None is implied by leaving them out.
+        options = [argument for argument in arguments if argument is not type(None)]
+        if len(options) == 1:
+            return json_schema(options[0])
+        return {"anyOf": [json_schema(option) for option in options]}
+    if origin is Literal:
+        return {"type": JSON_TYPES[type(arguments[0])], "enum": list(arguments)}
+    if origin in (list, tuple, set) or annotation in (list, tuple, set):
+        return {"type": "array", "items": json_schema(arguments[0])} if arguments else {"type": "array"}
+    if origin is dict:
+        return {"type": "object"}
+    if annotation in JSON_TYPES:
+        return {"type": JSON_TYPES[annotation]}
+    raise TypeError(f"Unsupported type for a tool parameter: {annotation}")
+
+
+def _parse_docstring(docstring: str | None) -> tuple[str, dict[str, str]]:
+    """Split a Google-style docstring into its first paragraph and the descriptions of its Args."""
+    docstring = inspect.cleandoc(docstring or "")
+    summary = " ".join(docstring.split("\n\n")[0].split())
+    arguments: dict[str, str] = {}
+    section = re.search(r"^Args:\n((?:[ \t]+.*\n?|\n)*)", docstring, re.MULTILINE)
+    if section:
+        current = None
+        for line in section.group(1).splitlines():
+            match = re.match(r"\s{0,8}(\w+)\s*(?:\([^)]*\))?:\s*(.*)", line)
+            if match and (current is None or len(line) - len(line.lstrip()) <= 4):
+                current = match.group(1)
+                arguments[current] = match.group(2).strip()
+            elif current is not None and line.strip():
+                # Descriptions may continue on further, more indented lines.
+                arguments[current] += " " + line.strip()
+    return summary, arguments
+
+
+
+class ToolSpec:
+    """A tool: the function that runs it and the definition sent to the model, generated once on first use."""
+    def __init__(self, function: Callable, name: str | None = None, description: str | None = None) -> None:
+        declared = getattr(function, "__tool__", {})
+        self.function: Callable = function
+        self.name: str = name or declared.get("name") or function.__name__
+        self.description: str | None = description or declared.get("description")
+        self.is_async: bool = inspect.iscoroutinefunction(function)
+
+
+    @functools.cached_property
+    def definition(self) -> dict:
+        """The tool in the function-calling format shared by OpenAI and Mistral."""
+        summary, descriptions = _parse_docstring(self.function.__doc__)
+        hints = typing.get_type_hints(self.function)
+        properties = {}
+        required = []
+        for parameter in inspect.signature(self.function).parameters.values():
+            if parameter.name == "self" or parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+                continue
+            schema = json_schema(hints.get(parameter.name, str))
+            if parameter.name in descriptions:
+                schema["description"] = descriptions[parameter.name]
+            properties[parameter.name] = schema
+            if parameter.default is parameter.empty:
+                required.append(parameter.name)
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description or summary,
+                "parameters": {"type": "object", "properties": properties, "required": required},
+            },
+        }
+
+
+
+class ToolRegistry:
+    """
+    The tools the models may call, by name, and where their calls run.
+
+    Tools are registered as functions or bound methods declared with @tool, or lazily as 'module:function'
+    paths, which are imported the first time the tools are needed rather than when the bot starts. Their
+    definitions are generated once and the same list is returned for every request. Synchronous tools run in a
+    shared thread pool and coroutine functions on a shared event loop thread; every call gets call_timeout
+    seconds before its result is replaced by an error.
+    """
+    def __init__(self, call_timeout: float = 20, max_workers: int = 8) -> None:
+        self.call_timeout: float = call_timeout
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._tools: dict[str, ToolSpec] = {}
+        self._lazy: list[str] = []
+        self._definitions: list[dict] | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def register(self, function: Callable, name: str | None = None, description: str | None = None) -> ToolSpec:
+        spec = ToolSpec(function, name, description)
+        with self._lock:
+            self._tools[spec.name] = spec
+            self._definitions = None
+        return spec
+
+
+    def register_lazy(self, path: str) -> None:
+        """Register the tool at path ('package.module:function'), importing it only once tools are needed."""
+        with self._lock:
+            self._lazy.append(path)
+            self._definitions = None
+
+
+    @property
+    def definitions(self) -> list[dict]:
+        """Definitions of every registered tool, to be passed to the model as its tools."""
+        self._load()
+        with self._lock:
+            if self._definitions is None:
+                self._definitions = [spec.definition for spec in self._tools.values()]
+            return self._definitions
+
+
+    def get(self, name: str) -> ToolSpec | None:
+        self._load()
+        return self._tools.get(name)
+
+
+    def call(self, function_name: str, arguments: str | dict) -> Any:
+        """
+        Execute a tool by name.
+
+        Args:
+            function_name (str): The name of the tool, as declared in its definition.
+            arguments (str | dict): The tool arguments, either as a dict or as the JSON string sent by the model.
+
+        Returns:
+            Any: The tool result, or a dictionary with an "error" key if the call failed or timed out.
+        """
+        return self.call_many([(function_name, arguments)])[0]
+
+
+    def call_many(self, calls: list[tuple[str, str | dict]]) -> list[Any]:
+        """
+        Execute several tool calls concurrently and return their results in order.
+
+        Each call gets call_timeout seconds; a call that takes longer is reported as an error instead of
+        holding up the others.
+        """
+        futures = [self._submit(function_name, arguments) for function_name, arguments in calls]
+        deadline = time.monotonic() + self.call_timeout
+        results = []
+        for (function_name, _), future in zip(calls, futures):
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except FutureTimeoutError:
+                # Coroutines are cancelled; threads cannot be, so a slow synchronous tool finishes in the background.
+                future.cancel()
+                results.append({"error": f"The tool {function_name} timed out."})
+            except Exception as e:
+                results.append({"error": f"The tool {function_name} failed: {e}"})
+        return results
+
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+    def _load(self) -> None:
+        with self._lock:
+            paths, self._lazy = self._lazy, []
+        for path in paths:
+            module_name, _, attribute = path.partition(":")
+            try:
+                function = getattr(importlib.import_module(module_name), attribute)
+            except (ImportError, AttributeError) as e:
+                print(f"Failed to load tool {path}: {e}")
+                continue
+            self.register(function)
+
+
+    def _submit(self, function_name: str, arguments: str | dict) -> Future:
+        spec = self.get(function_name)
+        if spec is None:
+            return _done({"error": f"Unknown tool: {function_name}"})
+        try:
+            function_params = json.loads(arguments) if isinstance(arguments, str) else arguments
+        except ValueError as e:
+            return _done({"error": f"Invalid arguments for {function_name}: {e}"})
+        try:
+            # Checked before the call, so a TypeError raised by the tool itself is reported as a failure of the tool.
+            inspect.signature(spec.function).bind(**function_params)
+        except TypeError as e:
+            return _done({"error": f"Invalid arguments for {function_name}: {e}"})
+        if spec.is_async:
+            return asyncio.run_coroutine_threadsafe(self._run_async(spec, function_params), self._get_loop())
+        return self.executor.submit(self._run, spec, function_params)
+
+
+    def _run(self, spec: ToolSpec, function_params: dict) -> Any:
+        with timer("tool", tool=spec.name):
+            result = spec.function(**function_params)
+        return _checked(result)
+
+
+    async def _run_async(self, spec: ToolSpec, function_params: dict) -> Any:
+        with timer("tool", tool=spec.name):
+            result = await spec.function(**function_params)
+        return _checked(result)
+
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="tool-loop", daemon=True).start()
+            return self._loop
+
+
+def _done(result: Any) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _checked(result: Any) -> Any:
+    # Tools report failures as an "error" entry rather than raising.
+    if isinstance(result, dict) and "error" in result:
+        STAGE_ERRORS.inc(stage="tool")
+    return result
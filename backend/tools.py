@@ -1,105 +1,123 @@
 import os
 import requests
-from typing import Dict, Any
-import functools
-import json
+from typing import Any
 
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from backend.cache import Cache, cache_key
+from backend.metrics import record_cache
+from backend.search_results import compact_results
+from backend.tool_registry import ToolRegistry, tool
 
 # Load environment variables
 load_dotenv()
 BRAVE_API_KEY = os.getenv('BRAVE_SEARCH_API_KEY')
+# Overridable so benchmarks can point the tool at a local stub server.
+BRAVE_SEARCH_URL = os.getenv('BRAVE_SEARCH_URL', 'https://api.search.brave.com/res/v1')
 
-
-class Tools:
-    def __init__(self) -> None:
-        self.tool_definitions = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search_the_web",
-                    "description": "Perform a web search using a search engine API and return results.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {"type": "string", "description": "The space-separated search query."},
-                            "video": {"type": "boolean", "description": "Whether to return only videos (true) or all types of results (false)."},
-                        },
-                        "required": ["query", "video"],
-                    },
-                },
-            },
-        ]
-
-        self.names_to_functions = {
-            'search_the_web': functools.partial(self.search_the_web),
-        }
+# Responses worth retrying: rate limiting and transient server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 
+class Tools:
+    def __init__(
+        self,
+        cache: Cache | None = None,
+        timeout: float = 10,
+        retries: int = 2,
+        backoff_factor: float = 0.3,
+        call_timeout: float = 20,
+        max_workers: int = 8,
+        extra_tools: list[str] | None = None,
+        result_tokens: int = 800,
+        snippets_per_result: int = 3,
+    ) -> None:
+        # Optional cache for search results, keyed on the normalized query, the video flag and the result budget.
+        self.cache: Cache | None = cache
+        self.timeout: float = timeout
+        self.retries: int = retries
+        self.backoff_factor: float = backoff_factor
+        # Search results are cut down to the snippets most relevant to the query, within result_tokens tokens, as
+        # tool results are sent again with every later turn of the conversation.
+        self.result_tokens: int = result_tokens
+        self.snippets_per_result: int = snippets_per_result
+        # Tools declared with @tool on this class, and further tools as 'module:function' paths, imported on first use.
+        # Each call may take call_timeout seconds before its result is replaced by an error.
+        self.registry: ToolRegistry = ToolRegistry(call_timeout=call_timeout, max_workers=max_workers)
+        for function in vars(type(self)).values():
+            if hasattr(function, "__tool__"):
+                self.registry.register(getattr(self, function.__name__))
+        for path in extra_tools or []:
+            self.registry.register_lazy(path)
+
+        # Connections are pooled and kept alive, so only the first search pays for the TCP and TLS handshakes.
+        self.session: requests.Session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=("GET",),
+                respect_retry_after_header=True,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    @property
+    def tool_definitions(self) -> list[dict]:
+        """Definitions of the available tools in the function-calling format, generated once."""
+        return self.registry.definitions
+
+
+    def call(self, function_name: str, arguments: str | dict) -> Any:
+        """Execute a tool by name; see ToolRegistry.call."""
+        return self.registry.call(function_name, arguments)
+
+
+    def call_many(self, calls: list[tuple[str, str | dict]]) -> list[Any]:
+        """Execute several tool calls concurrently and return their results in order; see ToolRegistry.call_many."""
+        return self.registry.call_many(calls)
+
+
+    @tool
     def search_the_web(self, query: str, video: bool = False) -> dict:
         """
-        Perform a web or video search using the Brave Search API and return results.
+        Perform a web search using a search engine API and return results.
 
         Args:
-            query (str): The search query.
-            video (bool): If True, perform a video search; otherwise, perform a web search.
+            query (str): The space-separated search query.
+            video (bool): Whether to return only videos (true) or all types of results (false).
 
         Returns:
-            dict: A dictionary containing the search query, results, and total number of results.
+            dict: A dictionary containing the search query and the results most relevant to it.
         """
 
         if not BRAVE_API_KEY:
             return {"error": "Brave Search API key not found in environment variables."}
 
-        # Define the Brave Search API endpoint
-        api_endpoint = "https://api.search.brave.com/res/v1/videos/search" if video else "https://api.search.brave.com/res/v1/web/search"
-        headers = {
-            "Accept": "application/json",
-            "Accept-Encoding": "gzip",
-            "X-Subscription-Token": BRAVE_API_KEY
-        }
-        params = {
-            "q": query,
-            "count": 5,
-            "safesearch": "moderate"
-        }
-        if not video:
-            params["extra_snippets"] = True
+        key = cache_key("search_the_web", query, bool(video), self.result_tokens, self.snippets_per_result)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            record_cache("search", cached is not None)
+            if cached is not None:
+                return cached
+
+        api_endpoint, headers, params = self._search_request(query, video)
 
         try:
-            response = requests.get(api_endpoint, headers=headers, params=params, timeout=10)
+            response = self.session.get(api_endpoint, headers=headers, params=params, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
 
-            # Extract and format the search results
-            results = []
-            if video:
-                for item in data.get('results', []):
-                    result = {
-                        "title": item.get('title'),
-                        "description": item.get('description'),
-                        "url": item.get('url'),
-                        "age": item.get('age'),
-                        "duration": item.get('video', {}).get('duration'),
-                        "views": item.get('video', {}).get('views'),
-                    }
-                    results.append(result)
-            else:
-                for item in data.get('web', {}).get('results', []):
-                    result = {
-                        "title": item.get('title'),
-                        "description": item.get('description'),
-                        "url": item.get('url'),
-                        "age": item.get('age'),
-                        "extra_snippets": item.get('extra_snippets')
-                    }
-                    results.append(result)
-
-            return {
-                "query": query,
-                "results": results,
-                "total_results": len(results)
-            }
+            result = self._parse_search_results(query, video, data)
+            if self.cache is not None:
+                self.cache.set(key, result)
+            return result
 
         except requests.exceptions.HTTPError as http_err:
             return {"error": f"HTTP error occurred: {http_err}"}
@@ -111,11 +129,65 @@ class Tools:
             return {"error": f"An error occurred: {req_err}"}
         except ValueError:
             return {"error": "Failed to parse JSON response from Brave Search API."}
-        
+
+
+    def close(self) -> None:
+        self.registry.close()
+        self.session.close()
+
+
+    def _search_request(self, query: str, video: bool) -> tuple[str, dict, dict]:
+        # Define the Brave Search API endpoint
+        api_endpoint = f"{BRAVE_SEARCH_URL}/videos/search" if video else f"{BRAVE_SEARCH_URL}/web/search"
+        headers = {
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+            "X-Subscription-Token": BRAVE_API_KEY
+        }
+        params = {
+            "q": query,
+            "count": 5,
+            "safesearch": "moderate"
+        }
+        if not video:
+            params["extra_snippets"] = True
+        return api_endpoint, headers, params
+
+
+    def _parse_search_results(self, query: str, video: bool, data: dict) -> dict:
+        # Extract and format the search results
+        results = []
+        if video:
+            for item in data.get('results', []):
+                result = {
+                    "title": item.get('title'),
+                    "description": item.get('description'),
+                    "url": item.get('url'),
+                    "age": item.get('age'),
+                    "duration": item.get('video', {}).get('duration'),
+                    "views": item.get('video', {}).get('views'),
+                }
+                results.append(result)
+        else:
+            for item in data.get('web', {}).get('results', []):
+                result = {
+                    "title": item.get('title'),
+                    "description": item.get('description'),
+                    "url": item.get('url'),
+                    "age": item.get('age'),
+                    "extra_snippets": item.get('extra_snippets')
+                }
+                results.append(result)
+
+        return {
+            "query": query,
+            "results": compact_results(query, results, self.result_tokens, self.snippets_per_result),
+        }
+
 
 
 if __name__ == "__main__":
     # This is used for development purposes
     tools = Tools()
     result = tools.search_the_web("Paris", video=False)
-    print(f"\n{result}")
\ No newline at end of file
+    print(f"\n{result}")
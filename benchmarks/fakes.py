@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import itertools
+import time
+from types import SimpleNamespace
+
+# The message the current task is answering, so the replies it sends can be attributed to it.
+answering: contextvars.ContextVar = contextvars.ContextVar("answering", default=None)
+
+_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str = "", bot: bool = False) -> None:
+        self.id: int = user_id
+        self.name: str = name or f"user{user_id}"
+        self.bot: bool = bot
+        self.guild_permissions = SimpleNamespace(manage_messages=True)
+
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int) -> None:
+        self.id: int = guild_id
+
+
+
+class FakeMessage:
+    """Stands in for discord.Message: records when it was created and when the bot replied to it."""
+    def __init__(self, content: str, author: FakeUser, channel: "FakeChannel", attachments: list | None = None) -> None:
+        self.id: int = next(_ids)
+        self.content: str = content
+        self.author: FakeUser = author
+        self.channel: FakeChannel = channel
+        self.guild: FakeGuild = channel.guild
+        self.attachments: list = attachments or []
+        self.created: float = time.perf_counter()
+        # Set on the user's message: when the first and the latest reply (or edit of it) was sent.
+        self.first_reply: float | None = None
+        self.last_reply: float | None = None
+        # Set on the bot's replies: the message they answer.
+        self.answers: FakeMessage | None = None
+
+
+    async def reply(self, content: str, **kwargs) -> "FakeMessage":
+        return await self.channel.send(content, **kwargs)
+
+
+    async def edit(self, content: str | None = None, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.channel.latency)
+        if content is not None:
+            self.content = content
+        if self.answers is not None:
+            self.answers.last_reply = time.perf_counter()
+        self.channel.edits += 1
+        return self
+
+
+
+class _Typing:
+    async def __aenter__(self) -> None:
+        pass
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+
+class FakeChannel:
+    """Stands in for a discord text channel; sending and editing take latency seconds, like a call to Discord's API."""
+    bot_user: FakeUser = FakeUser(0, "discobrain", bot=True)
+
+    def __init__(self, channel_id: int, guild: FakeGuild, latency: float = 0.0) -> None:
+        self.id: int = channel_id
+        self.guild: FakeGuild = guild
+        self.latency: float = latency
+        self.sent: list[FakeMessage] = []
+        self.edits: int = 0
+
+
+    def typing(self) -> _Typing:
+        return _Typing()
+
+
+    async def send(self, content: str, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(content, self.bot_user, self)
+        message.answers = answering.get()
+        if message.answers is not None:
+            now = time.perf_counter()
+            message.answers.first_reply = message.answers.first_reply or now
+            message.answers.last_reply = now
+        self.sent.append(message)
+        return message
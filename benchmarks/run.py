@@ -0,0 +1,313 @@
+"""
+Replay message traffic through DiscordHandler against local stub backends and report latency, throughput and memory.
+
+Examples:
+    python -m benchmarks.run --brain openai mistral --messages 200 --channels 20
+    python -m benchmarks.run --brain mistral --stream --search-ratio 0.3
+    python -m benchmarks.run --brain huggingface --hf-model ./tiny-model --messages 40
+    python -m benchmarks.run --brain huggingface --hf-model ./model --hf-draft-model ./draft-model --concurrency 1
+    python -m benchmarks.run --brain huggingface --hf-model ./model --hf-backend fp32 bf16 int8-dynamic onnx
+    python -m benchmarks.run --brain openai --trace traffic.jsonl
+    python -m benchmarks.run --brain fallback --latency 0.5
+
+A trace is a JSONL file with one message per line: {"at": seconds after start, "channel": id, "author": id,
+"content": text}. Without one, synthetic traffic is generated. Each configuration runs in its own process so
+memory figures are not mixed up.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser, answering
+from benchmarks.stubs import StubBackends
+
+BRAINS = {
+    "openai": "backend.brains.openai_brain.OpenAIAPIBrain",
+    "mistral": "backend.brains.mistral_vision_api_brain.MistralVisionAPIBrain",
+    "huggingface": "backend.brains.huggingface_local_brain.HuggingfaceModelLoader",
+    # Hedges requests between the OpenAI and Mistral brains.
+    "fallback": "backend.brains.fallback_brain.FallbackBrain",
+}
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Nearest-rank percentile of values, with q between 0 and 100."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_traffic(args: argparse.Namespace) -> list[dict]:
+    """Messages from args.users users spread over args.channels channels, arriving at args.rate per second (0: all at once)."""
+    generator = random.Random(args.seed)
+    traffic = []
+    at = 0.0
+    for i in range(args.messages):
+        if args.rate:
+            at += generator.expovariate(args.rate)
+        searching = generator.random() < args.search_ratio
+        traffic.append({
+            "at": at,
+            "channel": generator.randrange(args.channels) + 1,
+            "author": generator.randrange(args.users) + 1,
+            "content": f"Can you search for fact number {i}?" if searching else f"Tell me something interesting, number {i}.",
+        })
+    return traffic
+
+
+async def run_configuration(args: argparse.Namespace) -> dict:
+    stubs = StubBackends(args.latency, args.token_latency, args.reply_tokens, args.search_latency)
+    base_url = await stubs.start()
+
+    # The backend modules read these when they are imported, so they are set first.
+    os.environ.update({
+        "DISCORD_TOKEN": "benchmark",
+        "DISCORD_GUILD_ID": "1",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "API_KEY": "benchmark",
+        "MISTRAL_SERVER_URL": base_url,
+        "BRAVE_SEARCH_API_KEY": "benchmark",
+        "BRAVE_SEARCH_URL": f"{base_url}/res/v1",
+    })
+    if args.hf_model:
+        os.environ["HUGGINGFACE_MODEL_NAME"] = args.hf_model
+    if args.hf_draft_model:
+        os.environ["HUGGINGFACE_DRAFT_MODEL_NAME"] = args.hf_draft_model
+
+    from discobrain import brain_options, load_class, load_config
+    from backend.brains.model_backends import model_memory_mb
+    from backend.metrics import TOKENS, draft_acceptance_rate
+    from backend.characters.einstein import Einstein
+    from backend.tools import Tools
+    from frontend.discord_handler import DiscordHandler
+
+    config = load_config(args.config)
+    brain_class = load_class(BRAINS[args.brain])
+
+    def options(brain_class: type) -> dict:
+        scoped = brain_options(config.get('brain'), brain_class)
+        if args.concurrency:
+            scoped['max_workers'] = args.concurrency
+        if args.brain == "huggingface" and args.hf_backend:
+            scoped['model_backend'] = args.hf_backend
+        return scoped
+
+    scheduler_options = dict(config.get('scheduler') or {}) if args.rate_limits else {
+        'user_rate': 1e9, 'user_burst': 1e9, 'guild_rate': 1e9, 'guild_burst': 1e9, 'max_queue': 1e9, 'max_channel_queue': 1e9,
+    }
+    scheduler_options['coalesce_window'] = args.coalesce_window
+    delivery_options = dict(config.get('delivery') or {}) if args.rate_limits else {'rate': 1e9, 'per': 1.0}
+    if args.concurrency:
+        scheduler_options['max_concurrency'] = args.concurrency
+
+    character = Einstein()
+    tools = Tools(**(config.get('tools') or {}))
+    loaded_at = time.perf_counter()
+    if args.brain == "fallback":
+        backends = [load_class(BRAINS[name]) for name in ("openai", "mistral")]
+        brain = brain_class(backends=[backend(tools=tools, **options(backend)) for backend in backends], **options(brain_class))
+    else:
+        brain = brain_class(tools=tools, **options(brain_class))
+    brain.add_system_prompt(character.system_prompt())
+    load_seconds = time.perf_counter() - loaded_at
+    model_mb = model_memory_mb(getattr(brain, "model", None))
+    handler = DiscordHandler(brain, character, False, args.stream, scheduler_options, delivery_options=delivery_options)
+    rss_before = peak_rss_mb()
+
+    # Wrap the scheduler's handler to tell which message each reply answers and when answering finished.
+    answered: list[FakeMessage] = []
+    failed: list[FakeMessage] = []
+    queued = 0
+    finished = asyncio.Event()
+    respond = handler.scheduler.handler
+
+    async def measured(message) -> None:
+        # Coalesced messages are answered together and measured from the last of them.
+        latest = getattr(message, "messages", [message])[-1]
+        answering.set(latest)
+        try:
+            await respond(message)
+            answered.append(latest)
+        except Exception:
+            failed.append(latest)
+            raise
+        finally:
+            if len(answered) + len(failed) >= queued and sent_all:
+                finished.set()
+    handler.scheduler.handler = measured
+
+    traffic = load_trace(args.trace) if args.trace else synthetic_traffic(args)
+    guild = FakeGuild(1)
+    channels: dict[int, FakeChannel] = {}
+    statuses: dict[str, int] = {}
+    sent_all = False
+    started = time.perf_counter()
+    for item in traffic:
+        delay = started + item["at"] - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        channel = channels.setdefault(item["channel"], FakeChannel(item["channel"], guild, args.discord_latency))
+        message = FakeMessage(item["content"], FakeUser(item["author"]), channel)
+        status = await handler.handle_message(message)
+        statuses[status] = statuses.get(status, 0) + 1
+        queued += status == "queued"
+    sent_all = True
+    if len(answered) + len(failed) < queued:
+        try:
+            await asyncio.wait_for(finished.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out with {queued - len(answered) - len(failed)} messages unanswered.", file=sys.stderr)
+    # Replies are sent in the background, so answering can finish before the last of them reaches the channel.
+    try:
+        await asyncio.wait_for(handler.delivery.join(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"Timed out with {handler.delivery.backlog} replies undelivered.", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    await handler.scheduler.stop()
+    tools.close()
+    brain.shutdown()
+    await stubs.stop()
+
+    acceptance = draft_acceptance_rate()
+    metered = ("openai", "mistral") if args.brain == "fallback" else (args.brain,)
+    completion_tokens = sum(TOKENS.value(brain=name, kind="completion") for name in metered)
+    latencies = [message.last_reply - message.created for message in answered if message.last_reply]
+    first_reply = [message.first_reply - message.created for message in answered if message.first_reply]
+    return {
+        "configuration": f"{args.brain}{f' {args.hf_backend}' if args.hf_backend else ''}{' assisted' if args.hf_draft_model else ''}{' stream' if args.stream else ''}",
+        "messages": len(traffic),
+        "statuses": statuses,
+        "answered": len(answered),
+        "failed": len(failed),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(answered) / elapsed, 2) if elapsed else None,
+        # Tokens generated per second of wall time, over every concurrent reply; unknown for model workers.
+        "tokens_per_second": round(completion_tokens / elapsed, 1) if elapsed and completion_tokens else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "first_reply_p50": percentile(first_reply, 50),
+        "first_reply_p99": percentile(first_reply, 99),
+        "backend_requests": stubs.requests,
+        "draft_acceptance": None if acceptance is None else round(acceptance, 3),
+        "load_seconds": round(load_seconds, 3),
+        "rss_after_load_mb": round(rss_before, 1),
+        "model_mb": None if model_mb is None else round(model_mb, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def format_report(results: list[dict]) -> str:
+    def seconds(value: float | None) -> str:
+        return "-" if value is None else f"{value:.3f}s"
+
+    header = (
+        f"{'configuration':<28}{'answered':>10}{'rejected':>10}{'msg/s':>9}{'tok/s':>9}{'p50':>9}{'p99':>9}"
+        f"{'first p50':>11}{'first p99':>11}{'model':>11}{'peak RSS':>11}"
+    )
+    lines = [header, "-" * len(header)]
+    for result in results:
+        rejected = result["messages"] - result["answered"] - result["statuses"].get("coalesced", 0) - result["failed"]
+        model = "-" if result["model_mb"] is None else f"{result['model_mb']:.1f} MB"
+        lines.append(
+            f"{result['configuration']:<28}{result['answered']:>10}{rejected:>10}{result['throughput'] or 0:>9.2f}"
+            f"{result['tokens_per_second'] or 0:>9.1f}{seconds(result['latency_p50']):>9}{seconds(result['latency_p99']):>9}"
+            f"{seconds(result['first_reply_p50']):>11}{seconds(result['first_reply_p99']):>11}{model:>11}{result['peak_rss_mb']:>8.1f} MB"
+        )
+    for result in results:
+        if result.get("draft_acceptance") is not None:
+            lines.append(f"{result['configuration']}: {result['draft_acceptance']:.1%} of draft tokens accepted")
+    return "\n".join(lines)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--brain', nargs='+', choices=sorted(BRAINS), default=["openai"])
+    parser.add_argument('--stream', action='store_true', help="Stream replies and edit them in place.")
+    parser.add_argument('--config', default='config.yaml', help="Brain, tool and scheduler settings.")
+    parser.add_argument('--trace', help="JSONL file of recorded messages to replay.")
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=20, help="Messages per second (0 sends them all at once).")
+    parser.add_argument('--search-ratio', type=float, default=0.0, help="Share of messages asking for a web search.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, help="Replies generated at the same time (default: the brain's).")
+    parser.add_argument('--rate-limits', action='store_true', help="Apply the scheduler's rate limits and the delivery pacing from the config.")
+    parser.add_argument('--coalesce-window', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.3, help="Stub model latency before the first token, in seconds.")
+    parser.add_argument('--token-latency', type=float, default=0.01, help="Stub model latency per token, in seconds.")
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--search-latency', type=float, default=0.15)
+    parser.add_argument('--discord-latency', type=float, default=0.05, help="Latency of each Discord send or edit, in seconds.")
+    parser.add_argument('--hf-model', help="Model for the huggingface brain, e.g. a tiny local checkpoint.")
+    parser.add_argument('--hf-draft-model', help="Draft model for assisted decoding with the huggingface brain.")
+    parser.add_argument('--hf-backend', nargs='+', help="Model backends to compare for the huggingface brain, e.g. fp32 int8-dynamic.")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    return parser.parse_args(argv)
+
+
+def without_option(argv: list[str], option: str) -> list[str]:
+    """Remove a command line option and the values following it."""
+    if option not in argv:
+        return argv
+    index = argv.index(option)
+    end = index + 1
+    while end < len(argv) and not argv[end].startswith('--'):
+        end += 1
+    return argv[:index] + argv[end:]
+
+
+def main(argv: list[str] | None = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    # Model backends only apply to the local brain.
+    configurations = [
+        (brain, backend)
+        for brain in args.brain
+        for backend in (args.hf_backend or [None] if brain == "huggingface" else [None])
+    ]
+    if len(configurations) == 1:
+        args.brain, args.hf_backend = configurations[0]
+        results = [asyncio.run(run_configuration(args))]
+    else:
+        # One process per configuration, so each starts from a clean heap.
+        results = []
+        others = without_option(without_option(argv, '--brain'), '--hf-backend')
+        for brain, backend in configurations:
+            try:
+                output = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.run", "--brain", brain, *(["--hf-backend", backend] if backend else []), "--json", *others],
+                    check=True, stdout=subprocess.PIPE, text=True,
+                ).stdout
+            except subprocess.CalledProcessError as e:
+                # e.g. a backend whose optional dependencies are missing; the others are still compared.
+                print(f"Skipping {brain}{f' {backend}' if backend else ''}: exited with status {e.returncode}", file=sys.stderr)
+                continue
+            results += json.loads(output.strip().splitlines()[-1])
+
+    print(json.dumps(results) if args.json else format_report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+
+class StubBackends:
+    """
+    Local stand-ins for the OpenAI, Mistral and Brave Search APIs, served by one aiohttp app.
+
+    OpenAI and Mistral share the OpenAI-compatible /v1/chat/completions wire format, streamed or not. Each reply
+    takes latency seconds before its first token and token_latency seconds per token after that. When tools are
+    offered and the latest user message contains "search", the model asks for a web search first, which is
+    answered by the Brave endpoints after search_latency seconds.
+    """
+    def __init__(
+        self,
+        latency: float = 0.3,
+        token_latency: float = 0.01,
+        reply_tokens: int = 40,
+        search_latency: float = 0.15,
+    ) -> None:
+        self.latency: float = latency
+        self.token_latency: float = token_latency
+        self.reply_tokens: int = reply_tokens
+        self.search_latency: float = search_latency
+        self.requests: dict[str, int] = {"chat": 0, "search": 0}
+        self._ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+
+        self.app: web.Application = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.app.router.add_get("/res/v1/web/search", self.search)
+        self.app.router.add_get("/res/v1/videos/search", self.search)
+
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving and return the base URL."""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["chat"] += 1
+        body = await request.json()
+        completion_id = f"stub{next(self._ids)}"
+        prompt_tokens = sum(len(json.dumps(message.get("content", ""))) for message in body["messages"]) // 4
+        tool_call = self._tool_call(body)
+        words = [] if tool_call else [f"word{i} " for i in range(min(self.reply_tokens, body.get("max_tokens") or self.reply_tokens))]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words) or 1, "total_tokens": prompt_tokens + (len(words) or 1)}
+        finish_reason = "tool_calls" if tool_call else "stop"
+
+        await asyncio.sleep(self.latency)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_latency * len(words))
+            message = {"role": "assistant", "content": "".join(words).strip()}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish: str | None = None, chunk_usage: dict | None = None) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            if chunk_usage is not None:
+                chunk["usage"] = chunk_usage
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await send({"role": "assistant", "content": ""})
+        if tool_call:
+            await send({"tool_calls": [{"index": 0, **tool_call}]})
+        for word in words:
+            await asyncio.sleep(self.token_latency)
+            await send({"content": word})
+        await send({"content": ""}, finish_reason, usage)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests["search"] += 1
+        await asyncio.sleep(self.search_latency)
+        query = request.query.get("q", "")
+        results = [{
+            "title": f"Result {i} for {query}",
+            "description": f"A synthetic search result about {query}.",
+            "url": f"https://example.com/{i}",
+            "age": "1 day ago",
+            "extra_snippets": [f"More about {query}."],
+            "video": {"duration": "01:00", "views": 100},
+        } for i in range(int(request.query.get("count", 5)))]
+        if request.path.endswith("/videos/search"):
+            return web.json_response({"results": results})
+        return web.json_response({"web": {"results": results}})
+
+
+    def _tool_call(self, body: dict) -> dict | None:
+        messages = body["messages"]
+        if not body.get("tools") or body.get("tool_choice") == "none" or messages[-1].get("role") != "user":
+            return None
+        content = messages[-1].get("content")
+        text = content if isinstance(content, str) else " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        if "search" not in text.lower():
+            return None
+        return {
+            "id": f"call{next(self._ids):05d}",
+            "type": "function",
+            "function": {"name": "search_the_web", "arguments": json.dumps({"query": text, "video": False})},
+        }
@@ -1,53 +1,173 @@
+import time
+STARTED_AT: float = time.perf_counter()
+
+import atexit
 import os
 import argparse
+import threading
 import importlib
 import yaml
+from typing import Callable
 
 from dotenv import load_dotenv
 
+from backend import metrics
+from backend.attachments import ImagePipeline
+from backend.cache import Cache, create_cache
+from backend.memory import SemanticMemory, create_memory
+from backend.persistence import ConversationStore, create_store
 from backend.preset import PRESETS
+from backend.startup import StartupTimer
 from backend.tools import Tools
 from backend.characters.base import Character
 from backend.brains.brain import Brain
+from backend.brains.fallback_brain import FallbackBrain
 from frontend.discord_handler import DiscordHandler
+from frontend.personas import Persona
 
-def class_loader(class_path: str, *args, **kwargs) -> Brain:
+def load_class(class_path: str) -> type:
     try:
         module_name, class_name = class_path.rsplit('.', 1)
         module = importlib.import_module(module_name)
-        return getattr(module, class_name)(*args, **kwargs)
+        return getattr(module, class_name)
     except (ImportError, AttributeError) as e:
         raise ValueError(f"Failed to load brain class '{class_path}': {e}")
 
+def class_loader(class_path: str, *args, **kwargs) -> Brain:
+    return load_class(class_path)(*args, **kwargs)
+
 def load_config(config_path: str) -> dict:
     with open(config_path, 'r') as f:
         return yaml.safe_load(f)
 
-def main(brain_path: str, character_path: str, delay: bool) -> None:
-    tools = Tools()
-    brain: Brain = class_loader(brain_path, tools=tools)
-    character: Character = class_loader(character_path)
-    brain.add_system_prompt(character.system_prompt())
+def brain_options(options: dict | None, brain_class: type) -> dict:
+    """
+    Return the options of the brain config section that apply to brain_class.
+
+    Options at the top of the section apply to every brain; those under a key naming a brain class (e.g.
+    HuggingfaceModelLoader) only to that class.
+    """
+    options = options or {}
+    shared = {key: value for key, value in options.items() if not isinstance(value, dict)}
+    return {**shared, **(options.get(brain_class.__name__) or {})}
+
+def load_preset(character_key: str) -> dict:
+    if character_key not in PRESETS:
+        raise ValueError(f"Unknown character: {character_key}")
+    return PRESETS[character_key]
+
+def main(character_keys: list[str], config: dict) -> None:
+    timer = StartupTimer(STARTED_AT)
+    timer.mark("imports")
+    metrics.configure(config.get('metrics'))
 
-    discord_handler: DiscordHandler = DiscordHandler(brain, character, delay)
+    cache_options: dict = config.get('cache') or {}
+    cache: Cache | None = create_cache(cache_options)
+    tools = Tools(cache=cache, **(config.get('tools') or {}))
+    images = ImagePipeline(cache=cache, **(config.get('images') or {}))
+    atexit.register(tools.close)
+    atexit.register(images.close)
+    # Conversations live in this process unless a shared store lets several bot processes (shards) continue them.
+    session_options: dict = config.get('session_store') or {}
+    session_store: Cache | None = None
+    if session_options.get('backend', 'memory') != 'memory':
+        session_store = create_cache({
+            'ttl': None,
+            'max_entries': 100000,
+            'path': './state/sessions.sqlite3',
+            'prefix': 'discobrain:sessions:',
+            **session_options,
+        })
+    store: ConversationStore | None = create_store(config.get('persistence'))
+    if store is not None:
+        atexit.register(store.close)
+    # Built by the first brain loaded in the background, as loading its embedding model takes seconds.
+    memories: list[SemanticMemory | None] = []
+    memory_lock = threading.Lock()
+
+    def load_memory() -> SemanticMemory | None:
+        with memory_lock:
+            if not memories:
+                with timer.stage("memory init"):
+                    memories.append(create_memory(config.get('memory')))
+                if memories[0] is not None:
+                    atexit.register(memories[0].close)
+            return memories[0]
+
+    def brain_loader(character_key: str, character: Character) -> Callable[[], Brain]:
+        brain_path: str = load_preset(character_key)['brain']
+        fallback_options: dict = dict(config.get('fallback') or {})
+        fallback: bool = fallback_options.pop('enabled', False)
+        # With fallback enabled, the character's own brain comes first, followed by the configured fallbacks.
+        brain_paths: list[str] = list(dict.fromkeys([brain_path, *fallback_options.pop('backends', [])])) if fallback else [brain_path]
+
+        def load_brain() -> Brain:
+            # Runs in the background once the bot is connecting, so heavy imports and model loading don't delay it.
+            with timer.stage(f"brain import ({character_key})"):
+                brain_classes = [load_class(path) for path in brain_paths]
+            memory = load_memory()
+            with timer.stage(f"brain init ({character_key})"):
+                shared = {
+                    'cache': cache,
+                    'cache_completions': cache_options.get('completions', False),
+                    'conversation_store': store,
+                    'memory': memory,
+                    'session_store': session_store,
+                    'persona': character_key,
+                }
+                if fallback:
+                    # The fallback brain keeps the conversation, so its backends only need the tools and images.
+                    backends = [
+                        brain_class(tools=tools, images=images, **brain_options(config.get('brain'), brain_class))
+                        for brain_class in brain_classes
+                    ]
+                    brain: Brain = FallbackBrain(backends=backends, **shared, **fallback_options, **brain_options(config.get('brain'), FallbackBrain))
+                else:
+                    brain = brain_classes[0](tools=tools, images=images, **shared, **brain_options(config.get('brain'), brain_classes[0]))
+                brain.add_system_prompt(character.system_prompt())
+            return brain
+        return load_brain
+
+    # The first character is the bot's own; the others answer when mentioned by name or in their channels.
+    characters: dict[str, Character] = {key: class_loader(load_preset(key)['character']) for key in character_keys}
+    character_key, *other_keys = characters
+    personas = [Persona(key, characters[key], brain_loader(key, characters[key])) for key in other_keys]
+
+    discord_handler: DiscordHandler = DiscordHandler(
+        brain_loader(character_key, characters[character_key]),
+        characters[character_key],
+        config.get('delay', False),
+        config.get('stream', False),
+        config.get('scheduler'),
+        startup_timer=timer,
+        character_key=character_key,
+        personas=personas,
+        channels=config.get('channels'),
+        conversation_store=store,
+        shard_count=(config.get('sharding') or {}).get('shard_count'),
+        shard_ids=(config.get('sharding') or {}).get('shard_ids'),
+        delivery_options=config.get('delivery'),
+    )
     discord_handler.run()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str, default='config.yaml')
+    parser.add_argument('--shard-count', type=int, help="Total number of shards, overriding sharding.shard_count.")
+    parser.add_argument('--shard-ids', type=int, nargs='+', help="Shards run by this process, overriding sharding.shard_ids.")
     args = parser.parse_args()
 
     config = load_config(args.config)
-    character_key = config.get('character')
-
-    if character_key not in PRESETS:
-        raise ValueError(f"Unknown character: {character_key}")
+    if args.shard_count or args.shard_ids:
+        config['sharding'] = {
+            **(config.get('sharding') or {}),
+            **({'shard_count': args.shard_count} if args.shard_count else {}),
+            **({'shard_ids': args.shard_ids} if args.shard_ids else {}),
+        }
+    character_keys = [config.get('character'), *(config.get('characters') or [])]
 
-    selected = PRESETS[character_key]
     try:
-        main(selected['brain'],
-             selected['character'],
-             config.get('delay', False))
+        main(list(dict.fromkeys(character_keys)), config)
     except ValueError as e:
         print(e)
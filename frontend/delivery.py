@@ -0,0 +1,233 @@
+import asyncio
+import contextvars
+import re
+from collections import deque
+from typing import Awaitable, Callable, Hashable
+
+import discord
+
+from backend.metrics import timer
+from frontend.scheduler import TokenBucket
+
+# The most characters Discord accepts in one message.
+MESSAGE_LIMIT: int = 2000
+
+# Places to split a long message, best first: before a code block, between paragraphs, between lines, after a
+# sentence and between words. A split point is only taken in the second half of a chunk, so chunks stay large.
+SPLIT_POINTS: list[re.Pattern] = [
+    re.compile(r"\n(?=```)"),
+    re.compile(r"\n\n"),
+    re.compile(r"\n"),
+    re.compile(r"[.!?][)\"']?\s"),
+    re.compile(r"\s"),
+]
+
+FENCE: re.Pattern = re.compile(r"^```(\S*)", re.MULTILINE)
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Split text into chunks of at most limit characters, at the most natural boundary available.
+
+    A code block that has to be split is closed at the end of one chunk and reopened, with its language, at the
+    start of the next, so every chunk renders on its own.
+    """
+    chunks = []
+    language = None  # The language of a code block left open by the previous chunk.
+    while text:
+        opener = f"```{language}\n" if language is not None else ""
+        if len(opener) + len(text) <= limit:
+            chunks.append(opener + text)
+            break
+        # Leave room to close a code block at the end of the chunk.
+        room = limit - len(opener) - len("\n```")
+        cut = _split_point(text, room)
+        chunk, text = opener + text[:cut].rstrip(), text[cut:]
+
+        language = _open_fence(chunk)
+        if language is not None:
+            chunk += "\n```"
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+
+def _split_point(text: str, room: int) -> int:
+    for pattern in SPLIT_POINTS:
+        ends = [match.end() for match in pattern.finditer(text, room // 2, room)]
+        if ends:
+            return ends[-1]
+    return room
+
+
+def _open_fence(chunk: str) -> str | None:
+    """Return the language of the code block left open at the end of chunk, or None if all blocks are closed."""
+    language = None
+    for match in FENCE.finditer(chunk):
+        language = match.group(1) if language is None else None
+    return language
+
+
+
+class Reply:
+    """
+    A reply on its way to a channel. While it is being generated, update() replaces its content and the delivery
+    worker edits the sent messages to match; finish() marks it complete.
+    """
+    def __init__(self, channel, prefix: str = "") -> None:
+        self.channel = channel
+        self.prefix: str = prefix
+        self.content: str = ""
+        self.finished: bool = False
+        # The Discord messages the reply was sent as, one per chunk.
+        self.messages: list[discord.Message] = []
+        # Sends run in the context the reply was created in, so they are attributed to the message it answers.
+        self.context: contextvars.Context = contextvars.copy_context()
+        self.changed: asyncio.Event = asyncio.Event()
+        self.delivered: asyncio.Event = asyncio.Event()
+
+
+    @property
+    def text(self) -> str:
+        return self.prefix + self.content
+
+
+    def update(self, content: str) -> None:
+        self.content = content
+        self.changed.set()
+
+
+    def finish(self, content: str | None = None) -> None:
+        if content is not None:
+            self.content = content
+        self.finished = True
+        self.changed.set()
+
+
+
+class ReplyDelivery:
+    """
+    Sends replies to Discord in the background, so a slow or rate-limited channel never holds up the next reply.
+
+    Each channel has a queue of replies, delivered in order by a worker task that exists while the queue is not
+    empty. Replies longer than Discord's message limit are split at code-block, paragraph or sentence boundaries.
+    Streamed replies are edited at most every edit_interval seconds, with all changes since the last edit
+    coalesced into one. Sends are paced by a token bucket of rate calls per per seconds for each channel, which
+    matches Discord's limit on messages to a channel; when Discord still answers 429, the call is retried after
+    the retry_after it gives, and server errors are retried with exponential backoff.
+    """
+    def __init__(
+        self,
+        rate: float = 5,
+        per: float = 5.0,
+        edit_interval: float = 1.2,
+        max_retries: int = 3,
+        limit: int = MESSAGE_LIMIT,
+    ) -> None:
+        self.rate: float = rate
+        self.per: float = per
+        self.edit_interval: float = edit_interval
+        self.max_retries: int = max_retries
+        self.limit: int = limit
+        self._queues: dict[Hashable, deque[Reply]] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+        self._buckets: dict[Hashable, TokenBucket] = {}
+
+
+    def send(self, channel, content: str, prefix: str = "") -> Reply:
+        """Queue a complete reply to be sent to channel."""
+        reply = self.reply(channel, prefix)
+        reply.finish(content)
+        return reply
+
+
+    def reply(self, channel, prefix: str = "") -> Reply:
+        """Queue a reply whose content is still being generated; it is sent once it has content."""
+        reply = Reply(channel, prefix)
+        self._queues.setdefault(channel.id, deque()).append(reply)
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._run(channel.id))
+        return reply
+
+
+    @property
+    def backlog(self) -> int:
+        """Replies not yet fully delivered, across all channels."""
+        return sum(len(queue) for queue in self._queues.values())
+
+
+    async def join(self) -> None:
+        """Wait until every queued reply is delivered."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+
+    async def _run(self, channel_id: Hashable) -> None:
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                reply = queue[0]
+                try:
+                    await asyncio.create_task(self._deliver(reply), context=reply.context)
+                except Exception as e:
+                    print(f"Failed to deliver a reply in channel {channel_id}: {e}")
+                finally:
+                    reply.delivered.set()
+                    queue.popleft()
+        finally:
+            del self._queues[channel_id]
+            del self._workers[channel_id]
+
+
+    async def _deliver(self, reply: Reply) -> None:
+        shown: list[str] = []
+        while True:
+            await reply.changed.wait()
+            reply.changed.clear()
+            finished = reply.finished
+            if reply.content.strip():
+                await self._sync(reply, split_message(reply.text, self.limit), shown)
+            if finished:
+                return
+            # Whatever is generated in the meantime goes out in a single edit.
+            await asyncio.sleep(self.edit_interval)
+
+
+    async def _sync(self, reply: Reply, chunks: list[str], shown: list[str]) -> None:
+        """Send new chunks of a reply and edit those that changed since they were sent."""
+        for i, chunk in enumerate(chunks):
+            if i < len(shown):
+                if chunk != shown[i]:
+                    with timer("discord_edit"):
+                        await self._call(reply.channel.id, lambda: reply.messages[i].edit(content=chunk))
+                    shown[i] = chunk
+            else:
+                with timer("discord_send"):
+                    reply.messages.append(await self._call(reply.channel.id, lambda: reply.channel.send(chunk)))
+                shown.append(chunk)
+
+
+    async def _call(self, channel_id: Hashable, request: Callable[[], Awaitable]):
+        bucket = self._buckets.setdefault(channel_id, TokenBucket(self.rate / self.per, self.rate))
+        for attempt in range(self.max_retries + 1):
+            while not bucket.try_acquire():
+                await asyncio.sleep(bucket.delay())
+            try:
+                return await request()
+            except discord.RateLimited as e:
+                # discord.py waits out rate limits itself and only gives up on long ones.
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except discord.HTTPException as e:
+                if attempt == self.max_retries or (e.status != 429 and e.status < 500):
+                    raise
+                await asyncio.sleep(_retry_after(e) or 2 ** attempt)
+
+
+def _retry_after(error: discord.HTTPException) -> float | None:
+    headers = getattr(error.response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
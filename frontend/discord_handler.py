@@ -1,75 +1,161 @@
+import asyncio
 import os
 from dotenv import load_dotenv
-import time
 import random
+import time
+from typing import Callable
 
 import discord
 from discord.ext import commands
 
 from backend.characters.base import Character
 from backend.brains.brain import Brain
+from backend.persistence import ConversationStore
+from backend.startup import StartupTimer
+from frontend.delivery import ReplyDelivery
+from frontend.personas import Persona, PersonaRouter
+from frontend.scheduler import OVERLOADED, RATE_LIMITED, RequestScheduler
 
 # Env variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD_ID = int(os.getenv('DISCORD_GUILD_ID'))
 
+# Saved conversations shown per page of !list.
+LIST_PAGE_SIZE: int = 10
 
 
 class DiscordHandler:
-    def __init__(self, brain: Brain, character: Character, delay: bool) -> None:
-        self.brain: Brain = brain
+    def __init__(
+        self,
+        brain: Brain | Callable[[], Brain],
+        character: Character,
+        delay: bool,
+        stream: bool = False,
+        scheduler_options: dict | None = None,
+        startup_timer: StartupTimer | None = None,
+        character_key: str = "default",
+        personas: list[Persona] | None = None,
+        channels: dict[int, str] | None = None,
+        conversation_store: ConversationStore | None = None,
+        shard_count: int | None = None,
+        shard_ids: list[int] | None = None,
+        delivery_options: dict | None = None,
+    ) -> None:
+        # The character given here is the bot's own; further personas answer when mentioned by name or in their
+        # channels. Brains may be given as loaders, which are called in the background once the bot is connecting.
+        self.router: PersonaRouter = PersonaRouter([Persona(character_key, character, brain), *(personas or [])], channels)
         self.character: Character = character
         self.delay: bool = delay
+        self.stream: bool = stream
+        self.startup_timer: StartupTimer = startup_timer or StartupTimer()
+        self.store: ConversationStore | None = conversation_store
+        # Replies are sent by per-channel queues, so answering the next message never waits on Discord.
+        self.delivery: ReplyDelivery = ReplyDelivery(**(delivery_options or {}))
+        self._scheduler_options: dict = dict(scheduler_options or {})
+        self.scheduler: RequestScheduler | None = None
+        if all(persona.brain is not None for persona in self.router):
+            self._create_scheduler()
         # Discord intents
         self.intents = discord.Intents.default()
         self.intents.members = True
         self.intents.presences = True
         self.intents.message_content = True
         self.intents.typing = False
-        self.bot = commands.Bot(command_prefix="!", intents=self.intents)
-    
+        if shard_count or shard_ids:
+            # One gateway connection per shard; with shard_ids this process only runs those shards, and other
+            # processes run the rest. Guilds are spread over the shards by id, so each conversation has one home.
+            self.bot = commands.AutoShardedBot(command_prefix="!", intents=self.intents, shard_count=shard_count, shard_ids=shard_ids)
+        else:
+            self.bot = commands.Bot(command_prefix="!", intents=self.intents)
+        self.bot.setup_hook = self._setup_hook
+
+    @property
+    def brain(self) -> Brain | None:
+        return self.router.default.brain
+
     def run(self) -> None:
         #############
         # COMMANDS  #
         #############
-        @self.bot.command(name='clear', help='Clears the specified number of messages. Usage: !clear [number]')
+        @self.bot.command(name='clear', help='Clears the specified number of messages and resets the conversation in this channel. Usage: !clear [number]')
         async def clear(ctx, amount: int):
             if not ctx.author.guild_permissions.manage_messages:
                 await ctx.send("You do not have permission to manage messages.")
                 return
+            if self.brain is None:
+                await ctx.send(f"{self.character.name()} is still warming up, try again in a moment.")
+                return
             try:
                 deleted = await ctx.channel.purge(limit=amount + 1)  # +1 to include the command message
-                self.brain.reset_history()
+                for persona in self.router:
+                    if persona.brain is not None:
+                        await asyncio.to_thread(persona.brain.reset_history, ctx.channel.id)
                 await ctx.send(f"Deleted {len(deleted)} messages.", delete_after=1)
             except discord.Forbidden:
                 await ctx.send("I don't have permission to delete messages in this channel.")
             except discord.HTTPException as e:
                 await ctx.send(f"An error occurred: {e}")
         
-        @self.bot.command(name='save', help='Save the conversation history as JSON. Usage: !save [title]')
-        async def save_conversation(ctx, title: str):
+        @self.bot.command(name='save', help='Save the conversation of this channel under a title, in the conversation store if one is configured and as a JSON file otherwise. Usage: !save [title] [character]')
+        async def save_conversation(ctx, title: str, character: str | None = None):
             if not ctx.author.guild_permissions.manage_messages:
                 await ctx.send("You do not have permission to manage messages.")
                 return
+            persona = self.router.for_channel(ctx.channel) if character is None else self.router.mentioned(character) or self.router.get(character)
+            if persona is None:
+                await ctx.send(f"Unknown character: {character}")
+                return
+            if persona.brain is None:
+                await ctx.send(f"{persona.character.name()} is still warming up, try again in a moment.")
+                return
             try:
-                self.brain.save_history(title)
+                await asyncio.to_thread(persona.brain.save_history, title, ctx.channel.id)
                 await ctx.send(f"Conversation saved.", delete_after=1)
             except discord.Forbidden:
                 await ctx.send("I don't have permission to delete messages in this channel.")
             except discord.HTTPException as e:
                 await ctx.send(f"An error occurred: {e}")
         
-        @self.bot.command(name='list', help='Lists all saved conversations. Usage: !list')
-        async def list_conversations(ctx):
-            folder_path = "./conversations"
-            if not os.path.exists(folder_path):
-                await ctx.send("The conversations folder does not exist.")
+        @self.bot.command(name='list', help='Lists saved conversations, most recent first. Usage: !list [page]')
+        async def list_conversations(ctx, page: int = 1):
+            if self.store is not None:
+                conversations, pages = await asyncio.to_thread(self.store.list, page, LIST_PAGE_SIZE)
+                entries = [
+                    f"{conversation['title']} ({conversation['persona'] or 'unknown'}, {conversation['turns']} turns, "
+                    f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(conversation['updated']))})"
+                    for conversation in conversations
+                ]
+            else:
+                folder_path = "./conversations"
+                if not os.path.exists(folder_path):
+                    await ctx.send("The conversations folder does not exist.")
+                    return
+                json_files = sorted(file for file in os.listdir(folder_path) if file.endswith(".json"))
+                pages = max(1, -(-len(json_files) // LIST_PAGE_SIZE))
+                entries = json_files[(page - 1) * LIST_PAGE_SIZE:page * LIST_PAGE_SIZE]
+
+            if not entries:
+                await ctx.send("No saved conversations." if page == 1 else f"There are only {pages} pages.")
+                return
+            file_list = "\n".join(entries)
+            await ctx.send(f"Saved conversations (page {page} of {pages}):\n```\n{file_list}\n```")
+
+        @self.bot.command(name='load', help='Continue a saved conversation in this channel. Usage: !load [title]')
+        async def load_conversation(ctx, title: str):
+            if not ctx.author.guild_permissions.manage_messages:
+                await ctx.send("You do not have permission to manage messages.")
                 return
-            files = os.listdir(folder_path)
-            json_files = [file for file in files if file.endswith(".json")]
-            file_list = "\n".join(json_files)
-            await ctx.send(f"Saved conversations:\n```\n{file_list}\n```")
+            persona = self.router.for_channel(ctx.channel)
+            if persona.brain is None:
+                await ctx.send(f"{persona.character.name()} is still warming up, try again in a moment.")
+                return
+            try:
+                turns = await asyncio.to_thread(persona.brain.load_history, title, ctx.channel.id)
+            except KeyError:
+                await ctx.send(f"No conversation is saved as {title}.")
+                return
+            await ctx.send(f"Loaded {turns} messages of {title}.", delete_after=5)
 
         ###########
         # EVENTS  #
@@ -78,9 +164,14 @@ class DiscordHandler:
         async def on_ready():
             guild = self.bot.get_guild(GUILD_ID)
             if guild is None:
-                print(f"Guild with ID {GUILD_ID} not found.")
+                if self.bot.shard_count and self.bot.shard_count > 1:
+                    print(f"Guild with ID {GUILD_ID} is served by another shard, this process runs shards {self.bot.shard_ids}.")
+                else:
+                    print(f"Guild with ID {GUILD_ID} not found.")
                 return
             print(f"Connected to guild: {guild.name} (ID: {guild.id})")
+            if not any(name == "gateway connected" for name, _ in self.startup_timer.milestones):
+                self.startup_timer.mark("gateway connected")
 
             with open(self.character.profile_picture(), 'rb') as image:
                 profile_picture = image.read()
@@ -96,14 +187,79 @@ class DiscordHandler:
                 return
 
             await self.bot.process_commands(message)
-            if message.content.startswith("!"): return
+            await self.handle_message(message)
+
+        self.bot.run(TOKEN)
+
+    async def handle_message(self, message: discord.Message) -> str | None:
+        """Queue a (non-command) message to be answered and return the scheduler's verdict."""
+        if message.content.startswith("!"): return None
+
+        persona = self.router.route(message)
+        if persona.brain is None:
+            await message.reply(f"{persona.character.name()} is still warming up, try again in a moment.", delete_after=30)
+            return None
 
-            if self.delay: time.sleep(random.uniform(0, 10))
+        status = self.scheduler.submit(message)
+        if status in (RATE_LIMITED, OVERLOADED) and not self.scheduler.should_warn(message):
+            return status
+        if status == RATE_LIMITED:
+            await message.reply("You're sending messages too quickly, give me a moment to think.", delete_after=10)
+        elif status == OVERLOADED:
+            await message.reply("I'm answering a lot of messages right now, please try again shortly.", delete_after=10)
+        return status
 
+    async def _setup_hook(self) -> None:
+        if self.scheduler is None:
+            asyncio.create_task(self._load_brains())
+
+    async def _load_brains(self) -> None:
+        # Personas are loaded one after another, the bot's own first; brains sharing a local model load it once.
+        for persona in self.router:
+            if persona.brain is not None:
+                continue
+            print(f"Loading brain for {persona.character.name()} in the background...")
+            try:
+                persona.brain = await asyncio.to_thread(persona.loader)
+            except Exception as e:
+                print(f"Failed to load brain for {persona.character.name()}: {e}")
+                continue
+            if self.scheduler is None:
+                self._create_scheduler(persona.brain)
+        self.startup_timer.mark("brains ready")
+        print(self.startup_timer.report())
+
+    def _create_scheduler(self, brain: Brain | None = None) -> None:
+        self._scheduler_options.setdefault('max_concurrency', (brain or self.brain).max_workers)
+        self.scheduler = RequestScheduler(self._respond, **self._scheduler_options)
+
+    async def _respond(self, message: discord.Message) -> None:
+        persona = self.router.route(message)
+        if persona.brain is None:
+            await message.reply(f"{persona.character.name()} is still warming up, try again in a moment.", delete_after=30)
+            return
+        if self.delay: await asyncio.sleep(random.uniform(0, 10))
+
+        # With several personas in play, each reply says who is speaking.
+        prefix = f"**{persona.character.name()}:** " if len(self.router) > 1 else ""
+        if self.stream:
+            brain_response = await self._stream_response(message, persona.brain, prefix)
+        else:
             async with message.channel.typing():
-                brain_response = self.brain.response(message)
+                brain_response = await persona.brain.aresponse(message)
+            self.delivery.send(message.channel, brain_response, prefix)
 
-            print(f"\n{self.character.name()}: {brain_response}\n")
-            await message.channel.send(brain_response)
+        print(f"\n{persona.character.name()}: {brain_response}\n")
 
-        self.bot.run(TOKEN)
\ No newline at end of file
+    async def _stream_response(self, message: discord.Message, brain: Brain, prefix: str = "") -> str:
+        """Post the reply as soon as its first chunk arrives and have it edited in place as the rest is generated."""
+        reply = self.delivery.reply(message.channel, prefix)
+        content = ""
+        try:
+            async with message.channel.typing():
+                async for chunk in brain.astream(message):
+                    content += chunk
+                    reply.update(content)
+        finally:
+            reply.finish(content)
+        return content
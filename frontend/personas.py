@@ -0,0 +1,76 @@
+import re
+from typing import Callable, Iterator
+
+import discord
+
+from backend.brains.brain import Brain
+from backend.characters.base import Character
+
+
+class Persona:
+    """A character together with the brain that speaks for it. The brain may be given as a loader, called later."""
+    def __init__(self, key: str, character: Character, brain: Brain | Callable[[], Brain]) -> None:
+        self.key: str = key
+        self.character: Character = character
+        self.brain: Brain | None = brain if isinstance(brain, Brain) else None
+        self.loader: Callable[[], Brain] | None = None if self.brain else brain
+
+
+    @property
+    def names(self) -> list[str]:
+        """Lower-case names the persona answers to: its key, its full name and its last name."""
+        full_name = self.character.name().lower()
+        return list(dict.fromkeys([self.key.lower(), full_name, full_name.split()[-1]]))
+
+
+
+class PersonaRouter:
+    """
+    Decides which persona answers a message.
+
+    A message that mentions a persona by name goes to the persona mentioned first; otherwise the channel's
+    persona answers (threads follow their parent channel), falling back to the first persona.
+    """
+    def __init__(self, personas: list[Persona], channels: dict[int, str] | None = None) -> None:
+        if not personas:
+            raise ValueError("At least one persona is required.")
+        self.default: Persona = personas[0]
+        self.personas: dict[str, Persona] = {persona.key: persona for persona in personas}
+        self.channels: dict[int, str] = {int(channel_id): key for channel_id, key in (channels or {}).items()}
+        for key in self.channels.values():
+            if key not in self.personas:
+                raise ValueError(f"Unknown character in channel routes: {key}")
+        self._patterns: list[tuple[re.Pattern, Persona]] = [
+            (re.compile(rf"\b{re.escape(name)}\b"), persona) for persona in personas for name in persona.names
+        ]
+
+
+    def route(self, message: discord.Message) -> Persona:
+        return self.mentioned(message.content or "") or self.for_channel(message.channel)
+
+
+    def mentioned(self, content: str) -> Persona | None:
+        if len(self.personas) == 1:
+            return None
+        content = content.lower()
+        matches = [(match.start(), persona) for pattern, persona in self._patterns if (match := pattern.search(content))]
+        return min(matches, key=lambda match: match[0])[1] if matches else None
+
+
+    def for_channel(self, channel) -> Persona:
+        for channel_id in (channel.id, getattr(channel, "parent_id", None)):
+            if channel_id in self.channels:
+                return self.personas[self.channels[channel_id]]
+        return self.default
+
+
+    def get(self, key: str) -> Persona | None:
+        return self.personas.get(key)
+
+
+    def __iter__(self) -> Iterator[Persona]:
+        return iter(self.personas.values())
+
+
+    def __len__(self) -> int:
+        return len(self.personas)
@@ -0,0 +1,285 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Hashable
+
+import discord
+
+from backend.metrics import MESSAGES, QUEUE_DEPTH, observe
+
+# Outcomes of RequestScheduler.submit().
+QUEUED = "queued"
+COALESCED = "coalesced"
+RATE_LIMITED = "rate_limited"
+OVERLOADED = "overloaded"
+
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to capacity events."""
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+    def delay(self) -> float:
+        """Return the number of seconds until a token is available."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+
+class CombinedMessage:
+    """Several consecutive messages from one author, presented to the brain as a single message."""
+    def __init__(self, messages: list[discord.Message]) -> None:
+        self.messages: list[discord.Message] = messages
+
+
+    @property
+    def content(self) -> str:
+        return "\n".join(message.content for message in self.messages if message.content)
+
+
+    @property
+    def attachments(self) -> list:
+        return [attachment for message in self.messages for attachment in message.attachments]
+
+
+    def __getattr__(self, name: str):
+        # Everything else (channel, author, guild, ...) comes from the latest message.
+        return getattr(self.messages[-1], name)
+
+
+
+class PendingRequest:
+    def __init__(self, message: discord.Message) -> None:
+        self.messages: list[discord.Message] = [message]
+        self.enqueued: float = time.monotonic()
+        self.last_message: float = self.enqueued
+
+
+    @property
+    def author_id(self) -> Hashable:
+        return self.messages[0].author.id
+
+
+    @property
+    def message(self) -> discord.Message | CombinedMessage:
+        return self.messages[0] if len(self.messages) == 1 else CombinedMessage(self.messages)
+
+
+    @property
+    def length(self) -> int:
+        return sum(len(message.content or "") for message in self.messages)
+
+
+    def add(self, message: discord.Message) -> None:
+        self.messages.append(message)
+        self.last_message = time.monotonic()
+
+
+    def ready_at(self, coalesce_window: float, max_delay: float) -> float:
+        """Return when the request may be answered: once its author paused, but never later than max_delay after it was queued."""
+        return min(self.last_message + coalesce_window, self.enqueued + max_delay)
+
+
+
+class RequestScheduler:
+    """
+    Sits between the Discord handler and the brain and decides which message is answered next.
+
+    - Each user has a token bucket; messages beyond it are rejected (RATE_LIMITED).
+    - Each guild has a token bucket that paces calls to the brain, keeping bursts under the API rate limits.
+    - Channels are served round-robin with at most one request in flight per channel, so one busy channel
+      cannot starve the others.
+    - Queues are bounded; when they are full new messages are shed (OVERLOADED).
+    - Messages a user sends in quick succession (within coalesce_window seconds of each other) are collapsed
+      into one request of at most coalesce_max_messages messages and coalesce_max_chars characters, which is
+      answered at most coalesce_max_delay seconds after its first message. Every message is charged to its
+      author's bucket, coalesced or not.
+    - Authors of rejected messages are told at most once per refill of one token of their bucket (see
+      should_warn()), so flooding the bot does not make it flood the channel with notices.
+    """
+    def __init__(
+        self,
+        handler: Callable[[discord.Message], Awaitable[None]],
+        max_concurrency: int = 4,
+        max_queue: int = 100,
+        max_channel_queue: int = 10,
+        user_rate: float = 0.2,
+        user_burst: int = 5,
+        guild_rate: float = 2.0,
+        guild_burst: int = 10,
+        coalesce_window: float = 1.0,
+        coalesce_max_messages: int = 5,
+        coalesce_max_chars: int = 4000,
+        coalesce_max_delay: float = 5.0,
+    ) -> None:
+        self.handler: Callable[[discord.Message], Awaitable[None]] = handler
+        self.max_concurrency: int = max_concurrency
+        self.max_queue: int = max_queue
+        self.max_channel_queue: int = max_channel_queue
+        self.user_rate: float = user_rate
+        self.user_burst: int = user_burst
+        self.guild_rate: float = guild_rate
+        self.guild_burst: int = guild_burst
+        self.coalesce_window: float = coalesce_window
+        self.coalesce_max_messages: int = coalesce_max_messages
+        self.coalesce_max_chars: int = coalesce_max_chars
+        self.coalesce_max_delay: float = coalesce_max_delay
+
+        self._channels: OrderedDict[Hashable, deque[PendingRequest]] = OrderedDict()
+        self._active_channels: set[Hashable] = set()
+        self._user_buckets: dict[Hashable, TokenBucket] = {}
+        self._guild_buckets: dict[Hashable, TokenBucket] = {}
+        self._warned: dict[Hashable, float] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._workers: list[asyncio.Task] = []
+
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(requests) for requests in self._channels.values())
+
+
+    def submit(self, message: discord.Message) -> str:
+        """
+        Queue a message to be answered.
+
+        Returns:
+            str: QUEUED, COALESCED (merged into the author's pending request), RATE_LIMITED or OVERLOADED.
+        """
+        self._start()
+        status = self._admit(message)
+        MESSAGES.inc(status=status)
+        QUEUE_DEPTH.set(self.queue_depth)
+        return status
+
+
+    def should_warn(self, message: discord.Message) -> bool:
+        """Return whether the author of a rejected message should be told, at most once every 1 / user_rate seconds."""
+        now = time.monotonic()
+        warned_at = self._warned.get(message.author.id)
+        if warned_at is not None and now - warned_at < 1 / self.user_rate:
+            return False
+        self._warned[message.author.id] = now
+        return True
+
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+    def _admit(self, message: discord.Message) -> str:
+        channel_id = message.channel.id
+        requests = self._channels.get(channel_id)
+
+        # Coalesced messages still grow the prompt, so they are charged like any other.
+        bucket = self._user_buckets.setdefault(message.author.id, TokenBucket(self.user_rate, self.user_burst))
+        if not bucket.try_acquire():
+            return RATE_LIMITED
+        if requests and self._can_coalesce(requests[-1], message):
+            requests[-1].add(message)
+            return COALESCED
+        if self.queue_depth >= self.max_queue or (requests and len(requests) >= self.max_channel_queue):
+            return OVERLOADED
+
+        self._channels.setdefault(channel_id, deque()).append(PendingRequest(message))
+        self._wakeup.set()
+        return QUEUED
+
+
+    def _can_coalesce(self, request: PendingRequest, message: discord.Message) -> bool:
+        # A full request is answered as it is and the message starts a new one.
+        return (
+            request.author_id == message.author.id
+            and len(request.messages) < self.coalesce_max_messages
+            and request.length + len(message.content or "") <= self.coalesce_max_chars
+            and time.monotonic() < request.enqueued + self.coalesce_max_delay
+        )
+
+
+    def _start(self) -> None:
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+
+    async def _worker(self) -> None:
+        while True:
+            request = await self._next_request()
+            channel_id = request.messages[0].channel.id
+            observe("queue_wait", time.monotonic() - request.enqueued)
+            try:
+                await self.handler(request.message)
+            except Exception as e:
+                print(f"Failed to answer message in channel {channel_id}: {e}")
+            finally:
+                self._active_channels.discard(channel_id)
+                self._wakeup.set()
+
+
+    async def _next_request(self) -> PendingRequest:
+        while True:
+            self._wakeup.clear()
+            request, wait = self._pop_ready()
+            if request is not None:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+        guild = getattr(request.messages[0], "guild", None)
+        bucket = self._guild_buckets.setdefault(guild.id if guild else None, TokenBucket(self.guild_rate, self.guild_burst))
+        while not bucket.try_acquire():
+            await asyncio.sleep(bucket.delay())
+        return request
+
+
+    def _pop_ready(self) -> tuple[PendingRequest | None, float | None]:
+        """
+        Take the next request to answer, visiting channels round-robin.
+
+        Returns:
+            tuple: The request (or None) and, if there is none, how long to wait before a coalescing request is ready.
+        """
+        now = time.monotonic()
+        wait = None
+        for channel_id, requests in self._channels.items():
+            if channel_id in self._active_channels:
+                continue
+            ready_at = requests[0].ready_at(self.coalesce_window, self.coalesce_max_delay)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+
+            request = requests.popleft()
+            if requests:
+                self._channels.move_to_end(channel_id)
+            else:
+                del self._channels[channel_id]
+            self._active_channels.add(channel_id)
+            QUEUE_DEPTH.set(self.queue_depth)
+            return request, None
+        return None, wait
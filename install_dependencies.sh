@@ -93,12 +93,21 @@ if $INSTALL_LOCAL; then
     pip install 'accelerate>=0.26.0'
     pip install nvidia-ml-py
     pip install mistral
+    # Optional: ONNX Runtime model backend (model_backend: onnx in config.yaml).
+    # pip install 'optimum[onnxruntime]'
 fi
 # Install packages
 pip install python-dotenv
 pip install mistralai
 pip install discord.py
 pip install requests
+pip install numpy
+# Downscales image attachments before they are sent to vision models (optional).
+pip install pillow
+# Embedding model for long-term memory (optional, see the memory section of config.yaml).
+# pip install sentence-transformers
+# Redis client for a session store or cache shared by several bot processes (optional).
+# pip install redis
 pip install audioop-lts
 
 
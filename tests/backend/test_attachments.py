@@ -0,0 +1,145 @@
+import base64
+import io
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import backend.attachments
+from backend.attachments import ImagePipeline, image_tokens, image_url, strip_inline_images
+from backend.cache import MemoryCache
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_png(width, height, color=(200, 30, 30)):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(output, "PNG")
+    return output.getvalue()
+
+def make_attachment(url, data=b"", content_type="image/png", width=None, height=None):
+    return SimpleNamespace(url=url, content_type=content_type, size=len(data), width=width, height=height)
+
+def image_message(*urls):
+    return {"role": "user", "content": [{"type": "text", "text": "look"}] + [{"type": "image_url", "image_url": {"url": url}} for url in urls]}
+
+# Test fixture for a pipeline whose downloads are served from a dict of URL to bytes
+@pytest.fixture
+def pipeline(monkeypatch):
+    files = {}
+    downloads = []
+
+    def get(self, url, timeout=None):
+        downloads.append(url)
+        response = requests.Response()
+        response.status_code = 200 if url in files else 404
+        response._content = files.get(url, b"")
+        return response
+    monkeypatch.setattr(requests.Session, "get", get)
+
+    pipeline = ImagePipeline(cache=MemoryCache(), max_side=256)
+    pipeline.files = files
+    pipeline.downloads = downloads
+    yield pipeline
+    pipeline.close()
+
+# Test that image parts are recognized in both the OpenAI and the Mistral formats
+def test_image_url():
+    assert image_url({"type": "image_url", "image_url": {"url": "a"}}) == "a"
+    assert image_url({"type": "image_url", "image_url": "b"}) == "b"
+    assert image_url({"type": "text", "text": "c"}) is None
+
+# Test that large images are downscaled to a data URL and that their token estimate shrinks accordingly
+def test_prepare_downscales(pipeline):
+    pipeline.files["https://cdn/big.png"] = make_png(2048, 1024)
+    [image] = pipeline.prepare([make_attachment("https://cdn/big.png", pipeline.files["https://cdn/big.png"])])
+
+    assert image.url.startswith("data:image/jpeg;base64,")
+    assert (image.width, image.height) == (256, 128)
+    assert image.tokens == image_tokens(256, 128) < image_tokens(2048, 1024)
+    with Image.open(io.BytesIO(base64.b64decode(image.url.split(",", 1)[1]))) as decoded:
+        assert decoded.size == (256, 128)
+
+# Test that the same image posted twice is sent once and that a repeated URL is served from the cache
+def test_prepare_dedupes_and_caches(pipeline):
+    data = make_png(300, 300)
+    pipeline.files["https://cdn/a.png"] = data
+    pipeline.files["https://cdn/b.png"] = data
+    attachments = [make_attachment("https://cdn/a.png", data), make_attachment("https://cdn/b.png", data)]
+
+    assert len(pipeline.prepare(attachments)) == 1
+    assert len(pipeline.prepare(attachments[:1])) == 1
+    assert sorted(pipeline.downloads) == ["https://cdn/a.png", "https://cdn/b.png"]
+
+# Test that attachments which are not images are ignored and failed downloads fall back to the original URL
+def test_prepare_skips_and_falls_back(pipeline):
+    attachments = [
+        make_attachment("https://cdn/notes.txt", content_type="text/plain"),
+        make_attachment("https://cdn/missing.png", width=1024, height=512),
+    ]
+    [image] = pipeline.prepare(attachments)
+
+    assert image.url == "https://cdn/missing.png"
+    assert (image.width, image.height) == (256, 128)
+
+# Test that without Pillow attachments are passed by URL
+def test_prepare_without_pillow(pipeline, monkeypatch):
+    monkeypatch.setattr(backend.attachments, "Image", None)
+    [image] = pipeline.prepare([make_attachment("https://cdn/a.png", width=100, height=50)])
+
+    assert image.url == "https://cdn/a.png"
+    assert pipeline.downloads == []
+
+# Test that limit keeps the newest images, at most max_images of them, and leaves the text in place
+def test_limit_keeps_newest():
+    pipeline = ImagePipeline(max_images=2, token_budget=10_000)
+    history = [image_message("1", "2"), {"role": "assistant", "content": "ok"}, image_message("3")]
+    pipeline.limit(history)
+
+    assert [image_url(part) for message in history if isinstance(message["content"], list) for part in message["content"]] == [None, "2", None, "3"]
+    pipeline.close()
+
+# Test that limit drops older images once their estimated tokens exceed the budget
+def test_limit_token_budget():
+    pipeline = ImagePipeline(max_images=10, token_budget=image_tokens(1024, 1024) + image_tokens(256, 256))
+    for url, side in (("old", 1024), ("mid", 1024), ("new", 256)):
+        pipeline._remember_tokens(backend.attachments.PreparedImage(url, side, side))
+    history = [image_message("old"), image_message("mid"), image_message("new")]
+    pipeline.limit(history)
+
+    assert [len(message["content"]) for message in history] == [1, 2, 2]
+    pipeline.close()
+
+# Test that an image dropped from one session is still charged its real cost in another session holding it
+def test_limit_keeps_shared_costs():
+    pipeline = ImagePipeline(max_images=1, token_budget=image_tokens(256, 256))
+    for url in ("small", "newer"):
+        pipeline._remember_tokens(backend.attachments.PreparedImage(url, 256, 256))
+    crowded = [image_message("small"), image_message("newer")]
+    pipeline.limit(crowded)
+    other = [image_message("small")]
+    pipeline.limit(other)
+
+    assert [len(message["content"]) for message in crowded] == [1, 2]
+    assert len(other[0]["content"]) == 2
+    pipeline.close()
+
+# Test that the estimated tokens of prepared images are kept for a bounded number of images
+def test_tokens_bounded():
+    pipeline = ImagePipeline(cache=MemoryCache(max_entries=2))
+    for i in range(5):
+        pipeline._remember_tokens(backend.attachments.PreparedImage(f"data:image/png;base64,{i}", 256, 256))
+
+    assert len(pipeline._tokens) == 2
+    assert all(len(key) == 40 for key in pipeline._tokens)
+    pipeline.close()
+
+# Test that inline images are replaced by a placeholder for storage, leaving the message itself unchanged
+def test_strip_inline_images():
+    message = image_message("data:image/png;base64,AAAA", "https://cdn.example.com/cat.png")
+
+    stripped = strip_inline_images(message)
+    assert stripped["content"][1] == {"type": "text", "text": "[image]"}
+    assert image_url(stripped["content"][2]) == "https://cdn.example.com/cat.png"
+    assert image_url(message["content"][1]).startswith("data:")
+    assert strip_inline_images({"role": "user", "content": "hi"}) == {"role": "user", "content": "hi"}
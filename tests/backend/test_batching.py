@@ -0,0 +1,126 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from backend.brains.batching import BatchingEngine
+from backend.brains.prefix_cache import PrefixCache
+
+WORDS = ["<pad>", "<eos>", "<system>", "<user>", "<assistant>"] + [f"w{i}" for i in range(59)]
+GREEDY = {"do_sample": False, "max_new_tokens": 12}
+
+# Word-level tokenizer with a chat template, built in memory so the tests run offline
+def make_tokenizer():
+    tokenizer = Tokenizer(models.WordLevel({word: i for i, word in enumerate(WORDS)}, unk_token="w0"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.decoder = decoders.WordPiece()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>", pad_token="<pad>")
+    tokenizer.chat_template = (
+        "{% for m in messages %}<{{ m['role'] }}> {{ m['content'] }} {% endfor %}"
+        "{% if add_generation_prompt %}<assistant> {% endif %}"
+    )
+    return tokenizer
+
+# Tiny randomly initialised model; greedy decoding makes its output deterministic
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(WORDS), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=4, max_position_embeddings=256, pad_token_id=0, bos_token_id=1, eos_token_id=1,
+    )
+    return LlamaForCausalLM(config).eval()
+
+def make_chat(i):
+    return [
+        {"role": "system", "content": "w1 w2 w3"},
+        {"role": "user", "content": " ".join(f"w{(i * 7 + j) % 50 + 5}" for j in range(3 + i))},
+    ]
+
+# Test fixture for a tiny model and tokenizer, shared by the tests of this module
+@pytest.fixture(scope="module")
+def model():
+    return make_model()
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return make_tokenizer()
+
+# Engine that records the size of every batch it generates
+class RecordingEngine(BatchingEngine):
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super().__init__(*args, **kwargs)
+
+    def _generate_batch(self, batch):
+        self.batches.append(len(batch))
+        super()._generate_batch(batch)
+
+def unbatched(model, tokenizer, chats, **generation_kwargs):
+    engine = BatchingEngine(model, tokenizer, max_batch_size=1)
+    try:
+        return [engine.generate(chat, **generation_kwargs) for chat in chats]
+    finally:
+        engine.stop()
+
+# Test that left-padded batches give every request the reply it gets when generated alone
+def test_batch_matches_single(model, tokenizer):
+    chats = [make_chat(i) for i in range(4)]
+    expected = unbatched(model, tokenizer, chats, **GREEDY)
+
+    engine = RecordingEngine(model, tokenizer, max_wait=0.2)
+    futures = [engine.submit(chat, **GREEDY) for chat in chats]
+    assert [future.result() for future in futures] == expected
+    assert engine.batches == [4]
+    engine.stop()
+
+# Test that only requests with the same generation settings share a batch
+def test_grouped_by_batch_key(model, tokenizer):
+    engine = RecordingEngine(model, tokenizer, max_wait=0.2)
+    futures = [engine.submit(make_chat(i), do_sample=False, max_new_tokens=4 if i % 2 else 6) for i in range(4)]
+    for future in futures:
+        future.result()
+
+    assert sorted(engine.batches) == [2, 2]
+    engine.stop()
+
+# Test that a failing request only fails its own future
+def test_error_stays_with_request(model, tokenizer):
+    engine = BatchingEngine(model, tokenizer, max_wait=0.2)
+    good = engine.submit(make_chat(0), **GREEDY)
+    bad = engine.submit(make_chat(1), do_sample=False, max_new_tokens=-1)
+
+    assert good.result() == unbatched(model, tokenizer, [make_chat(0)], **GREEDY)[0]
+    with pytest.raises(ValueError):
+        bad.result()
+    engine.stop()
+
+# Test that requests queued before stop() are still answered
+def test_stop_drains_queue(model, tokenizer):
+    engine = BatchingEngine(model, tokenizer, max_batch_size=2, max_wait=0.01)
+    futures = [engine.submit(make_chat(i), **GREEDY) for i in range(5)]
+    engine.stop()
+
+    assert all(future.done() and future.exception() is None for future in futures)
+    assert not engine._thread.is_alive()
+
+# Test that reusing the cached prefix of the system prompt and of earlier turns keeps replies unchanged
+def test_prefix_cache_matches_uncached(model, tokenizer):
+    chats = [make_chat(i) for i in range(3)]
+    expected = unbatched(model, tokenizer, chats, **GREEDY)
+
+    engine = BatchingEngine(model, tokenizer, prefix_cache=PrefixCache())
+    engine.register_prefix(chats[0][:1])
+    assert [engine.generate(chat, session_id=1, **GREEDY) for chat in chats] == expected
+    engine.stop()
+
+# Test that assisted decoding with a draft model gives the replies of plain greedy decoding, even with a prefix cache
+def test_assisted_matches_greedy(model, tokenizer):
+    chats = [make_chat(i) for i in range(5)]
+    expected = unbatched(model, tokenizer, chats, **GREEDY)
+
+    # The draft is a copy of the model, so its proposals are accepted; fresh copies keep the counting hooks off the fixture.
+    engine = BatchingEngine(make_model(), tokenizer, prefix_cache=PrefixCache(), assistant_model=make_model())
+    engine.register_prefix(chats[0][:1])
+    assert [engine.generate(chat, session_id=1, **GREEDY) for chat in chats] == expected
+    assert engine.draft_proposed > 0
+    engine.stop()
@@ -0,0 +1,101 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from backend.brains.brain import Brain
+from backend.cache import MemoryCache
+
+# Minimal brain that echoes the message content word by word
+class EchoBrain(Brain):
+    calls = 0
+
+    def add_system_prompt(self, system_prompt):
+        self.system_prompt = system_prompt
+
+    def response(self, message):
+        self.calls += 1
+        return message.content
+
+    def stream(self, message):
+        for word in message.content.split():
+            if word == "fail":
+                raise RuntimeError("generation failed")
+            yield word + " "
+
+    def _add_user_message(self, session, message):
+        session.append({"role": "user", "content": message.content})
+
+def make_message(content, channel_id=1):
+    return SimpleNamespace(content=content, channel=SimpleNamespace(id=channel_id), attachments=[])
+
+# Test fixture for EchoBrain instance
+@pytest.fixture
+def brain():
+    brain = EchoBrain(max_workers=2)
+    brain.add_system_prompt("prompt")
+    yield brain
+    brain.shutdown()
+
+async def collect(brain, message):
+    return [chunk async for chunk in brain.astream(message)]
+
+# Test that aresponse runs response() in the brain's pool
+def test_aresponse(brain):
+    assert asyncio.run(brain.aresponse(make_message("hello"))) == "hello"
+
+# Test that astream yields every chunk in order
+def test_astream(brain):
+    assert asyncio.run(collect(brain, make_message("a b c"))) == ["a ", "b ", "c "]
+
+# Test that errors raised while streaming reach the caller
+def test_astream_error(brain):
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(brain, make_message("a fail")))
+
+# Test that sessions are keyed by channel and seeded with the system prompt
+def test_sessions_per_channel(brain):
+    session = brain.sessions.get(brain.session_id(make_message("hi", channel_id=5)))
+
+    assert session.session_id == 5
+    assert session.history == [{"role": "system", "content": "prompt"}]
+
+# Test that opt-in completion caching only serves the first turn of a conversation
+def test_completion_cache():
+    brain = EchoBrain(cache=MemoryCache(), cache_completions=True)
+    brain.add_system_prompt("prompt")
+
+    asyncio.run(brain.aresponse(make_message("Hello", channel_id=1)))
+    asyncio.run(brain.aresponse(make_message("hello", channel_id=2)))
+    asyncio.run(brain.aresponse(make_message("hello", channel_id=2)))
+
+    assert brain.calls == 2
+    assert brain.sessions.get(2).history[-1] == {"role": "assistant", "content": "Hello"}
+    brain.shutdown()
+
+# Test that options no brain takes are reported instead of being silently ignored
+def test_unknown_options(capsys):
+    EchoBrain(max_sessions=5, tools=None, max_batch_sise=4).shutdown()
+
+    assert "EchoBrain ignores unknown options: max_batch_sise" in capsys.readouterr().out
+
+# Test that tool calls are logged as truncated JSON events only when JSON logs are enabled
+def test_tool_calls_logged(brain, capsys):
+    from backend import metrics
+    brain.tools = SimpleNamespace(call_many=lambda calls: [{"results": "x" * 1000} for _ in calls])
+    call = SimpleNamespace(id="call-1", function=SimpleNamespace(name="search_the_web", arguments='{"query": "paris"}'))
+    session = brain.sessions.get(1)
+
+    brain._run_tool_calls(session, SimpleNamespace(content="", tool_calls=[call]))
+    assert capsys.readouterr().out == ""
+    metrics.configure({"json_logs": True})
+    try:
+        brain._run_tool_calls(session, SimpleNamespace(content="", tool_calls=[call]))
+    finally:
+        metrics.configure(None)
+
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    [event] = [event for event in events if event["event"] == "tool_call"]
+    assert event["tool"] == "search_the_web" and event["arguments"] == '{"query": "paris"}'
+    assert len(event["result"]) < 300 and event["result_chars"] > 1000
+    assert session.history[-1]["content"] == '{"results":"' + "x" * 1000 + '"}'
@@ -0,0 +1,96 @@
+import fnmatch
+import time
+from unittest.mock import patch
+
+import pytest
+from backend.cache import MemoryCache, RedisCache, SQLiteCache, cache_key, create_cache
+
+# Local stand-in for a Redis client, implementing the few commands RedisCache uses
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value, expires = self.values.get(key, (None, None))
+        return None if expires is not None and expires < time.time() else value
+
+    def set(self, key, value, px=None):
+        self.values[key] = (value.encode(), time.time() + px / 1000 if px else None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.values if fnmatch.fnmatch(key, match)]
+
+# Test fixture for both cache backends
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "memory":
+        return MemoryCache(ttl=60, max_entries=2)
+    return SQLiteCache(str(tmp_path / "cache.sqlite3"), ttl=60, max_entries=2)
+
+# Test that keys ignore case, whitespace and trailing punctuation
+def test_cache_key_normalization():
+    assert cache_key("search", "Who are  you?", False) == cache_key("search", "who are you", False)
+    assert cache_key("search", "who are you", False) != cache_key("search", "who are you", True)
+
+# Test that stored values are returned
+def test_get_set(cache):
+    cache.set("key", {"results": [1, 2]})
+
+    assert cache.get("key") == {"results": [1, 2]}
+    assert cache.get("missing") is None
+
+# Test that entries expire after their time to live
+def test_ttl_expiry(cache):
+    with patch('backend.cache.time.time', return_value=1000):
+        cache.set("key", "value")
+    with patch('backend.cache.time.time', return_value=1061):
+        assert cache.get("key") is None
+
+# Test that the least recently used entry is evicted
+def test_lru_eviction(cache):
+    with patch('backend.cache.time.time', side_effect=range(1000, 1100)):
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+# Test that the SQLite cache persists across instances
+def test_sqlite_persistence(tmp_path):
+    SQLiteCache(str(tmp_path / "cache.sqlite3")).set("key", "value")
+
+    assert SQLiteCache(str(tmp_path / "cache.sqlite3")).get("key") == "value"
+
+# Test cache creation from config
+def test_create_cache(tmp_path):
+    assert create_cache(None) is None
+    assert isinstance(create_cache({"backend": "memory"}), MemoryCache)
+    assert isinstance(create_cache({"backend": "sqlite", "path": str(tmp_path / "c.sqlite3")}), SQLiteCache)
+    with pytest.raises(ValueError):
+        create_cache({"backend": "unknown"})
+
+# Test that the Redis cache stores JSON under its prefix, expires entries and only clears its own keys
+def test_redis_cache():
+    client = FakeRedis()
+    cache = RedisCache(ttl=60, prefix="test:", client=client)
+    other = RedisCache(prefix="other:", client=client)
+    cache.set("key", {"results": [1, 2]})
+    other.set("key", "kept")
+
+    assert cache.get("key") == {"results": [1, 2]}
+    assert "test:key" in client.values
+    with patch('time.time', return_value=time.time() + 120):
+        assert cache.get("key") is None
+
+    cache.clear()
+    assert cache.get("key") is None
+    assert other.get("key") == "kept"
+    other.delete("key")
+    assert other.get("key") is None
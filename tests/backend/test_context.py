@@ -0,0 +1,71 @@
+import pytest
+from backend.context import ContextWindow, message_text
+from backend.sessions import Session
+
+SYSTEM_PROMPT = {"role": "system", "content": "You are a test."}
+
+# Count one token per word to keep the budgets readable
+def count_words(text):
+    return len(text.split())
+
+# Test fixture for a summarizer that records what it was asked to fold
+@pytest.fixture
+def summarizer():
+    calls = []
+    def summarize(summary, turns):
+        calls.append(turns)
+        return f"{len(calls)} summaries"
+    summarize.calls = calls
+    return summarize
+
+def make_session(turns):
+    history = [SYSTEM_PROMPT] + [{"role": "user", "content": "word " * 10} for _ in range(turns)]
+    return Session(1, history)
+
+# Test that a history under budget is sent unchanged
+def test_fit_under_budget(summarizer):
+    context = ContextWindow(count_words, summarizer, max_tokens=1000)
+    session = make_session(3)
+
+    assert context.fit(session) == session.history
+    assert not summarizer.calls
+
+# Test that old turns are folded into the summary once the budget is exceeded
+def test_fit_folds_old_turns(summarizer):
+    context = ContextWindow(count_words, summarizer, max_tokens=60, low_water=0.5)
+    session = make_session(6)
+
+    messages = context.fit(session)
+
+    assert len(summarizer.calls) == 1
+    assert session.summary == "1 summaries"
+    assert session.history[0] == SYSTEM_PROMPT
+    assert sum(count_words(message_text(m)) + 4 for m in session.history) <= 60
+    assert "1 summaries" in messages[0]["content"]
+    assert messages[1:] == session.history[1:]
+
+# Test that tool results are folded together with the call that produced them
+def test_fit_keeps_tool_results_with_calls(summarizer):
+    context = ContextWindow(count_words, summarizer, max_tokens=30, low_water=0.5)
+    session = Session(1, [
+        SYSTEM_PROMPT,
+        {"role": "assistant", "content": "word " * 10, "tool_calls": []},
+        {"role": "tool", "content": "word " * 2},
+        {"role": "user", "content": "word " * 5},
+    ])
+
+    context.fit(session)
+
+    assert [m["role"] for m in session.history] == ["system", "user"]
+
+# Test that a failing summarizer does not break the response
+def test_fit_summarizer_failure():
+    def summarize(summary, turns):
+        raise RuntimeError("model unavailable")
+    context = ContextWindow(count_words, summarize, max_tokens=30)
+    session = make_session(5)
+
+    context.fit(session)
+
+    assert session.summary == ""
+    assert len(session.history) < 6
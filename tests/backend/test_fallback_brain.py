@@ -0,0 +1,157 @@
+import time
+
+import pytest
+from backend.brains.fallback_brain import CircuitBreaker, FallbackBrain
+from tests.backend.test_brain import EchoBrain, make_message
+
+# Brain that answers after a delay, or fails while failing is set
+class SlowBrain(EchoBrain):
+    def __init__(self, name, delay=0.0, failing=False, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.delay = delay
+        self.failing = failing
+        self.prompts = []
+
+    def response(self, message):
+        session = self.sessions.get(self.session_id(message))
+        self._add_user_message(session, message)
+        self.prompts.append([turn["content"] for turn in session.history])
+        time.sleep(self.delay)
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        return f"{self.name}: {message.content}"
+
+    def stream(self, message):
+        yield self.response(message)
+
+def make_brain(*backends, **kwargs):
+    brain = FallbackBrain(backends=list(backends), hedge_delay=0.05, **kwargs)
+    brain.add_system_prompt("prompt")
+    return brain
+
+# Test that a breaker opens after repeated failures and lets a single trial through once it resets
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+# Test that the first backend answers and the conversation is kept by the fallback brain
+def test_primary_answers():
+    primary, secondary = SlowBrain("primary"), SlowBrain("secondary")
+    brain = make_brain(primary, secondary)
+
+    assert brain.response(make_message("hello")) == "primary: hello"
+    assert brain.response(make_message("again")) == "primary: again"
+    assert primary.prompts[-1] == ["prompt", "hello", "primary: hello", "again"]
+    assert secondary.prompts == []
+    brain.shutdown()
+
+# Test that a slow backend is hedged to the next one, whose answer wins and which then continues the conversation
+def test_hedge_slow_backend():
+    slow, fast = SlowBrain("slow", delay=0.5), SlowBrain("fast")
+    brain = make_brain(slow, fast)
+
+    started = time.monotonic()
+    assert brain.response(make_message("hello")) == "fast: hello"
+    assert time.monotonic() - started < 0.4
+    assert brain.response(make_message("again")).endswith("again")
+    assert fast.prompts[-1][:3] == ["prompt", "hello", "fast: hello"]
+    brain.shutdown()
+
+# Test that failures fall back to the next backend and open the breaker of the failing one
+def test_fallback_and_breaker():
+    down, up = SlowBrain("down", failing=True), SlowBrain("up")
+    brain = make_brain(down, up, failure_threshold=2, reset_timeout=60)
+
+    assert [brain.response(make_message(f"message {i}")) for i in range(3)] == [f"up: message {i}" for i in range(3)]
+    assert len(down.prompts) == 2
+    assert brain.backends[0].breaker.state == "open"
+    brain.shutdown()
+
+# Test that an error is raised when every backend fails
+def test_all_backends_fail():
+    brain = make_brain(SlowBrain("a", failing=True), SlowBrain("b", failing=True))
+
+    with pytest.raises(RuntimeError):
+        brain.response(make_message("hello"))
+    brain.shutdown()
+
+# Test that streaming takes the chunks of the backend that answers first
+def test_stream():
+    brain = make_brain(SlowBrain("slow", delay=0.5), SlowBrain("fast"))
+
+    assert list(brain.stream(make_message("hello"))) == ["fast: hello"]
+    brain.shutdown()
+
+# Test that backends with a known lower latency are tried first
+def test_latency_routing():
+    first, second = SlowBrain("first"), SlowBrain("second")
+    brain = make_brain(first, second)
+    brain.backends[0].latencies.extend([1.0] * 10)
+    brain.backends[1].latencies.extend([0.1] * 10)
+
+    assert brain.response(make_message("hello")) == "second: hello"
+    brain.shutdown()
+
+# Brain that streams one chunk and then stalls
+class StallingBrain(SlowBrain):
+    def stream(self, message):
+        yield f"{self.name}: {message.content}"
+        time.sleep(1.0)
+        yield " and more"
+
+# Test that a backend stalling in the middle of its reply is given up on rather than waited for forever
+def test_stalled_stream_times_out():
+    brain = make_brain(StallingBrain("stalling"), timeout=0.2)
+    chunks = brain.stream(make_message("hello"))
+
+    assert next(chunks) == "stalling: hello"
+    with pytest.raises(TimeoutError):
+        next(chunks)
+    brain.shutdown()
+
+# Brain that starts answering late and then streams many chunks, counting the chunks of each reply
+class ChunkyBrain(SlowBrain):
+    def __init__(self, name, chunks=20, **kwargs):
+        super().__init__(name, **kwargs)
+        self.chunks = chunks
+        self.streamed = []
+
+    def response(self, message):
+        return "".join(self.stream(message))
+
+    def stream(self, message):
+        session = self.sessions.get(self.session_id(message))
+        with session.lock:
+            self.streamed.append(0)
+            time.sleep(self.delay)
+            for i in range(self.chunks):
+                self.streamed[-1] += 1
+                yield f"{self.name} {i} "
+                time.sleep(0.05)
+
+# Test that a hedged attempt that lost is stopped, so the next turn does not queue behind its reply
+def test_loser_stopped_for_next_turn():
+    slow, fast = ChunkyBrain("slow", delay=0.2), SlowBrain("fast")
+    brain = make_brain(slow, fast)
+    assert brain.response(make_message("hello")) == "fast: hello"
+
+    # The losing reply would take another second; the next turn goes to the slow backend as the fast one is down.
+    slow.delay = 0
+    fast.failing = True
+    started = time.monotonic()
+    chunks = brain.stream(make_message("again"))
+    assert next(chunks) == "slow 0 "
+    assert time.monotonic() - started < 0.6
+    chunks.close()
+    assert slow.streamed[0] < 5
+    brain.shutdown()
@@ -0,0 +1,20 @@
+from backend.brains import huggingface_local_brain
+from backend.brains.huggingface_local_brain import HuggingfaceModelLoader
+from tests.backend.test_batching import make_model, make_tokenizer
+
+# Test that brains sharing a loaded model share its engine, and are told when their engine options are ignored
+def test_shared_engine_options(monkeypatch, capsys):
+    monkeypatch.setattr(huggingface_local_brain, "load_tokenizer", lambda model_name: make_tokenizer())
+    monkeypatch.setattr(huggingface_local_brain, "load_model", lambda model_name, backend: make_model())
+    first = HuggingfaceModelLoader(model_backend="fp32", max_batch_size=4)
+    same = HuggingfaceModelLoader(model_backend="fp32", max_batch_size=4)
+    assert capsys.readouterr().out.count("already loaded") == 0
+
+    other = HuggingfaceModelLoader(model_backend="fp32", max_batch_size=4, workers=2)
+    assert "ignoring workers=2 (using 0)" in capsys.readouterr().out
+    assert first.engine is same.engine is other.engine
+
+    for brain in (first, same, other):
+        brain.cleanup()
+        brain.shutdown()
+    assert huggingface_local_brain._shared_models == {}
@@ -0,0 +1,116 @@
+import threading
+
+import pytest
+from backend.memory import HashingEmbedder, SemanticMemory, create_memory
+from tests.backend.test_brain import EchoBrain, make_message
+
+# Test fixture for a memory in a temporary directory
+@pytest.fixture
+def memory(tmp_path):
+    memory = SemanticMemory(str(tmp_path / "memory"), top_k=2, min_score=0.2, flush_interval=0.05)
+    yield memory
+    memory.close()
+
+def remember(memory, channel, *texts):
+    for text in texts:
+        memory.remember(channel, {"role": "user", "content": text})
+    memory.flush()
+
+# Test that texts sharing words are closer than unrelated ones
+def test_hashing_embedder():
+    embedder = HashingEmbedder()
+    cat, kitten, stocks = embedder.embed(["my cat is called Tom", "Tom the cat likes milk", "stock prices fell today"])
+
+    assert cat @ kitten > cat @ stocks
+    assert cat @ cat == pytest.approx(1.0)
+
+# Test that the most relevant turns of the channel are recalled, best first, and other channels are kept apart
+def test_recall(memory):
+    remember(memory, "1", "my cat is called Tom", "I work as a baker", "I live in Stockholm")
+    remember(memory, "2", "my dog is called Rex")
+
+    assert memory.recall("1", "what is my cat called?") == ["user: my cat is called Tom"]
+    assert memory.recall("1", "completely unrelated words") == []
+    assert memory.recall("2", "what is my cat called?") == ["user: my dog is called Rex"]
+
+# Test that excluded texts, e.g. turns still in the prompt, are not recalled
+def test_recall_exclude(memory):
+    remember(memory, "1", "my cat is called Tom", "the cat Tom is grey")
+
+    assert memory.recall("1", "cat Tom", exclude={"user: my cat is called Tom"}) == ["user: the cat Tom is grey"]
+
+# Test that memories are saved to disk, survive a restart and are re-embedded for a different embedder
+def test_persistence(memory, tmp_path):
+    remember(memory, "1", "my cat is called Tom")
+    memory.close()
+
+    reopened = SemanticMemory(str(tmp_path / "memory"), min_score=0.2)
+    assert reopened.recall("1", "cat called Tom") == ["user: my cat is called Tom"]
+    reopened.close()
+
+    reembedded = SemanticMemory(str(tmp_path / "memory"), embedder=HashingEmbedder(dimensions=256), min_score=0.2)
+    assert reembedded.recall("1", "cat called Tom") == ["user: my cat is called Tom"]
+    reembedded.close()
+
+# Embedder that blocks re-embedding until released, to look at the memory while it runs
+class BlockingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__(dimensions=256)
+        self.embedding = threading.Event()
+        self.release = threading.Event()
+
+    def embed(self, texts):
+        if len(texts) > 1:
+            self.embedding.set()
+            self.release.wait(5)
+        return super().embed(texts)
+
+# Test that re-embedding a channel's memories does not hold the lock, so other channels are still recalled
+def test_reembed_without_lock(memory, tmp_path):
+    remember(memory, "1", "my cat is called Tom", "the cat Tom is grey")
+    remember(memory, "2", "my dog is called Rex")
+    memory.close()
+
+    embedder = BlockingEmbedder()
+    reopened = SemanticMemory(str(tmp_path / "memory"), embedder=embedder, min_score=0.2)
+    loading = threading.Thread(target=reopened.recall, args=("1", "cat Tom"))
+    loading.start()
+    assert embedder.embedding.wait(5)
+    assert not reopened._lock.locked()
+    assert reopened.recall("2", "dog called Rex") == ["user: my dog is called Rex"]
+    embedder.release.set()
+    loading.join()
+    assert reopened.recall("1", "cat called Tom")[0] == "user: my cat is called Tom"
+    reopened.close()
+
+# Test that the oldest memories are forgotten beyond max_entries
+def test_max_entries(tmp_path):
+    memory = SemanticMemory(str(tmp_path / "memory"), max_entries=2, min_score=0.2)
+    remember(memory, "1", "first cat", "second cat", "third cat")
+
+    assert sorted(memory.recall("1", "cat")) == ["user: second cat", "user: third cat"]
+    memory.close()
+
+# Test that a brain adds recalled turns to the prompt after its history was reset
+def test_brain_recalls_after_reset(memory):
+    brain = EchoBrain(memory=memory)
+    brain.add_system_prompt("prompt")
+    brain._record_turn(make_message("my cat is called Tom"), "nice name")
+    memory.flush()
+    brain.reset_history(1)
+
+    session = brain.sessions.get(1)
+    session.append({"role": "user", "content": "what is my cat called?"})
+    memory.flush()
+    prompt = brain.context.fit(session)
+    assert "user: my cat is called Tom" in prompt[0]["content"]
+    assert len(prompt) == 2
+    brain.shutdown()
+
+# Test that memory is disabled unless enabled in the config
+def test_create_memory(tmp_path):
+    assert create_memory(None) is None
+    assert create_memory({"enabled": False}) is None
+    memory = create_memory({"enabled": True, "path": str(tmp_path / "memory"), "embedder": "hashing"})
+    assert isinstance(memory.embedder, HashingEmbedder)
+    memory.close()
@@ -0,0 +1,93 @@
+import json
+import urllib.request
+
+import pytest
+from backend import metrics
+from backend.metrics import MetricsRegistry
+
+# Test fixture for an empty registry
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+# Test that counters and gauges are rendered per label combination
+def test_counter_and_gauge(registry):
+    counter = registry.counter("test_requests_total", "Requests.", ["status"])
+    counter.inc(status="ok")
+    counter.inc(2, status="ok")
+    counter.inc(status="error")
+    registry.gauge("test_depth", "Depth.").set(3)
+
+    text = registry.render()
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{status="ok"} 3' in text
+    assert 'test_requests_total{status="error"} 1' in text
+    assert "test_depth 3" in text
+    assert counter.value(status="ok") == 3
+
+# Test that histogram buckets are cumulative and include +Inf, sum and count
+def test_histogram(registry):
+    histogram = registry.histogram("test_seconds", "Latency.", ["stage"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage="model")
+
+    text = registry.render()
+    assert 'test_seconds_bucket{stage="model",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="model",le="1"} 2' in text
+    assert 'test_seconds_bucket{stage="model",le="+Inf"} 3' in text
+    assert 'test_seconds_sum{stage="model"} 5.55' in text
+    assert histogram.count(stage="model") == 3
+
+# Test that registering a name twice returns the same metric, and wrong labels are rejected
+def test_register_twice(registry):
+    counter = registry.counter("test_total", "Total.", ["kind"])
+    assert registry.counter("test_total", "Total.", ["kind"]) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("test_total", "Total.")
+    with pytest.raises(ValueError):
+        counter.inc(other="x")
+
+# Test that timer() records the duration and counts errors
+def test_timer_records_errors():
+    count = metrics.STAGE_SECONDS.count(stage="test_stage")
+    errors = metrics.STAGE_ERRORS.value(stage="test_stage")
+    with metrics.timer("test_stage"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.timer("test_stage"):
+            raise RuntimeError("failed")
+
+    assert metrics.STAGE_SECONDS.count(stage="test_stage") == count + 2
+    assert metrics.STAGE_ERRORS.value(stage="test_stage") == errors + 1
+
+# Test that JSON logs are printed for each stage when enabled
+def test_json_logs(capsys):
+    metrics.configure({"json_logs": True})
+    try:
+        metrics.observe("test_logged", 0.25, channel=1)
+    finally:
+        metrics.configure(None)
+    line = json.loads(capsys.readouterr().out.strip())
+    assert line["event"] == "stage" and line["stage"] == "test_logged" and line["seconds"] == 0.25 and line["channel"] == 1
+
+# Test that the metrics endpoint serves the registry
+def test_metrics_endpoint():
+    server = metrics.start_server("127.0.0.1", 0)
+    try:
+        metrics.MESSAGES.inc(status="test")
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+        assert 'discobrain_messages_total{status="test"}' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# Test that the draft acceptance rate accounts for accepted and rejected draft tokens
+def test_draft_acceptance_rate(monkeypatch):
+    monkeypatch.setattr(metrics, "DRAFT_TOKENS", MetricsRegistry().counter("test_draft_tokens_total", "Draft tokens.", ["result"]))
+    assert metrics.draft_acceptance_rate() is None
+
+    metrics.record_draft(10, 7)
+    metrics.record_draft(10, 5)
+    assert metrics.draft_acceptance_rate() == pytest.approx(0.6)
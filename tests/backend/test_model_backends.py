@@ -0,0 +1,35 @@
+import pytest
+import torch
+from backend.brains import model_backends
+from backend.brains.model_backends import MODEL_BACKENDS, get_backend, model_memory_mb, register_backend
+
+# Test that auto picks bitsandbytes on a GPU and bf16 on CPU
+def test_auto_backend(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    assert get_backend("auto").name == "bnb-4bit"
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    assert get_backend(None).name == "bf16"
+
+# Test that unknown backends are rejected with the available ones listed
+def test_unknown_backend():
+    with pytest.raises(ValueError, match="int8-dynamic"):
+        get_backend("int3")
+
+# Test that registered backends can be selected by name, and only the ONNX one runs without a prefix cache
+def test_register_backend(monkeypatch):
+    monkeypatch.setattr(model_backends, "MODEL_BACKENDS", dict(MODEL_BACKENDS))
+    register_backend("test", "A test backend", prefix_cache=False)(lambda model_name, token=None: model_name)
+
+    backend = get_backend("test")
+    assert backend.load("model") == "model" and not backend.prefix_cache
+    assert [name for name, backend in MODEL_BACKENDS.items() if not backend.prefix_cache] == ["onnx"]
+
+# Test that the memory of dynamically quantized weights is counted, and is about a quarter of float32
+def test_model_memory_mb():
+    model = torch.nn.Sequential(torch.nn.Linear(256, 256), torch.nn.Linear(256, 256))
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    full = model_memory_mb(model)
+    assert full == pytest.approx(2 * (256 * 256 + 256) * 4 / (1024 * 1024))
+    assert full / 4.5 < model_memory_mb(quantized) < full / 3
+    assert model_memory_mb(object()) is None
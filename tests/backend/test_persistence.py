@@ -0,0 +1,99 @@
+import pytest
+from backend.persistence import ConversationStore, create_store
+from tests.backend.test_brain import EchoBrain, make_message
+
+# Test fixture for a store in a temporary directory
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.sqlite3"), flush_interval=0.01)
+    yield store
+    store.close()
+
+# Test fixture for a brain persisting its conversations to the store
+@pytest.fixture
+def brain(store):
+    brain = EchoBrain(conversation_store=store, persona="echo")
+    brain.add_system_prompt("prompt")
+    yield brain
+    brain.shutdown()
+
+# Test that appended turns are persisted in order and can be read back
+def test_append_and_load(store):
+    conversation_id = store.start_conversation(1, "echo")
+    for i in range(5):
+        store.append(conversation_id, {"role": "user", "content": f"message {i}"})
+
+    assert [turn["content"] for turn in store.load(conversation_id)] == [f"message {i}" for i in range(5)]
+    assert [turn["content"] for turn in store.load(conversation_id, limit=2)] == ["message 3", "message 4"]
+
+# Test that only titled conversations are listed, most recently updated first, one page at a time
+def test_list_pages(store):
+    for i in range(3):
+        conversation_id = store.start_conversation(i, "echo")
+        store.append(conversation_id, {"role": "user", "content": f"hello {i}"})
+        store.name(conversation_id, f"title {i}")
+    store.start_conversation(99, "echo")
+
+    conversations, pages = store.list(page=1, per_page=2)
+    assert pages == 2
+    assert [conversation["title"] for conversation in conversations] == ["title 2", "title 1"]
+    assert conversations[0]["turns"] == 1 and conversations[0]["preview"] == "hello 2"
+    assert [conversation["title"] for conversation in store.list(page=2, per_page=2)[0]] == ["title 0"]
+
+# Test that saving under an existing title moves the title to the new conversation
+def test_title_reuse(store):
+    first = store.start_conversation(1)
+    second = store.start_conversation(2)
+    store.name(first, "notes")
+    store.name(second, "notes")
+    assert store.find("notes") == second
+    assert store.find("missing") is None
+
+# Test that every turn of a brain's session is persisted as it happens
+def test_brain_persists_turns(brain, store):
+    brain._record_turn(make_message("hello"), "hi there")
+    brain.save_history("greeting", 1)
+
+    conversation_id = store.find("greeting")
+    assert conversation_id == brain.sessions.get(1).conversation_id
+    assert store.load(conversation_id) == [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi there"}]
+    assert store.list()[0][0]["persona"] == "echo"
+
+# Test that inline images are stored as placeholders
+def test_brain_persists_without_images(brain, store):
+    session = brain.sessions.get(1)
+    session.append({"role": "user", "content": [{"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}]})
+    brain.save_history("picture", 1)
+
+    assert store.load(store.find("picture")) == [{"role": "user", "content": [{"type": "text", "text": "[image]"}]}]
+
+# Test that a saved conversation is loaded into a session and continued
+def test_brain_load_history(brain, store):
+    session = brain.sessions.get(1)
+    session.append({"role": "user", "content": "first"})
+    session.append({"role": "assistant", "content": "reply"})
+    brain.save_history("saved", 1)
+    brain.reset_history(1)
+
+    assert brain.load_history("saved", 2) == 2
+    loaded = brain.sessions.get(2)
+    assert [message["content"] for message in loaded.history] == ["prompt", "first", "reply"]
+    loaded.append({"role": "user", "content": "second"})
+    assert [turn["content"] for turn in store.load(store.find("saved"))] == ["first", "reply", "second"]
+
+    with pytest.raises(KeyError):
+        brain.load_history("missing", 2)
+
+# Test that persistence can be disabled
+def test_create_store(tmp_path):
+    assert create_store(None) is None
+    assert create_store({"enabled": False}) is None
+    store = create_store({"path": str(tmp_path / "store.sqlite3")})
+    assert isinstance(store, ConversationStore)
+    store.close()
+
+# Test that only SQLite's synchronous modes are accepted, as the pragma is not parameterized
+def test_synchronous_checked(tmp_path):
+    ConversationStore(str(tmp_path / "full.sqlite3"), synchronous="full").close()
+    with pytest.raises(ValueError):
+        ConversationStore(str(tmp_path / "bad.sqlite3"), synchronous="OFF; DROP TABLE turns")
@@ -0,0 +1,71 @@
+import pytest
+from backend.brains.prefix_cache import PrefixCache, common_prefix_length
+
+# Minimal stand-in for a transformers cache holding one tensor-like object per token
+class FakeTensor:
+    def __init__(self, length):
+        self.length = length
+    def nelement(self):
+        return self.length
+    def element_size(self):
+        return 1
+
+class FakeLayer:
+    def __init__(self, length):
+        self.keys = FakeTensor(length)
+        self.values = FakeTensor(length)
+
+class FakeCache:
+    def __init__(self, length):
+        self.layers = [FakeLayer(length)]
+    def get_seq_length(self):
+        return self.layers[0].keys.length
+    def crop(self, max_length):
+        length = self.get_seq_length() + max_length if max_length < 0 else max_length
+        self.layers = [FakeLayer(length)]
+
+# Test fixture for PrefixCache instance
+@pytest.fixture
+def prefix_cache():
+    return PrefixCache(max_bytes=100)
+
+# Test common prefix length computation
+def test_common_prefix_length():
+    assert common_prefix_length([1, 2, 3], [1, 2, 4]) == 2
+    assert common_prefix_length([], [1]) == 0
+
+# Test that a lookup returns a cropped copy of the longest matching entry
+def test_lookup_longest_prefix(prefix_cache):
+    prefix_cache.store("system", [1, 2], FakeCache(2))
+    prefix_cache.store("session", [1, 2, 3, 4, 5], FakeCache(5))
+
+    past_key_values, length = prefix_cache.lookup(["session", "system"], [1, 2, 3, 4, 9, 9])
+
+    assert length == 4
+    assert past_key_values.get_seq_length() == 4
+    assert prefix_cache._entries["session"][1].get_seq_length() == 5
+
+# Test that at least one prompt token is left uncached
+def test_lookup_leaves_one_token(prefix_cache):
+    prefix_cache.store("session", [1, 2, 3], FakeCache(3))
+
+    _, length = prefix_cache.lookup(["session"], [1, 2, 3])
+
+    assert length == 2
+
+# Test that a miss returns no cache
+def test_lookup_miss(prefix_cache):
+    prefix_cache.store("session", [1, 2, 3], FakeCache(3))
+
+    assert prefix_cache.lookup(["session", "other"], [7, 8]) == (None, 0)
+
+# Test that least recently used entries are evicted once the byte budget is exceeded
+def test_eviction_by_size(prefix_cache):
+    prefix_cache.store("a", [1] * 20, FakeCache(20))
+    prefix_cache.store("b", [2] * 20, FakeCache(20))
+    prefix_cache.lookup(["a"], [1] * 21)
+    prefix_cache.store("c", [3] * 20, FakeCache(20))
+
+    assert "a" in prefix_cache
+    assert "b" not in prefix_cache
+    assert "c" in prefix_cache
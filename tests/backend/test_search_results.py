@@ -0,0 +1,70 @@
+import json
+
+from backend.search_results import BM25, clean_snippet, compact_results, normalize_url, tokenize
+from backend.tool_registry import tool_result_text
+
+def make_result(i, description, extra=(), url=None):
+    return {
+        "title": f"Result <strong>{i}</strong>",
+        "url": url or f"https://example.com/{i}",
+        "age": "1 day ago",
+        "description": description,
+        "extra_snippets": list(extra),
+    }
+
+# Test that highlighting tags, entities and URL variants are normalized
+def test_normalize():
+    assert clean_snippet("The <strong>Eiffel</strong> Tower &amp; more") == "The Eiffel Tower & more"
+    assert normalize_url("https://www.Example.com/page/") == normalize_url("http://example.com/page")
+    assert normalize_url("https://example.com/page?id=1") != normalize_url("https://example.com/page?id=2")
+
+# Test that BM25 scores documents sharing rare query terms highest
+def test_bm25():
+    documents = [tokenize(text) for text in ("the tower is tall", "paris has a tower and a river", "the weather is nice")]
+    scores = BM25(documents).scores(tokenize("paris tower"))
+
+    assert scores[1] > scores[0] > scores[2] == 0
+
+# Test that duplicate pages and repeated snippets are dropped
+def test_dedupe():
+    results = [
+        make_result(1, "Paris is the capital of France."),
+        make_result(2, "Paris is the capital of France.", extra=["Paris has 2 million inhabitants."]),
+        make_result(3, "A mirror of the first page.", url="http://www.example.com/1/"),
+    ]
+    compacted = compact_results("Paris population", results)
+
+    assert [page["url"] for page in compacted] == ["https://example.com/1", "https://example.com/2"]
+    assert compacted[0]["title"] == "Result 1"
+    assert compacted[1]["snippets"] == ["Paris has 2 million inhabitants."]
+
+# Test that the snippets most relevant to the query are kept within the token budget, in result order
+def test_rank_and_trim():
+    filler = "Unrelated words about something else entirely. " * 5
+    results = [
+        make_result(1, filler, extra=[filler + "one", filler + "two"]),
+        make_result(2, "The Eiffel Tower is 330 metres tall.", extra=[filler + "three"]),
+        make_result(3, "Height of the Eiffel Tower in metres.", extra=[filler + "four"]),
+    ]
+    compacted = compact_results("eiffel tower height", results, max_tokens=60)
+
+    assert [page["url"] for page in compacted] == ["https://example.com/1", "https://example.com/2", "https://example.com/3"]
+    assert [page.get("snippets") for page in compacted] == [None, ["The Eiffel Tower is 330 metres tall."], ["Height of the Eiffel Tower in metres."]]
+
+# Test that at most max_snippets snippets are kept per result and pages without snippets keep their link
+def test_max_snippets():
+    results = [make_result(1, "tower one", extra=["tower two", "tower three"]), make_result(2, None)]
+    compacted = compact_results("tower", results, max_snippets=2)
+
+    assert len(compacted[0]["snippets"]) == 2
+    assert compacted[1] == {"title": "Result 2", "url": "https://example.com/2", "age": "1 day ago"}
+
+# Test that tool results are serialized as compact JSON rather than a Python repr
+def test_tool_result_text():
+    result = {"query": "café", "results": [{"title": "A", "views": None}]}
+    text = tool_result_text(result)
+
+    assert text == '{"query":"café","results":[{"title":"A","views":null}]}'
+    assert json.loads(text) == result
+    assert len(text) < len(str(result))
+    assert tool_result_text("plain") == "plain"
@@ -0,0 +1,101 @@
+from unittest.mock import patch
+
+import pytest
+from backend.cache import SQLiteCache
+from backend.sessions import SessionManager
+
+def initial_history():
+    return [{"role": "system", "content": "prompt"}]
+
+# Test fixture for two session managers sharing a store, as two bot processes (shards) would
+@pytest.fixture
+def shards(tmp_path):
+    store = SQLiteCache(str(tmp_path / "sessions.sqlite3"), ttl=None)
+    return SessionManager(initial_history, store=store, namespace="echo"), SessionManager(initial_history, store=store, namespace="echo")
+
+# Test fixture for SessionManager instance
+@pytest.fixture
+def session_manager():
+    return SessionManager(lambda: [{"role": "system", "content": "prompt"}], max_sessions=2, idle_timeout=60)
+
+# Test that every session starts from its own copy of the initial history
+def test_sessions_are_independent(session_manager):
+    session_manager.get(1).append({"role": "user", "content": "hello"})
+
+    assert len(session_manager.get(1).history) == 2
+    assert session_manager.get(2).history == [{"role": "system", "content": "prompt"}]
+
+# Test that the least recently used session is evicted when the limit is exceeded
+def test_lru_eviction(session_manager):
+    session_manager.get(1)
+    session_manager.get(2)
+    session_manager.get(1)
+    session_manager.get(3)
+
+    assert 1 in session_manager
+    assert 2 not in session_manager
+    assert 3 in session_manager
+
+# Test that idle sessions expire
+def test_idle_sessions_expire(session_manager):
+    with patch('backend.sessions.time.monotonic', return_value=0):
+        session_manager.get(1)
+    with patch('backend.sessions.time.monotonic', return_value=120):
+        session_manager.get(2)
+
+    assert 1 not in session_manager
+    assert len(session_manager) == 1
+
+# Test that reset only clears the given session
+def test_reset_single_session(session_manager):
+    session_manager.get(1).append({"role": "user", "content": "hello"})
+    session_manager.get(2).append({"role": "user", "content": "hi"})
+    session_manager.reset(1)
+
+    assert len(session_manager.get(1).history) == 1
+    assert len(session_manager.get(2).history) == 2
+
+# Test that a conversation saved by one process is continued by another, and back
+def test_shared_store_continues_conversation(shards):
+    first, second = shards
+    first.get(1).append({"role": "user", "content": "hello"})
+    first.get(1).summary = "greetings"
+    first.save(1)
+
+    session = second.get(1)
+    assert [message["content"] for message in session.history] == ["prompt", "hello"]
+    assert session.summary == "greetings"
+
+    session.append({"role": "assistant", "content": "hi"})
+    second.save(1)
+    assert len(first.get(1).history) == 3
+
+# Test that a session is only reloaded when another process saved a newer version
+def test_shared_store_keeps_unchanged_session(shards):
+    first, second = shards
+    first.get(1).append({"role": "user", "content": "hello"})
+    first.save(1)
+    session = first.get(1)
+    session.append({"role": "assistant", "content": "not saved yet"})
+
+    assert first.get(1) is session and len(session.history) == 3
+
+# Test that resetting a session clears it in every process
+def test_shared_store_reset(shards):
+    first, second = shards
+    first.get(1).append({"role": "user", "content": "hello"})
+    first.save(1)
+    second.get(1)
+    second.reset(1)
+
+    assert first.get(1).history == initial_history()
+
+# Test that inline images are saved to the shared store as placeholders, while the process that has them keeps them
+def test_shared_store_without_images(shards):
+    first, second = shards
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}
+    first.get(1).append({"role": "user", "content": [image]})
+    first.save(1)
+
+    assert first.get(1).history[-1]["content"] == [image]
+    assert second.get(1).history[-1]["content"] == [{"type": "text", "text": "[image]"}]
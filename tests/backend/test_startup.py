@@ -0,0 +1,46 @@
+import threading
+import time
+
+from backend.startup import StartupTimer
+
+# Test that stages are timed individually, from any thread, and milestones from the start
+def test_stages_and_milestones():
+    timer = StartupTimer(time.perf_counter() - 1.0)
+    with timer.stage("imports"):
+        time.sleep(0.02)
+
+    def load():
+        with timer.stage("brain init"):
+            time.sleep(0.01)
+    thread = threading.Thread(target=load)
+    thread.start()
+    thread.join()
+    timer.mark("gateway connected")
+
+    assert [name for name, _ in timer.stages] == ["imports", "brain init"]
+    assert timer.stages[0][1] >= 0.02
+    [(name, elapsed)] = timer.milestones
+    assert name == "gateway connected" and elapsed >= 1.0
+
+# Test that a failing stage is still timed
+def test_failed_stage():
+    timer = StartupTimer()
+    try:
+        with timer.stage("brain import"):
+            raise ImportError("missing")
+    except ImportError:
+        pass
+
+    assert [name for name, _ in timer.stages] == ["brain import"]
+
+# Test that the report lists every stage and milestone
+def test_report():
+    timer = StartupTimer()
+    with timer.stage("imports"):
+        pass
+    timer.mark("brains ready")
+
+    lines = timer.report().splitlines()
+    assert lines[0] == "Startup time breakdown:"
+    assert lines[1].split()[0] == "imports"
+    assert lines[2].split()[:3] == ["brains", "ready", "after"]
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Literal
+
+import pytest
+from backend.tool_registry import ToolRegistry, json_schema, tool
+
+@tool(name="convert")
+def convert_units(value: float, unit: Literal["km", "mi"], precision: int | None = None, tags: list[str] | None = None) -> dict:
+    """
+    Convert a distance.
+
+    Args:
+        value (float): The distance to convert.
+        unit (str): The unit to convert to,
+            either kilometres or miles.
+        precision (int): Digits after the decimal point.
+    """
+    return {"value": round(value * (1.609 if unit == "km" else 1 / 1.609), precision or 0)}
+
+async def wait(seconds: float) -> float:
+    """Wait for a number of seconds."""
+    await asyncio.sleep(seconds)
+    return seconds
+
+# Test fixture for a registry with a short call timeout
+@pytest.fixture
+def registry():
+    registry = ToolRegistry(call_timeout=0.5)
+    yield registry
+    registry.close()
+
+# Test that Python types map to their JSON schema
+def test_json_schema():
+    assert json_schema(str) == {"type": "string"}
+    assert json_schema(list[int]) == {"type": "array", "items": {"type": "integer"}}
+    assert json_schema(float | None) == {"type": "number"}
+    assert json_schema(Literal["a", "b"]) == {"type": "string", "enum": ["a", "b"]}
+    with pytest.raises(TypeError):
+        json_schema(object)
+
+# Test that a definition is generated from the type hints and the docstring
+def test_definition(registry):
+    registry.register(convert_units)
+    [definition] = registry.definitions
+    function = definition["function"]
+
+    assert function["name"] == "convert"
+    assert function["description"] == "Convert a distance."
+    assert function["parameters"]["required"] == ["value", "unit"]
+    assert function["parameters"]["properties"]["unit"] == {
+        "type": "string", "enum": ["km", "mi"], "description": "The unit to convert to, either kilometres or miles.",
+    }
+    assert function["parameters"]["properties"]["tags"] == {"type": "array", "items": {"type": "string"}}
+    assert registry.definitions is registry.definitions
+
+# Test that tools registered by path are only imported once the tools are needed
+def test_lazy_registration(registry):
+    registry.register_lazy("tests.backend.test_tool_registry:convert_units")
+    registry.register_lazy("tests.backend.missing_module:tool")
+    assert registry._tools == {}
+
+    assert registry.call("convert", {"value": 10, "unit": "mi"}) == {"value": 6}
+    assert [definition["function"]["name"] for definition in registry.definitions] == ["convert"]
+
+# Test that coroutine tools run on the shared event loop and are cancelled when they time out
+def test_async_tools(registry):
+    registry.register(wait)
+    started = time.monotonic()
+    results = registry.call_many([("wait", {"seconds": 0.1}), ("wait", {"seconds": 0.1}), ("wait", '{"seconds": 5}')])
+
+    assert results[:2] == [0.1, 0.1]
+    assert "timed out" in results[2]["error"]
+    assert time.monotonic() - started < 1
+
+def divide(a: float, b: float) -> float:
+    """Divide a by b."""
+    if not isinstance(b, (int, float)):
+        raise TypeError("b must be a number")
+    return a / b
+
+# Test that arguments not matching the signature are reported as invalid, and errors raised by the tool as failures
+def test_invalid_arguments(registry):
+    registry.register(divide)
+
+    assert registry.call("divide", {"a": 1, "b": 2}) == 0.5
+    assert registry.call("divide", {"a": 1})["error"].startswith("Invalid arguments for divide")
+    assert registry.call("divide", {"a": 1, "b": 2, "c": 3})["error"].startswith("Invalid arguments for divide")
+    assert registry.call("divide", {"a": 1, "b": "2"}) == {"error": "The tool divide failed: b must be a number"}
+    assert registry.call("divide", {"a": 1, "b": 0})["error"].startswith("The tool divide failed")
@@ -1,10 +1,12 @@
 
 import os
 import json
+import time
 
 import requests
 import pytest
 from unittest.mock import patch, MagicMock
+from backend.cache import MemoryCache
 from backend.tools import Tools
 
 # Test fixture for Tools instance
@@ -25,7 +27,7 @@ def test_web_search_missing_api_key(tools_instance):
         assert result["error"] == "Brave Search API key not found in environment variables."
 
 # Test for HTTPError handling
-@patch('backend.tools.requests.get')
+@patch('backend.tools.requests.Session.get')
 def test_web_search_http_error(mock_get, tools_instance):
     mock_get.side_effect = requests.exceptions.HTTPError("HTTP error occurred")
 
@@ -34,7 +36,7 @@ def test_web_search_http_error(mock_get, tools_instance):
     assert "HTTP error occurred" in result["error"]
 
 # Test for connection error handling
-@patch('backend.tools.requests.get')
+@patch('backend.tools.requests.Session.get')
 def test_web_search_connection_error(mock_get, tools_instance):
     mock_get.side_effect = requests.exceptions.ConnectionError()
 
@@ -43,7 +45,7 @@ def test_web_search_connection_error(mock_get, tools_instance):
     assert "Connection error occurred" in result["error"]
 
 # Test for timeout error handling
-@patch('backend.tools.requests.get')
+@patch('backend.tools.requests.Session.get')
 def test_web_search_timeout_error(mock_get, tools_instance):
     mock_get.side_effect = requests.exceptions.Timeout()
 
@@ -52,7 +54,7 @@ def test_web_search_timeout_error(mock_get, tools_instance):
     assert "The request to Brave Search API timed out." in result["error"]
 
 # Test for request exception handling
-@patch('backend.tools.requests.get')
+@patch('backend.tools.requests.Session.get')
 def test_web_search_request_exception(mock_get, tools_instance):
     mock_get.side_effect = requests.exceptions.RequestException("General request error")
 
@@ -61,7 +63,7 @@ def test_web_search_request_exception(mock_get, tools_instance):
     assert "An error occurred: General request error" in result["error"]
 
 # Test for JSON decoding failure
-@patch('backend.tools.requests.get')
+@patch('backend.tools.requests.Session.get')
 def test_web_search_json_error(mock_get, tools_instance):
     mock_response = MagicMock()
     mock_response.json.side_effect = ValueError("Invalid JSON")
@@ -70,3 +72,51 @@ def test_web_search_json_error(mock_get, tools_instance):
     result = tools_instance.search_the_web("test query")
     assert "error" in result
     assert "Failed to parse JSON response" in result["error"]
+
+# Test that successful searches are served from the cache
+@patch('backend.tools.requests.Session.get')
+def test_web_search_cached(mock_get):
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"web": {"results": [{"title": "Paris"}]}}
+    mock_get.return_value = mock_response
+    tools = Tools(cache=MemoryCache())
+
+    first = tools.search_the_web("Paris")
+    second = tools.search_the_web("  paris ")
+
+    assert first == second
+    assert mock_get.call_count == 1
+
+# Test that tool calls are dispatched by name with JSON arguments
+def test_call_by_name(tools_instance):
+    tools_instance.registry.register(lambda text: text, name="echo")
+
+    assert tools_instance.call('echo', '{"text": "hi"}') == "hi"
+    assert "Unknown tool" in tools_instance.call('missing', '{}')["error"]
+    assert "Invalid arguments" in tools_instance.call('echo', 'not json')["error"]
+    assert "Invalid arguments" in tools_instance.call('echo', '{"words": "hi"}')["error"]
+
+# Test that tool calls run concurrently and a slow call times out without holding up the others
+def test_call_many_concurrent_with_timeout(tools_instance):
+    def slow(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    tools_instance.registry.call_timeout = 0.5
+    tools_instance.registry.register(slow)
+    start = time.monotonic()
+    results = tools_instance.call_many([('slow', {"seconds": 0.2}), ('slow', {"seconds": 0.2}), ('slow', {"seconds": 2})])
+    elapsed = time.monotonic() - start
+
+    assert results[:2] == [0.2, 0.2]
+    assert "timed out" in results[2]["error"]
+    assert elapsed < 1
+
+# Test that the web search is declared from its signature and docstring, once
+def test_tool_definitions(tools_instance):
+    [definition] = tools_instance.tool_definitions
+
+    assert definition["function"]["name"] == "search_the_web"
+    assert definition["function"]["parameters"]["properties"]["query"] == {"type": "string", "description": "The space-separated search query."}
+    assert definition["function"]["parameters"]["required"] == ["query"]
+    assert tools_instance.tool_definitions is tools_instance.tool_definitions
@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+from backend.brains.workers import WorkerError, WorkerPool
+
+# Stand-in for serve() that echoes the last message instead of loading a model. Messages saying "crash" kill
+# the worker and "hang" is never answered; with fail_marker set, loading fails once that file exists.
+def stub_serve(model_name, backend, engine_options, num_threads, requests, responses):
+    marker = engine_options.get("fail_marker")
+    if marker and os.path.exists(marker):
+        responses.put(("failed", None, "RuntimeError: cannot load the model"))
+        return
+    responses.put(("ready", None, os.getpid()))
+    while True:
+        command, request_id, payload = requests.get()
+        if command == "stop":
+            return
+        if command == "ping":
+            responses.put(("pong", request_id, None))
+        elif command == "generate":
+            messages, session_id, generation_kwargs, stream = payload
+            content = messages[-1]["content"]
+            if content == "crash":
+                os._exit(1)
+            if content == "hang":
+                continue
+            if stream:
+                for word in content.split():
+                    responses.put(("chunk", request_id, word))
+                responses.put(("done", request_id, None))
+            else:
+                responses.put(("done", request_id, f"{os.getpid()}:{content}"))
+
+def make_pool(workers=1, **kwargs):
+    options = {"health_interval": 0.05, "startup_timeout": 30, "target": stub_serve, **kwargs}
+    return WorkerPool("model", "fp32", workers=workers, **options)
+
+def chat(content):
+    return [{"role": "user", "content": content}]
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+# Test that workers start, replies reach their callers and a session always goes to the same worker
+def test_start_and_routing():
+    pool = make_pool(workers=2)
+    try:
+        assert all(worker.ready.is_set() for worker in pool._workers) and pool.healthy
+        assert pool.generate(chat("hello")).endswith(":hello")
+        assert list(pool.stream(chat("one two three"))) == ["one", "two", "three"]
+
+        replies = {session: pool.generate(chat(str(session)), session) for session in range(6)}
+        assert all(pool.generate(chat(str(session)), session) == reply for session, reply in replies.items())
+        assert len({reply.split(":")[0] for reply in replies.values()}) == 2
+    finally:
+        pool.stop()
+
+# Test that a crash fails the requests the worker was serving and that it is restarted
+def test_crash_fails_pending_and_restarts():
+    pool = make_pool()
+    try:
+        pending = pool.submit(chat("hang"))
+        with pytest.raises(WorkerError):
+            pool.generate(chat("crash"))
+        assert pending.get(timeout=5)[0] == "error"
+
+        [worker] = pool._workers
+        wait_for(lambda: worker.restarts == 1 and worker.ready.is_set())
+        assert pool.generate(chat("hello")).endswith(":hello")
+        assert worker.restarts == 1 and pool.healthy
+    finally:
+        pool.stop()
+
+# Test that a worker that cannot be loaded again is restarted with backoff, then given up on
+def test_gives_up_after_max_restarts(tmp_path):
+    marker = tmp_path / "broken"
+    pool = make_pool(max_restarts=2, restart_backoff=0.05, engine_options={"fail_marker": str(marker)})
+    try:
+        marker.touch()
+        started = time.monotonic()
+        with pytest.raises(WorkerError):
+            pool.generate(chat("crash"))
+
+        wait_for(lambda: not pool.healthy)
+        [worker] = pool._workers
+        # Restarts after 0 and 0.05 seconds, then none.
+        assert worker.restarts == 2 and time.monotonic() - started >= 0.05
+        with pytest.raises(WorkerError):
+            pool.generate(chat("hello"))
+    finally:
+        pool.stop()
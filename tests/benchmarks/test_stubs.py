@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import aiohttp
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser, answering
+from benchmarks.run import percentile
+from benchmarks.stubs import StubBackends
+
+async def post_chat(body):
+    stubs = StubBackends(latency=0, token_latency=0, reply_tokens=3, search_latency=0)
+    base_url = await stubs.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{base_url}/v1/chat/completions", json=body) as response:
+                return await response.text()
+    finally:
+        await stubs.stop()
+
+# Test that the stub answers chat completions in the OpenAI format
+def test_chat_completion():
+    body = json.loads(asyncio.run(post_chat({"model": "m", "messages": [{"role": "user", "content": "hi"}]})))
+    assert body["choices"][0]["message"]["content"] == "word0 word1 word2"
+    assert body["usage"]["completion_tokens"] == 3
+
+# Test that the stub streams server-sent events and asks for a search when tools are offered
+def test_streamed_tool_call():
+    text = asyncio.run(post_chat({
+        "model": "m",
+        "stream": True,
+        "tools": [{"type": "function"}],
+        "messages": [{"role": "user", "content": [{"type": "text", "text": "Please search for Paris"}]}],
+    }))
+    events = [line[len("data: "):] for line in text.splitlines() if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    tool_calls = [call for chunk in chunks for call in chunk["choices"][0]["delta"].get("tool_calls", [])]
+    assert tool_calls[0]["function"]["name"] == "search_the_web"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "tool_calls"
+
+# Test that replies sent while answering a message are attributed to it
+def test_fake_channel_records_replies():
+    async def reply():
+        channel = FakeChannel(1, FakeGuild(1))
+        message = FakeMessage("hi", FakeUser(1), channel)
+        answering.set(message)
+        sent = await channel.send("hello")
+        await sent.edit(content="hello there")
+        return message, sent
+
+    message, sent = asyncio.run(reply())
+    assert sent.answers is message and sent.content == "hello there"
+    assert message.first_reply <= message.last_reply
+
+# Test the nearest-rank percentile
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
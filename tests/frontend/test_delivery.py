@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+from frontend.delivery import ReplyDelivery, split_message
+
+# Records the messages sent to a channel and the edits made to them
+class FakeChannel:
+    def __init__(self, channel_id=1, failures=()):
+        self.id = channel_id
+        self.sent = []
+        self.calls = 0
+        # Exceptions raised by the first calls, one per call.
+        self.failures = list(failures)
+
+    async def send(self, content):
+        self._fail()
+        message = FakeSent(self, content)
+        self.sent.append(message)
+        return message
+
+    def _fail(self):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+
+class FakeSent:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content):
+        self.channel._fail()
+        self.content = content
+        self.edits += 1
+        return self
+
+def http_error(status, retry_after=None):
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+    return discord.HTTPException(SimpleNamespace(status=status, reason="error", headers=headers), "error")
+
+# Test that short messages are left alone and long ones split within the limit at sentence boundaries
+def test_split_sentences():
+    assert split_message("Hello there.") == ["Hello there."]
+
+    text = " ".join(f"Sentence number {i} is here." for i in range(200))
+    chunks = split_message(text, limit=300)
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    assert all(chunk.endswith(".") for chunk in chunks)
+    assert " ".join(chunks) == text
+
+# Test that paragraphs are preferred over sentences, and that text without spaces is cut hard
+def test_split_paragraphs_and_hard_cut():
+    first, second = "A short one. " * 10, "Another. " * 10
+    assert split_message(f"{first.strip()}\n\n{second.strip()}", limit=150) == [first.strip(), second.strip()]
+    assert split_message("x" * 250, limit=100) == ["x" * 96, "x" * 96, "x" * 58]
+
+# Test that a code block split across chunks is closed and reopened with its language
+def test_split_code_block():
+    code = "\n".join(f"print({i})" for i in range(60))
+    chunks = split_message(f"Here is the code:\n```python\n{code}\n```\nDone.", limit=200)
+
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert chunks[0].startswith("Here is the code:\n```python\n")
+    assert chunks[-1].endswith("```\nDone.")
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+    assert all(chunk.startswith("```python\n") for chunk in chunks[1:-1])
+    lines = [line for chunk in chunks for line in chunk.splitlines() if line.startswith("print")]
+    assert lines == code.splitlines()
+
+# Test that a long reply is sent as several messages, and replies to a channel keep their order
+def test_send_in_order():
+    async def scenario():
+        delivery = ReplyDelivery(limit=100)
+        channel = FakeChannel()
+        delivery.send(channel, "word " * 50)
+        delivery.send(channel, "second", prefix="**Bot:** ")
+        await delivery.join()
+        return channel, delivery
+
+    channel, delivery = asyncio.run(scenario())
+    assert len(channel.sent) == 4
+    assert channel.sent[-1].content == "**Bot:** second"
+    assert delivery.backlog == 0 and not delivery._workers
+
+# Test that streamed updates are coalesced into a few edits of the sent message
+def test_stream_coalesces_edits():
+    async def scenario():
+        delivery = ReplyDelivery(edit_interval=0.05)
+        channel = FakeChannel()
+        reply = delivery.reply(channel)
+        content = ""
+        for i in range(20):
+            content += f"{i} "
+            reply.update(content)
+            await asyncio.sleep(0.01)
+        reply.finish()
+        await delivery.join()
+        return channel, content
+
+    channel, content = asyncio.run(scenario())
+    [message] = channel.sent
+    assert message.content == content
+    assert 1 <= message.edits <= 6
+
+# Test that sends are paced by the per-channel rate
+def test_pacing():
+    async def scenario():
+        delivery = ReplyDelivery(rate=2, per=0.2)
+        channel = FakeChannel()
+        for i in range(4):
+            delivery.send(channel, f"reply {i}")
+        started = asyncio.get_running_loop().time()
+        await delivery.join()
+        return asyncio.get_running_loop().time() - started
+
+    # Two sends go out at once and the next two wait a tenth of a second each.
+    assert asyncio.run(scenario()) >= 0.18
+
+# Test that rate limited and server errors are retried and other errors drop the reply
+def test_retries():
+    async def scenario():
+        delivery = ReplyDelivery(rate=1e9, per=1.0)
+        flaky = FakeChannel(1, [http_error(429, retry_after=0.01), http_error(503, retry_after=0.01), discord.RateLimited(0.01)])
+        forbidden = FakeChannel(2, [http_error(403)])
+        delivery.send(flaky, "hello")
+        delivery.send(forbidden, "hello")
+        delivery.send(forbidden, "again")
+        await delivery.join()
+        return flaky, forbidden
+
+    flaky, forbidden = asyncio.run(scenario())
+    assert [message.content for message in flaky.sent] == ["hello"]
+    assert flaky.calls == 4
+    assert [message.content for message in forbidden.sent] == ["again"]
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import threading
+from types import SimpleNamespace
+
+# The handler module reads the guild id when it is imported.
+os.environ.setdefault("DISCORD_GUILD_ID", "1")
+
+from backend.startup import StartupTimer
+from frontend.discord_handler import DiscordHandler
+from frontend.personas import Persona
+from frontend.scheduler import QUEUED, RATE_LIMITED
+from tests.backend.test_brain import EchoBrain
+from tests.frontend.test_personas import NamedCharacter
+
+# Message recording the replies the handler sends to it
+class FakeMessage:
+    def __init__(self, content, channel_id=1):
+        self.content = content
+        self.attachments = []
+        self.author = SimpleNamespace(id=1)
+        self.channel = SimpleNamespace(id=channel_id)
+        self.guild = SimpleNamespace(id=1)
+        self.replies = []
+
+    async def reply(self, content, **kwargs):
+        self.replies.append(content)
+
+# Brain factory that blocks until released, then returns a brain or raises
+class FakeLoader:
+    def __init__(self, error=None):
+        self.error = error
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(timeout=5)
+        if self.error is not None:
+            raise self.error
+        return EchoBrain(max_workers=3)
+
+def make_handler(loader, personas=None):
+    return DiscordHandler(loader, NamedCharacter("Albert Einstein"), False, startup_timer=StartupTimer(), personas=personas)
+
+# Test that messages arriving while the brain loads get a warming up reply and are answered once it is ready
+def test_warming_up_until_loaded():
+    async def scenario():
+        loader = FakeLoader()
+        handler = make_handler(loader)
+        assert handler.scheduler is None
+        loading = asyncio.create_task(handler._load_brains())
+
+        early = FakeMessage("hello")
+        assert await handler.handle_message(early) is None
+        loader.release.set()
+        await loading
+        status = await handler.handle_message(FakeMessage("hello again"))
+        await handler.scheduler.stop()
+        return handler, early, status
+
+    handler, early, status = asyncio.run(scenario())
+    assert early.replies == ["Albert Einstein is still warming up, try again in a moment."]
+    assert status == QUEUED
+    assert handler.scheduler.max_concurrency == 3
+    assert [name for name, _ in handler.startup_timer.milestones] == ["brains ready"]
+    handler.brain.shutdown()
+
+# Test that a persona whose brain fails to load stays unavailable while the others are loaded
+def test_load_failure():
+    async def scenario():
+        failing = FakeLoader(RuntimeError("no weights"))
+        working = FakeLoader()
+        failing.release.set()
+        working.release.set()
+        handler = make_handler(failing, [Persona("curie", NamedCharacter("Marie Curie"), working)])
+        await handler._load_brains()
+        message = FakeMessage("hello")
+        await handler.handle_message(message)
+        return handler, message
+
+    handler, message = asyncio.run(scenario())
+    assert handler.brain is None
+    assert handler.router.get("curie").brain is not None
+    assert handler.scheduler is not None
+    assert message.replies == ["Albert Einstein is still warming up, try again in a moment."]
+    handler.router.get("curie").brain.shutdown()
+
+# Test that brains are only loaded in the background when they were given as loaders
+def test_setup_hook():
+    async def scenario():
+        brain = EchoBrain()
+        handler = make_handler(brain)
+        await handler._setup_hook()
+        loader = FakeLoader()
+        loader.release.set()
+        lazy = make_handler(loader)
+        await lazy._setup_hook()
+        await asyncio.sleep(0.1)
+        return handler, lazy, loader
+
+    handler, lazy, loader = asyncio.run(scenario())
+    assert handler.scheduler is not None
+    assert loader.calls == 1 and lazy.brain is not None
+    lazy.brain.shutdown()
+
+# Test that a user flooding the bot is told about the rate limit once, not once per message
+def test_rate_limit_warned_once():
+    async def scenario():
+        handler = make_handler(EchoBrain())
+        handler._scheduler_options.update(user_rate=0.01, user_burst=1)
+        handler._create_scheduler()
+        messages = [FakeMessage(f"spam {i}") for i in range(10)]
+        statuses = [await handler.handle_message(message) for message in messages]
+        await handler.scheduler.stop()
+        return handler, messages, statuses
+
+    handler, messages, statuses = asyncio.run(scenario())
+    assert statuses == [QUEUED] + [RATE_LIMITED] * 9
+    assert sum(len(message.replies) for message in messages) == 1
+    assert messages[1].replies == ["You're sending messages too quickly, give me a moment to think."]
+    handler.brain.shutdown()
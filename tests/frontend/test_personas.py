@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import pytest
+from backend.characters.base import Character
+from frontend.personas import Persona, PersonaRouter
+
+class NamedCharacter(Character):
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def description(self):
+        return self._name
+
+    def system_prompt(self):
+        return f"You are {self._name}."
+
+def make_message(content, channel_id=1, parent_id=None):
+    return SimpleNamespace(content=content, channel=SimpleNamespace(id=channel_id, parent_id=parent_id))
+
+# Test fixture for a router with two personas, the second routed to channel 2
+@pytest.fixture
+def router():
+    personas = [
+        Persona("einstein", NamedCharacter("Albert Einstein"), lambda: None),
+        Persona("curie", NamedCharacter("Marie Curie"), lambda: None),
+    ]
+    return PersonaRouter(personas, {"2": "curie"})
+
+# Test that messages go to the first persona by default and to the channel's persona in routed channels
+def test_route_by_channel(router):
+    assert router.route(make_message("hello")).key == "einstein"
+    assert router.route(make_message("hello", channel_id=2)).key == "curie"
+    assert router.route(make_message("hello", channel_id=3, parent_id=2)).key == "curie"
+
+# Test that mentioning a persona by name overrides the channel, and the first mention wins
+def test_route_by_mention(router):
+    assert router.route(make_message("What do you think, Curie?")).key == "curie"
+    assert router.route(make_message("Ask albert einstein", channel_id=2)).key == "einstein"
+    assert router.route(make_message("Einstein, what would Curie say?", channel_id=2)).key == "einstein"
+    assert router.route(make_message("curies and einsteinium")).key == "einstein"
+
+# Test that brains given as loaders are left unloaded
+def test_persona_loader():
+    loader = lambda: None
+    persona = Persona("einstein", NamedCharacter("Albert Einstein"), loader)
+    assert persona.brain is None and persona.loader is loader
+    assert persona.names == ["einstein", "albert einstein"]
+
+# Test that channel routes must name a known persona
+def test_unknown_channel_route():
+    with pytest.raises(ValueError):
+        PersonaRouter([Persona("einstein", NamedCharacter("Albert Einstein"), lambda: None)], {1: "curie"})
@@ -0,0 +1,115 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from frontend.scheduler import (
+    COALESCED,
+    OVERLOADED,
+    QUEUED,
+    RATE_LIMITED,
+    RequestScheduler,
+    TokenBucket,
+)
+
+def make_message(content, author_id=1, channel_id=1, guild_id=1):
+    return SimpleNamespace(
+        content=content,
+        attachments=[],
+        author=SimpleNamespace(id=author_id),
+        channel=SimpleNamespace(id=channel_id),
+        guild=SimpleNamespace(id=guild_id),
+    )
+
+# Records the messages answered by the scheduler
+class Answered(list):
+    async def handler(self, message):
+        self.append((message.channel.id, message.content))
+        await asyncio.sleep(0.01)
+
+# Test fixture for a handler that records the messages it answers
+@pytest.fixture
+def answered():
+    return Answered()
+
+# Test that a token bucket allows bursts and then refills at its rate
+def test_token_bucket():
+    with patch('frontend.scheduler.time.monotonic', return_value=0):
+        bucket = TokenBucket(rate=1, capacity=2)
+        assert bucket.try_acquire()
+        assert bucket.try_acquire()
+        assert not bucket.try_acquire()
+        assert bucket.delay() == pytest.approx(1)
+    with patch('frontend.scheduler.time.monotonic', return_value=1):
+        assert bucket.try_acquire()
+
+# Test that rapid messages from one user are answered as one request
+def test_coalescing(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, coalesce_window=0.05)
+        statuses = [scheduler.submit(make_message(text)) for text in ("hello", "are you", "there?")]
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return statuses
+
+    assert asyncio.run(scenario()) == [QUEUED, COALESCED, COALESCED]
+    assert answered == [(1, "hello\nare you\nthere?")]
+
+# Test that coalesced messages are charged to the user's bucket and requests stop growing at their caps
+def test_coalescing_limits(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, user_burst=4, coalesce_window=0.05, coalesce_max_messages=2)
+        statuses = [scheduler.submit(make_message(f"part {i}")) for i in range(5)]
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return statuses
+
+    assert asyncio.run(scenario()) == [QUEUED, COALESCED, QUEUED, COALESCED, RATE_LIMITED]
+    assert answered == [(1, "part 0\npart 1"), (1, "part 2\npart 3")]
+
+# Test that a user who keeps posting within the window is still answered by the coalescing deadline
+def test_coalescing_deadline(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, user_burst=100, coalesce_window=0.05, coalesce_max_messages=100, coalesce_max_delay=0.15)
+        started = asyncio.get_running_loop().time()
+        while not answered:
+            scheduler.submit(make_message("more"))
+            await asyncio.sleep(0.02)
+        await scheduler.stop()
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(scenario()) < 0.3
+
+# Test that users over their rate limit are rejected
+def test_user_rate_limit(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, user_rate=0.01, user_burst=1, coalesce_window=0)
+        statuses = [scheduler.submit(make_message("hi", channel_id=channel)) for channel in (1, 2)]
+        await scheduler.stop()
+        return statuses
+
+    assert asyncio.run(scenario()) == [QUEUED, RATE_LIMITED]
+
+# Test that messages are shed once the queue is full
+def test_load_shedding(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, max_queue=2, coalesce_window=10)
+        statuses = [scheduler.submit(make_message("hi", author_id=user)) for user in (1, 2, 3)]
+        await scheduler.stop()
+        return statuses
+
+    assert asyncio.run(scenario()) == [QUEUED, QUEUED, OVERLOADED]
+
+# Test that a busy channel does not starve other channels
+def test_fair_across_channels(answered):
+    async def scenario():
+        scheduler = RequestScheduler(answered.handler, max_concurrency=1, coalesce_window=0)
+        for user in range(3):
+            scheduler.submit(make_message(f"busy {user}", author_id=user, channel_id=1))
+        scheduler.submit(make_message("quiet", author_id=9, channel_id=2))
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert answered[:2] == [(1, "busy 0"), (2, "quiet")]
+    assert len(answered) == 4